@@ -0,0 +1 @@
+""" Offline performance benchmarks, run with 'python3 -m benchmarks.<name>'. """
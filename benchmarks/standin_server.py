@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+""" Local HTTP server standing in for the Canal+ API and CDN, serving synthetic data. """
+
+import argparse
+import hashlib
+import http.server
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+from benchmarks import synthetic
+from canalplus import http_server
+
+
+class StandInServer:
+
+  """
+  Stand-in Canal+ server, serving API XML data, HLS playlists and TS segments.
+
+  Program i has videos_per_program videos with ids i * VIDEO_ID_STRIDE + j. Each video has one HLS variant per
+  bandwidth in variant_bandwidths, with segments_per_video segments of segment_duration seconds.
+
+  latency is added before each response in seconds, bandwidth limits each response throughput in bytes per second,
+  error_rate is the probability of a 503 response, and reset_rate the probability to close the connection in the
+  middle of a TS segment. If relative_segment_urls is True, media playlists reference segments with relative URLs.
+  """
+
+  VIDEO_ID_STRIDE = 100000
+
+  def __init__(self, *, programs=50, videos_per_program=100, segments_per_video=30, segment_duration=10,
+               variant_bandwidths=(200000, 500000, 1000000), latency=0, bandwidth=None, error_rate=0, reset_rate=0,
+               relative_segment_urls=False, seed=0, port=0):
+    self.program_count = programs
+    self.videos_per_program = videos_per_program
+    self.segments_per_video = segments_per_video
+    self.segment_duration = segment_duration
+    self.variant_bandwidths = variant_bandwidths
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.error_rate = error_rate
+    self.reset_rate = reset_rate
+    self.relative_segment_urls = relative_segment_urls
+    self.random = random.Random(seed)
+    self.random_lock = threading.Lock()
+    self.request_count = 0
+    self.http_server = http_server.create_http_server(("127.0.0.1", port), self.makeHandlerClass())
+    self.base_url = "http://127.0.0.1:%u" % (self.http_server.server_address[1])
+    self.api_base_url = "%s/video/rest" % (self.base_url)
+    self.thread = None
+
+  def __enter__(self):
+    self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.http_server.shutdown()
+    self.http_server.server_close()
+
+  def getSegmentSize(self, variant):
+    """ Return the size in bytes of segments of a variant. """
+    return self.variant_bandwidths[variant] * self.segment_duration // 8
+
+  def getVideoSize(self, variant):
+    """ Return the size in bytes of a video for a variant. """
+    return self.getSegmentSize(variant) * self.segments_per_video
+
+  def draw(self, probability):
+    """ Return True with the given probability. """
+    if not probability:
+      return False
+    with self.random_lock:
+      return self.random.random() < probability
+
+  def route(self, path):
+    """ Return a tuple of (content type, data) for a path, or None if not found. """
+    parts = urllib.parse.unquote(path.split("?", 1)[0]).strip("/").split("/")
+    if parts[:2] == ["video", "rest"] and (len(parts) >= 4) and (parts[3] == "cplus"):
+      action = parts[2]
+      parameter = parts[4] if (len(parts) > 4) else ""
+      if action == "initPlayer":
+        return "text/xml", synthetic.make_program_list_xml(self.program_count)
+      elif action == "getMEAs":
+        program_id = int(parameter)
+        if program_id >= self.program_count:
+          return None
+        return "text/xml", synthetic.make_vidlist_xml(self.videos_per_program,
+                                                       "MEA",
+                                                       first_id=program_id * __class__.VIDEO_ID_STRIDE)
+      elif action == "getVideos":
+        return "text/xml", synthetic.make_video_info_xml(int(parameter),
+                                                          "%s/hls/%s/master.m3u8" % (self.base_url, parameter))
+      elif action == "search":
+        return "text/xml", synthetic.make_vidlist_xml(self.videos_per_program, "VIDEO", first_id=0)
+    elif (parts[0] == "hls") and (len(parts) == 3) and (parts[2] == "master.m3u8"):
+      video_id = int(parts[1])
+      variants = ((bandwidth, "%s/hls/%u/%u/index.m3u8" % (self.base_url, video_id, i))
+                  for i, bandwidth in enumerate(self.variant_bandwidths))
+      return "application/vnd.apple.mpegurl", synthetic.make_master_playlist(variants)
+    elif (parts[0] == "hls") and (len(parts) == 4):
+      video_id, variant = int(parts[1]), int(parts[2])
+      if variant >= len(self.variant_bandwidths):
+        return None
+      if parts[3] == "index.m3u8":
+        if self.relative_segment_urls:
+          url_prefix = ""
+        else:
+          url_prefix = "%s/hls/%u/%u/" % (self.base_url, video_id, variant)
+        segment_urls = ("%s%u.ts" % (url_prefix, i) for i in range(self.segments_per_video))
+        return "application/vnd.apple.mpegurl", synthetic.make_media_playlist(segment_urls, self.segment_duration)
+      elif parts[3].endswith(".ts"):
+        index = int(parts[3][:-3])
+        if index >= self.segments_per_video:
+          return None
+        return "video/mp2t", synthetic.make_segment(video_id, variant, index, self.getSegmentSize(variant))
+    return None
+
+  def makeHandlerClass(self):
+    server = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+      protocol_version = "HTTP/1.1"
+      disable_nagle_algorithm = True
+
+      def do_GET(self):
+        self.respond(True)
+
+      def do_HEAD(self):
+        self.respond(False)
+
+      def respond(self, send_body):
+        with server.random_lock:
+          server.request_count += 1
+        if server.latency:
+          time.sleep(server.latency)
+        if server.draw(server.error_rate):
+          self.send_error(503)
+          return
+        r = server.route(self.path)
+        if r is None:
+          self.send_error(404)
+          return
+        content_type, data = r
+        if isinstance(data, str):
+          data = data.encode("utf-8")
+        etag = "\"%s\"" % (hashlib.sha1(data).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+          self.send_response(304)
+          self.send_header("ETag", etag)
+          self.send_header("Content-Length", "0")
+          self.end_headers()
+          return
+        range_header = self.headers.get("Range")
+        if (range_header is not None) and range_header.startswith("bytes="):
+          start, end = range_header[6:].split("-", 1)
+          start = int(start)
+          end = int(end) if end else (len(data) - 1)
+          self.send_response(206)
+          self.send_header("Content-Range", "bytes %u-%u/%u" % (start, end, len(data)))
+          data = data[start:end + 1]
+        else:
+          self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+          self.sendBody(data, reset=(content_type == "video/mp2t") and server.draw(server.reset_rate))
+
+      def sendBody(self, data, reset):
+        chunk_size = 2 ** 14
+        if reset:
+          data = data[:len(data) // 2]
+        for i in range(0, len(data), chunk_size):
+          chunk = data[i:i + chunk_size]
+          self.wfile.write(chunk)
+          if server.bandwidth:
+            time.sleep(len(chunk) / server.bandwidth)
+        if reset:
+          self.close_connection = True
+          self.wfile.flush()
+          self.connection.shutdown(socket.SHUT_RDWR)
+
+      def log_message(self, *args):
+        pass
+
+    return Handler
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__,
+                                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  arg_parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+  arg_parser.add_argument("--latency", type=float, default=0, help="Latency added to each response in seconds")
+  arg_parser.add_argument("--bandwidth", type=int, default=None, help="Bandwidth of each response in bytes per second")
+  arg_parser.add_argument("--error-rate", type=float, default=0, help="Probability of a 503 response")
+  arg_parser.add_argument("--reset-rate", type=float, default=0, help="Probability of connection reset in a segment")
+  args = arg_parser.parse_args()
+  with StandInServer(latency=args.latency,
+                     bandwidth=args.bandwidth,
+                     error_rate=args.error_rate,
+                     reset_rate=args.reset_rate,
+                     port=args.port) as server:
+    print("Serving API at '%s'" % (server.api_base_url))
+    try:
+      server.thread.join()
+    except KeyboardInterrupt:
+      pass
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+""" Startup time benchmark of single program command line runs ('canalplus -p <program> -m last'). """
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import standin_server
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_child(api_base_url, cache_dir_path, cl_args):
+  """ Run the command line in a child process with a given cache directory, and return its wall time in seconds. """
+  cmd = [sys.executable, "-m", "benchmarks.startup", "--child", "--api-url", api_base_url, "--"]
+  cmd.extend(cl_args)
+  env = dict(os.environ, XDG_CACHE_HOME=cache_dir_path)
+  start = time.perf_counter()
+  subprocess.check_call(cmd, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return time.perf_counter() - start
+
+
+def clear_cache(dir_path, keep=()):
+  """ Remove all files and directories in a directory, except those listed in keep. """
+  for filename in os.listdir(dir_path):
+    if filename in keep:
+      continue
+    filepath = os.path.join(dir_path, filename)
+    if os.path.isdir(filepath):
+      shutil.rmtree(filepath)
+    else:
+      os.remove(filepath)
+
+
+def time_import(count):
+  """ Return the median wall time in seconds of a child process only importing canalplus. """
+  times = []
+  for _ in range(count):
+    start = time.perf_counter()
+    subprocess.check_call((sys.executable, "-c", "import canalplus"), cwd=ROOT_DIR)
+    times.append(time.perf_counter() - start)
+  return statistics.median(times)
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__,
+                                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  arg_parser.add_argument("--latency", type=float, default=0.05, help="Server latency in seconds")
+  arg_parser.add_argument("--programs", type=int, default=500, help="Number of programs")
+  arg_parser.add_argument("-c", "--count", type=int, default=5, help="Number of runs per case")
+  arg_parser.add_argument("--child", action="store_true", default=False, help=argparse.SUPPRESS)
+  arg_parser.add_argument("--api-url", default=None, help=argparse.SUPPRESS)
+  arg_parser.add_argument("cl_args", nargs="*", help=argparse.SUPPRESS)
+  args = arg_parser.parse_args()
+
+  if args.child:
+    import canalplus
+    canalplus.CanalPlusApiObject.BASE_URL = args.api_url
+    sys.argv = ["canalplus"] + args.cl_args
+    canalplus.cl_main()
+    return
+
+  program_id = args.programs // 2
+  cases = (("by name, cold cache", ("-p", "Program %u" % (program_id)), False),
+           ("by name, warm cache", ("-p", "Program %u" % (program_id)), True),
+           ("by id", ("-p", str(program_id)), False))
+  with standin_server.StandInServer(programs=args.programs,
+                                    videos_per_program=20,
+                                    segments_per_video=3,
+                                    latency=args.latency) as server:
+    print("Startup time (median of %u runs)" % (args.count))
+    print("  %-24s %8.1fms" % ("import", time_import(args.count) * 1000))
+    for name, program_args, warm in cases:
+      times = []
+      for _ in range(args.count):
+        with tempfile.TemporaryDirectory() as cache_dir_path:
+          cl_args = program_args + ("-m", "last", "--dry-run", cache_dir_path)
+          if warm:
+            run_child(server.api_base_url, cache_dir_path, cl_args)
+            # only keep the program index, so that API responses are fetched again like in a later cron run
+            clear_cache(os.path.join(cache_dir_path, "canalplus"), keep=("programs.json",))
+          times.append(run_child(server.api_base_url, cache_dir_path, cl_args))
+      print("  %-24s %8.1fms" % (name, statistics.median(times) * 1000))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+""" Offline benchmark suite of metadata resolution, downloads, and listing, against a local stand-in server. """
+
+import argparse
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import canalplus
+from benchmarks import standin_server
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_client(api_base_url):
+  """ Point the Canal+ API objects to a stand-in server, and disable logging. """
+  canalplus.CanalPlusApiObject.BASE_URL = api_base_url
+  logging.basicConfig(level=logging.CRITICAL + 1)
+
+
+def bench_metadata(server, count):
+  """ Return a dict of operation -> mean latency in seconds for metadata resolution operations. """
+  results = {}
+  start = time.perf_counter()
+  for _ in range(count):
+    programs = canalplus.CanalPlusProgramList()
+  results["program list"] = (time.perf_counter() - start) / count
+  start = time.perf_counter()
+  for i in range(count):
+    programs[i % len(programs)].fetchVidlist()
+  results["program video list"] = (time.perf_counter() - start) / count
+  start = time.perf_counter()
+  for i in range(count):
+    canalplus.CanalPlusVideo(i, "video").fetchVideoUrl()
+  results["video stream URL"] = (time.perf_counter() - start) / count
+  return results
+
+
+def download(segment_workers):
+  """ Download a video to a temporary directory, and return a tuple of (success, elapsed time in seconds). """
+  video = canalplus.CanalPlusVideo(0, "video")
+  video.fetchVideoUrl()
+  with tempfile.TemporaryDirectory() as temp_dir_path:
+    start = time.perf_counter()
+    success = video.download(temp_dir_path, segment_workers=segment_workers, show_progress=False)
+    return success, time.perf_counter() - start
+
+
+def list_all():
+  """ Get video lists of all programs. """
+  for program in canalplus.CanalPlusProgramList():
+    for video in program:
+      pass
+
+
+def get_peak_rss():
+  """ Return peak RSS of the current process in bytes. """
+  try:
+    # unlike getrusage, not inherited from the parent process before exec
+    with open("/proc/self/status", "rt") as f:
+      for line in f:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1]) * 1024
+  except FileNotFoundError:
+    pass
+  # ru_maxrss is in KB on Linux, bytes on macOS
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if (sys.platform == "darwin") else 1024)
+
+
+def run_child(path, api_base_url, args):
+  """ Run a benchmark path in a child process, and return its peak RSS in bytes. """
+  cmd = [sys.executable, "-m", "benchmarks.suite", "--child", path, "--api-url", api_base_url]
+  cmd.extend(args)
+  output = subprocess.check_output(cmd, cwd=ROOT_DIR, universal_newlines=True)
+  return int(output)
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__,
+                                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  arg_parser.add_argument("--latency", type=float, default=0.02, help="Server latency in seconds")
+  arg_parser.add_argument("--bandwidth",
+                          type=int,
+                          default=5 * 1024 * 1024,
+                          help="Server bandwidth per connection in bytes per second")
+  arg_parser.add_argument("--error-rate", type=float, default=0, help="Probability of server errors")
+  arg_parser.add_argument("--segments", type=int, default=30, help="Number of segments per video")
+  arg_parser.add_argument("--programs", type=int, default=50, help="Number of programs")
+  arg_parser.add_argument("--videos", type=int, default=100, help="Number of videos per program")
+  arg_parser.add_argument("--metadata-count", type=int, default=20, help="Number of metadata requests per operation")
+  arg_parser.add_argument("--workers",
+                          type=int,
+                          nargs="+",
+                          default=(1, 4, 8),
+                          help="Segment worker counts to benchmark downloads with")
+  arg_parser.add_argument("--child", choices=("download", "listing"), default=None, help=argparse.SUPPRESS)
+  arg_parser.add_argument("--api-url", default=None, help=argparse.SUPPRESS)
+  args = arg_parser.parse_args()
+
+  if args.child is not None:
+    setup_client(args.api_url)
+    if args.child == "download":
+      download(args.workers[0])
+    else:
+      list_all()
+    print(get_peak_rss())
+    return
+
+  with standin_server.StandInServer(programs=args.programs,
+                                    videos_per_program=args.videos,
+                                    segments_per_video=args.segments,
+                                    latency=args.latency,
+                                    bandwidth=args.bandwidth,
+                                    error_rate=args.error_rate) as server:
+    setup_client(server.api_base_url)
+    video_size = server.getVideoSize(len(server.variant_bandwidths) - 1)
+
+    print("Metadata resolution latency")
+    for operation, latency in bench_metadata(server, args.metadata_count).items():
+      print("  %-24s %8.1fms" % (operation, latency * 1000))
+
+    print("Download throughput (%s video)" % (canalplus.format_byte_size_str(video_size)))
+    for workers in args.workers:
+      success, elapsed = download(workers)
+      print("  %2u segment worker%s %13s/s%s" % (workers,
+                                                 "s" if workers > 1 else " ",
+                                                 canalplus.format_byte_size_str(video_size / elapsed),
+                                                 "" if success else " (failed)"))
+
+    print("Peak RSS")
+    for workers in args.workers:
+      rss = run_child("download", server.api_base_url, ("--workers", str(workers)))
+      print("  %-24s %10s" % ("download (%u worker%s)" % (workers, "s" if workers > 1 else ""),
+                              canalplus.format_byte_size_str(rss)))
+    rss = run_child("listing", server.api_base_url, ())
+    print("  %-24s %10s" % ("listing", canalplus.format_byte_size_str(rss)))
+
+
+if __name__ == "__main__":
+  main()
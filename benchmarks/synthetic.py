@@ -0,0 +1,69 @@
+""" Synthetic Canal+ API data. """
+
+import xml.sax.saxutils
+
+
+def make_vidlist_xml(count, video_tag, first_id=1000000):
+  """
+  Return XML text for a video list of count videos, with video_tag being 'MEA' (getMEAs) or 'VIDEO' (search), and video
+  ids starting at first_id.
+  """
+  root_tag = "MEAS" if (video_tag == "MEA") else "VIDEOS"
+  lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>", "<%s>" % (root_tag)]
+  for i in range(count):
+    lines.append("<%s><ID>%u</ID><INFOS><TITRAGE><TITRE>%s</TITRE><SOUS_TITRE>%s</SOUS_TITRE></TITRAGE></INFOS></%s>" %
+                 (video_tag,
+                  first_id + i,
+                  xml.sax.saxutils.escape("Video title #%u" % (i)),
+                  xml.sax.saxutils.escape("Subtitle & more #%u" % (i)) if (i % 2) else "",
+                  video_tag))
+  lines.append("</%s>" % (root_tag))
+  return "\n".join(lines)
+
+
+def make_program_list_xml(count, group_size=20):
+  """ Return initPlayer XML text for a list of count programs, split in groups of group_size programs. """
+  lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>", "<INIT_PLAYER>", "<THEMATIQUES>"]
+  for group_start in range(0, count, group_size):
+    lines.append("<THEMATIQUE><SELECTIONS>")
+    for i in range(group_start, min(count, group_start + group_size)):
+      lines.append("<SELECTION><ID>%u</ID><NOM>Program %u</NOM></SELECTION>" % (i, i))
+    lines.append("</SELECTIONS></THEMATIQUE>")
+  lines.extend(("</THEMATIQUES>", "</INIT_PLAYER>"))
+  return "\n".join(lines)
+
+
+def make_video_info_xml(video_id, hls_url):
+  """ Return getVideos XML text for a video with a HLS master playlist URL. """
+  return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+          "<VIDEOS><VIDEO><ID>%u</ID><MEDIA><VIDEOS><HLS>%s</HLS></VIDEOS></MEDIA></VIDEO></VIDEOS>" %
+          (video_id, xml.sax.saxutils.escape(hls_url)))
+
+
+def make_master_playlist(variants):
+  """ Return HLS master playlist text for an iterable of (bandwidth, media playlist URL) tuples. """
+  lines = ["#EXTM3U"]
+  for bandwidth, url in variants:
+    lines.append("#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%u" % (bandwidth))
+    lines.append(url)
+  return "\n".join(lines) + "\n"
+
+
+def make_media_playlist(segment_urls, segment_duration=10):
+  """ Return HLS media playlist text for an iterable of segment URLs. """
+  lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:%u" % (segment_duration), "#EXT-X-MEDIA-SEQUENCE:0"]
+  for url in segment_urls:
+    lines.append("#EXTINF:%u," % (segment_duration))
+    lines.append(url)
+  lines.append("#EXT-X-ENDLIST")
+  return "\n".join(lines) + "\n"
+
+
+def make_segment(video_id, variant, index, size):
+  """ Return deterministic data of a TS segment, made of 188 bytes MPEG-TS packets. """
+  packet = bytearray(188)
+  packet[0] = 0x47
+  header = ("%u/%u/%u" % (video_id, variant, index)).encode("ascii")
+  packet[4:4 + len(header)] = header
+  packet = bytes(packet)
+  return (packet * (size // len(packet) + 1))[:size]
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+""" Benchmark video list length, indexing and memory usage on synthetic lists. """
+
+import argparse
+import gc
+import time
+import tracemalloc
+import xml.etree.ElementTree
+
+import canalplus
+from benchmarks import synthetic
+
+
+class OfflineProgram(canalplus.CanalPlusProgram):
+
+  """ Program with a video list parsed from a XML string instead of fetched. """
+
+  def __init__(self, xml_text):
+    super().__init__(0, "benchmark")
+    self.xml_text = xml_text
+
+  def fetchVidlist(self):
+    self.parseVidlist(xml.etree.ElementTree.fromstring(self.xml_text))
+
+
+def legacy_auto_mode_loop(xml_vidlist):
+  """ Iterate over videos and get list length at each step, with the previous ElementTree based implementation. """
+  for xml_vid in xml_vidlist.iterfind("MEA"):
+    len(xml_vidlist.findall("MEA"))
+    xml_vidlist.findall("MEA")[-1].findtext("ID")
+
+
+def auto_mode_loop(program):
+  """ Iterate over videos and get list length at each step, like the command line automatic mode. """
+  for video in program:
+    len(program)
+    program[-1].id
+
+
+def measure(func, *args):
+  """
+  Call a function and return a tuple of (elapsed time in seconds, peak traced memory in bytes, retained memory in
+  bytes, return value).
+  """
+  gc.collect()
+  tracemalloc.start()
+  start = time.perf_counter()
+  r = func(*args)
+  elapsed = time.perf_counter() - start
+  retained, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return elapsed, peak, retained, r
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__)
+  arg_parser.add_argument("-c",
+                          "--count",
+                          type=int,
+                          default=10000,
+                          help="Number of videos in synthetic list")
+  args = arg_parser.parse_args()
+
+  xml_text = synthetic.make_vidlist_xml(args.count, "MEA")
+
+  legacy_parse = measure(xml.etree.ElementTree.fromstring, xml_text)
+  xml_vidlist = legacy_parse[3]
+  legacy_loop = measure(legacy_auto_mode_loop, xml_vidlist)
+  del xml_vidlist
+
+  program = OfflineProgram(xml_text)
+  parse = measure(program.fetchVidlist)
+  loop = measure(auto_mode_loop, program)
+
+  print("%u videos" % (args.count))
+  print("%-24s %12s %12s" % ("", "ElementTree", "indexed"))
+  print("%-24s %11.3fs %11.3fs" % ("parse", legacy_parse[0], parse[0]))
+  print("%-24s %10.1fMB %10.1fMB" % ("retained memory", legacy_parse[2] / 1000000, parse[2] / 1000000))
+  print("%-24s %11.3fs %11.3fs" % ("auto mode loop", legacy_loop[0], loop[0]))
+
+
+if __name__ == "__main__":
+  main()
@@ -7,8 +7,14 @@ __author__ = "desbma"
 __license__ = "GPLv3"
 
 import argparse
+import atexit
+import collections
+import concurrent.futures
 import contextlib
-import itertools
+import errno
+import functools
+import hashlib
+import io
 import logging
 import os
 import shutil
@@ -16,19 +22,68 @@ import signal
 import subprocess
 import string
 import sys
+import threading
+import time
 import urllib.parse
 import xml.etree.ElementTree
 
 import requests
 
 from canalplus import colored_logging
+from canalplus import download_journal
+from canalplus import http_cache
+from canalplus import http_transport
+from canalplus import m3u8
+from canalplus import metrics
 from canalplus import mkstemp_ctx
+from canalplus import program_index
 from canalplus import progress_display
 
 
 USER_AGENT = "Mozilla/5.0"
 IS_TRAVIS = os.getenv("CI") and os.getenv("TRAVIS")
+HTTP_CONNECT_TIMEOUT = 9.1 if IS_TRAVIS else 3.05
 HTTP_TIMEOUT = 30.1 if IS_TRAVIS else 9.1
+SEGMENT_READ_TIMEOUT = 60.1 if IS_TRAVIS else 30.1
+
+# video quality policies, the other policy is a maximum bitrate in bits per second
+QUALITY_MAX = "max"
+QUALITY_AUTO = "auto"
+
+# number of program video lists fetched concurrently when updating the local catalog
+CATALOG_UPDATE_WORKERS = 8
+
+# number of video stream URLs resolved concurrently
+RESOLVE_WORKERS = 8
+
+# number of videos remuxed concurrently while the next downloads run
+REMUX_WORKERS = 1
+
+# number of segments prefetched by the player mode proxy ahead of the last segment requested by the player
+PROXY_PREFETCH = 3
+
+# maximum size of the player mode proxy segment cache in bytes
+PROXY_CACHE_SIZE = 512 * 1024 * 1024
+
+# number of batch entries (video lists or videos) resolved concurrently
+BATCH_WORKERS = 8
+
+# prefix of video id entries in batch files
+BATCH_VIDEO_PREFIX = "video:"
+
+HTTP_REQUESTS = metrics.counter("canalplus_http_requests_total", "HTTP requests sent")
+HTTP_ERRORS = metrics.counter("canalplus_http_errors_total", "HTTP requests that failed or got an error status")
+API_LATENCY = metrics.histogram("canalplus_api_request_duration_seconds", "API and playlist request duration")
+CACHE_HITS = metrics.counter("canalplus_cache_hits_total", "API responses served from cache, possibly revalidated")
+SEGMENT_TTFB = metrics.histogram("canalplus_segment_ttfb_seconds", "Time to first byte of video segments")
+SEGMENT_THROUGHPUT = metrics.histogram("canalplus_segment_throughput_bytes_per_second",
+                                       "Download throughput of video segments",
+                                       metrics.THROUGHPUT_BUCKETS)
+SEGMENTS_DOWNLOADED = metrics.counter("canalplus_segments_downloaded_total", "Video segments downloaded")
+BYTES_DOWNLOADED = metrics.counter("canalplus_downloaded_bytes_total", "Video bytes downloaded")
+API_RETRIES = metrics.counter("canalplus_api_retries_total", "API and playlist request retries")
+SEGMENT_RETRIES = metrics.counter("canalplus_segment_retries_total", "Video segment download retries")
+REMUX_DURATION = metrics.histogram("canalplus_remux_duration_seconds", "Duration of remuxing to MP4")
 
 
 def format_byte_size_str(size):
@@ -41,137 +96,956 @@ def format_byte_size_str(size):
   return "%uB" % (size)
 
 
+def format_retries_str(count):
+  """ Return a progress information suffix for a number of retries. """
+  if not count:
+    return ""
+  return ", %u retr%s" % (count, "ies" if (count > 1) else "y")
+
+
+def preallocate_file(file, size):
+  """
+  Reserve disk space for a file object to grow to a given size, to avoid fragmentation and fail early if the disk is
+  full. The file size is extended, and must be truncated after writing. Return True if space was reserved, False if
+  preallocation is not supported.
+  """
+  if not hasattr(os, "posix_fallocate"):
+    return False
+  try:
+    os.posix_fallocate(file.fileno(), 0, size)
+  except OSError as e:
+    if e.errno == errno.ENOSPC:
+      raise
+    logging.getLogger().debug("Unable to preallocate file: %s" % (e))
+    return False
+  return True
+
+
+class DownloadStopped(Exception):
+
+  """ Raised by a download when its stop event is set, between two segments. """
+
+  pass
+
+
+class TeeFile:
+
+  """
+  Binary file object wrapper also writing data written to or read from the file to a stream, which can be closed early
+  by its reader.
+  """
+
+  def __init__(self, file, stream):
+    self.file = file
+    self.stream = stream
+
+  def write(self, data):
+    self.writeStream(data)
+    return self.file.write(data)
+
+  def read(self, *args):
+    data = self.file.read(*args)
+    self.writeStream(data)
+    return data
+
+  def writeStream(self, data):
+    if self.stream is None:
+      return
+    try:
+      self.stream.write(data)
+    except BrokenPipeError:
+      logging.getLogger().debug("Stream closed by reader")
+      self.stream = None
+
+  def writeStreams(self, data):
+    """ Write data to the stream, and to the streams of wrapped TeeFile objects. """
+    self.writeStream(data)
+    if isinstance(self.file, TeeFile):
+      self.file.writeStreams(data)
+
+  def getRawFile(self):
+    """ Return the innermost wrapped file object. """
+    return self.file.getRawFile() if isinstance(self.file, TeeFile) else self.file
+
+  def replay(self, start, end):
+    """ Write data already in file between start and end offsets to the streams (see writeStreams). """
+    if start == end:
+      return
+    raw_file = self.getRawFile()
+    position = raw_file.tell()
+    raw_file.seek(start)
+    remaining = end - start
+    while remaining > 0:
+      data = raw_file.read(min(remaining, 2 ** 16))
+      if not data:
+        break
+      remaining -= len(data)
+      self.writeStreams(data)
+    raw_file.seek(position)
+
+  def __getattr__(self, name):
+    return getattr(self.file, name)
+
+
+class HashStream:
+
+  """ Write only stream updating a hashlib hash object with the data written to it. """
+
+  def __init__(self, hash):
+    self.hash = hash
+
+  def write(self, data):
+    self.hash.update(data)
+    return len(data)
+
+
 class CanalPlusApiObject:
 
   """ Base class for Canal+ API objects. """
 
   BASE_URL = "http://service.canal-plus.com/video/rest"
 
-  session = requests.Session()
+  # time to live in seconds of cached API responses, per action
+  CACHE_TTLS = {"initPlayer": 24 * 60 * 60,
+                "getMEAs": 5 * 60,
+                "getVideos": 60 * 60,
+                "search": 5 * 60}
+
+  # HTTP transport shared by all API objects and threads, an instance attribute overrides it for a single object
+  transport = http_transport.Transport(timeouts={http_transport.API: (HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT),
+                                                 http_transport.SEGMENT: (HTTP_CONNECT_TIMEOUT, SEGMENT_READ_TIMEOUT)})
+
+  # http_cache.HttpCache object to cache API responses, or None to disable caching
+  cache = None
 
-  def getHttpSession(self):
-    return __class__.session
+  def getTransport(self):
+    return self.transport
 
-  def fetchXml(self, action, parameter=""):
-    """ Fetch XML data from an URL and return a xml.etree.ElementTree object. """
-    url = "%s/%s/cplus/%s" % (self.BASE_URL, action, parameter)
-    xml_text = self.fetchText(url)
+  @staticmethod
+  def setHttpPoolSize(size, host=None):
+    """ Set the maximum number of connections kept alive per host (or only for a given host) by the HTTP transport. """
+    __class__.transport.setPoolSize(size, host)
+
+  def getApiUrl(self, action, parameter=""):
+    return "%s/%s/cplus/%s" % (self.BASE_URL, action, parameter)
+
+  def fetchXml(self, action, parameter="", *, ttl=None):
+    """
+    Fetch XML data from an URL and return a xml.etree.ElementTree object.
+
+    If ttl is not None, it overrides the cached response time to live of the action.
+    """
+    url = self.getApiUrl(action, parameter)
+    if ttl is None:
+      ttl = __class__.CACHE_TTLS.get(action)
+    xml_text = self.fetchText(url, ttl=ttl)
     return xml.etree.ElementTree.fromstring(xml_text)
 
-  def fetchText(self, url):
-    """ Fetch text from an URL. """
+  def streamXml(self, action, parameter, tag, *, ttl=None):
+    """
+    Fetch XML data from an URL, and yield child elements of the root with a given tag, as soon as they are parsed.
+
+    Yielded elements are cleared after use, they must not be kept. If ttl is not None, it overrides the cached response
+    time to live of the action.
+    """
+    url = self.getApiUrl(action, parameter)
+    if ttl is None:
+      ttl = __class__.CACHE_TTLS.get(action)
+    text, response = self.fetchCachedOrRequest(url, ttl, stream=True)
+    if text is not None:
+      source = io.BytesIO(text.encode("utf-8"))
+    else:
+      response.raw.decode_content = True
+      source = response.raw
+      if (ttl is not None) and (__class__.cache is not None):
+        # keep a copy of the data read to store it in cache
+        source = TeeFile(source, io.BytesIO())
+    try:
+      depth = 0
+      root = None
+      for event, xml_element in xml.etree.ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+          if root is None:
+            root = xml_element
+          depth += 1
+          continue
+        depth -= 1
+        if (depth == 1) and (xml_element.tag == tag):
+          yield xml_element
+          # free parsed elements
+          root.clear()
+      if isinstance(source, TeeFile):
+        __class__.cache.store(url, source.stream.getvalue().decode("utf-8"), response.headers)
+    finally:
+      if response is not None:
+        response.close()
+
+  def fetchText(self, url, *, ttl=None):
+    """
+    Fetch text from an URL.
+
+    If ttl is not None and a cache is set, a cached response younger than ttl seconds is returned without any request,
+    and an older one is revalidated with a conditional request.
+    """
+    text, response = self.fetchCachedOrRequest(url, ttl)
+    if text is None:
+      text = response.content.decode("utf-8")
+      if (ttl is not None) and (__class__.cache is not None):
+        __class__.cache.store(url, text, response.headers)
+    return text
+
+  def fetchCachedOrRequest(self, url, ttl, *, stream=False):
+    """
+    Get a valid cached response text for an URL if any (see fetchText), or send a request for it.
+
+    Return a tuple of (text, None) if the response text was cached, or (None, successful requests response object)
+    otherwise. The caller is responsible for storing the response in cache.
+    """
+    cache = __class__.cache if (ttl is not None) else None
+    headers = {"User-Agent": USER_AGENT}
+    entry = None
+    if cache is not None:
+      entry = cache.get(url)
+      if entry is not None:
+        if cache.isFresh(entry, ttl):
+          logging.getLogger().debug("Got '%s' from cache" % (url))
+          CACHE_HITS.inc()
+          return entry["text"], None
+        headers.update(cache.getValidationHeaders(entry))
     logging.getLogger().debug("Fetching '%s'..." % (url))
-    response = self.getHttpSession().get(url,
-                                         headers={"User-Agent":
-                                                  USER_AGENT},
-                                         timeout=HTTP_TIMEOUT)
-    response.raise_for_status()
-    return response.content.decode("utf-8")
+    HTTP_REQUESTS.inc()
+    try:
+      with API_LATENCY.time():
+        response = self.getTransport().get(url,
+                                           stream=stream,
+                                           headers=headers,
+                                           retry_counter=API_RETRIES)
+    except requests.exceptions.RequestException:
+      HTTP_ERRORS.inc()
+      raise
+    if (entry is not None) and (response.status_code == 304):
+      logging.getLogger().debug("Cached '%s' is still valid" % (url))
+      CACHE_HITS.inc()
+      response.close()
+      cache.refresh(url, entry)
+      return entry["text"], None
+    try:
+      response.raise_for_status()
+    except requests.exceptions.HTTPError:
+      HTTP_ERRORS.inc()
+      response.close()
+      raise
+    return None, response
+
+
+class SegmentProgressWeights:
+
+  """ Compute download progress percentage, with segments weighted by size or duration if known. """
+
+  def __init__(self, segments, sizes=None):
+    durations = tuple(m3u8.as_segment(segment).duration for segment in segments)
+    if (sizes is not None) and (None not in sizes):
+      weights = sizes
+    elif None not in durations:
+      weights = durations
+    else:
+      weights = (1,) * len(segments)
+    self.weights = weights
+    self.offsets = []
+    total = 0
+    for weight in weights:
+      self.offsets.append(total)
+      total += weight
+    self.total = total
+
+  def getProgress(self, index, fraction):
+    """ Return progress percentage when segment at index is downloaded at a given fraction. """
+    if not self.total:
+      return 0
+    return min(100, 100 * (self.offsets[index] + self.weights[index] * fraction) / self.total)
+
+
+class AdaptiveSegmentUrls:
+
+  """
+  Sequence of the segment URLs of a HLS video, switching to the next lower quality variant when the download
+  throughput measured over the last segments can not sustain the current variant bitrate.
+  """
+
+  # number of last segments to measure throughput on
+  SAMPLE_COUNT = 3
+
+  def __init__(self, video, variant_index, urls):
+    self.video = video
+    self.variant_index = variant_index
+    self.urls = urls
+    self.samples = collections.deque(maxlen=__class__.SAMPLE_COUNT)
+    # True while the playlist of a new variant is being fetched
+    self.switching = False
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.urls)
+
+  def __getitem__(self, index):
+    return self.urls[index]
+
+  def addSample(self, start_time, end_time, size):
+    """
+    Add a segment download measurement, and switch variant if needed.
+
+    Segments of both variants end up in the same file, which is remuxed by copying the codec parameters found at its
+    start, so only lower variants with the same codecs and resolution are switched to. When all variants have a
+    different resolution, the initially selected variant is kept.
+    """
+    with self.lock:
+      self.samples.append((start_time, end_time, size))
+      if (len(self.samples) < self.samples.maxlen) or self.switching:
+        return
+      # aggregate throughput, valid for both sequential and concurrent downloads
+      duration = max(s[1] for s in self.samples) - min(s[0] for s in self.samples)
+      throughput = sum(s[2] for s in self.samples) / max(duration, 0.001)
+      bitrate, _, variant_format = self.video.variants[self.variant_index]
+      if throughput * 8 * CanalPlusVideo.AUTO_QUALITY_THROUGHPUT_RATIO >= bitrate:
+        return
+      new_index = next((i for i in range(self.variant_index + 1, len(self.video.variants))
+                        if self.video.variants[i][2] == variant_format),
+                       None)
+      if new_index is None:
+        return
+      self.samples.clear()
+      self.switching = True
+    # fetch playlist without blocking the other segment downloads
+    new_bitrate, new_url, _ = self.video.variants[new_index]
+    try:
+      new_urls = self.video.fetchMediaPlaylist(new_url)
+    finally:
+      with self.lock:
+        self.switching = False
+    if len(new_urls) != len(self.urls):
+      logging.getLogger().debug("Variant segments are not aligned, not switching")
+      return
+    logging.getLogger().warning("Throughput dropped to %s/s, switching from %ukbps to %ukbps variant" %
+                                (format_byte_size_str(throughput), bitrate // 1000, new_bitrate // 1000))
+    with self.lock:
+      self.variant_index = new_index
+      self.urls = new_urls
+      self.video.stream_url = new_url
 
 
 class CanalPlusVideo(CanalPlusApiObject):
 
   """ Canal+ video API object. """
 
+  # number of TS segments downloaded concurrently by default
+  SEGMENT_WORKERS = 4
+
+  # maximum number of segments in flight (downloading or waiting to be written) per worker, this bounds memory usage
+  SEGMENT_WINDOW_PER_WORKER = 2
+
+  # interval at which progress is checkpointed in the journal inside a single large segment (resumable mode)
+  JOURNAL_CHECKPOINT_BYTES = 4 * 1024 * 1024
+
+  # maximum number of times the rest of a segment is requested again after a connection failure
+  MAX_SEGMENT_RETRIES = 5
+
+  # maximum fraction of the measured download throughput a variant bitrate can use, with automatic quality
+  AUTO_QUALITY_THROUGHPUT_RATIO = 0.8
+
+  # variant selection policy: QUALITY_MAX, QUALITY_AUTO, or a maximum bitrate in bits per second
+  quality = QUALITY_MAX
+
   def __init__(self, id, title):
     self.id = id
     self.title = title
     self.stream_url = None
-
-  def download(self, dir):
-    """ Download a video to a given directory. """
-    if self.stream_url is None:
-      self.fetchVideoUrl()
-
-    # sanitize output filename
-    video_filepath_ts = os.path.join(dir,
-                                     "%s.ts" % (self.title.replace("/", "-").strip(string.whitespace + ".")))
-    video_filepath_mp4 = "%s.mp4" % (os.path.splitext(video_filepath_ts)[0])
-
-    if os.path.isfile(video_filepath_ts) or os.path.isfile(video_filepath_mp4):
-      logging.getLogger().info("File already exists, skipping download")
-      return
+    # list of (bitrate, url, format) tuples of HLS variants, sorted by decreasing bitrate, see m3u8.Variant.getFormat
+    self.variants = None
+    self.adaptive_segment_urls = None
+    # measured download throughput in bytes per second, for automatic quality
+    self.throughput = None
+
+  def download(self, dir, *, segment_workers=SEGMENT_WORKERS, resume=False, show_progress=True, stream_remux=False,
+               compute_size=False, archive=None, remux_queue=None, staging_dir=None, stop=None):
+    """
+    Download a video to a given directory, return True if success (or video was already downloaded), False instead.
+
+    The video is staged in staging_dir (by default the output directory) and renamed to its final path when complete,
+    so staging on the same filesystem as the output directory avoids copying it.
+    If compute_size is True, the size of all segments is fetched before downloading, to check available disk space,
+    preallocate it, and display accurate progress.
+    If resume is True, partial download is staged with a journal of completed segments, and is kept on failure so that
+    a later call with the same staging directory can resume it.
+    If stream_remux is True, downloaded data is piped to the converter while downloading, so that no separate remux pass
+    is needed. The TS file is still written to be able to fall back to it if remuxing fails.
+    If archive is a download_archive.DownloadArchive object, videos already in it are skipped whatever their file name,
+    and completed downloads are added to it, hard linked to a previous download with identical content if any.
+    If remux_queue is a RemuxQueue object, remuxing runs on it after download, and this returns as soon as the
+    remux is queued.
+    If stop is a threading.Event object, the download stops before the next segment once it is set, and this returns
+    False.
+    """
+    downloaded_filepath = self.getDownloadedFilepath(dir, archive=archive)
+    if downloaded_filepath is not None:
+      logging.getLogger().info("Video already downloaded to '%s', skipping download" % (downloaded_filepath))
+      return True
+    video_filepath_ts, video_filepath_mp4 = self.getOutputFilepaths(dir)
+    video_filepath_tmp = None
 
     try:
-      with mkstemp_ctx.mkstemp(suffix=".ts") as video_filepath_tmp:
+      if self.stream_url is None:
+        self.fetchVideoUrl()
+
+      with contextlib.ExitStack() as stack:
+        if staging_dir is None:
+          staging_dir = dir
+        if resume:
+          video_filepath_tmp = os.path.join(staging_dir, "%s.part" % (os.path.basename(video_filepath_ts)))
+        else:
+          video_filepath_tmp = stack.enter_context(mkstemp_ctx.mkstemp(prefix=".canalplus-",
+                                                                       suffix=".ts",
+                                                                       dir=staging_dir))
+
         # download
-        if sys.stdout.isatty() and logging.getLogger().isEnabledFor(logging.INFO):
+        if show_progress and sys.stdout.isatty() and logging.getLogger().isEnabledFor(logging.INFO):
           progress = progress_display.ProgressBar(append_eta=True)
         else:
           progress = None
-        if self.stream_url.endswith(".m3u8"):
-          # fetch m3u8 playlist
-          m3u8_data = self.fetchText(self.stream_url)
-          # parse it
-          ts_urls = tuple(filter(lambda x: not x.startswith("#"),
-                                 m3u8_data.splitlines()))
-          # download ts files
-          self.download_ts(ts_urls, video_filepath_tmp, progress)
-
-        else:
-          # direct stream download
+        ts_urls = self.getSegmentUrls()
+        if self.isDirectStream():
           logging.getLogger().info("Downloading video to '%s'..." % (video_filepath_ts))
-          self.download_ts((self.stream_url,), video_filepath_tmp, progress)
+          workers = 1
+        else:
+          workers = segment_workers
+        if compute_size:
+          sizes = self.fetchSegmentSizes(ts_urls, segment_workers)
+          if None not in sizes:
+            __class__.checkDiskSpace(sum(sizes), (dir, os.path.dirname(video_filepath_tmp)))
+        else:
+          sizes = None
+        if resume:
+          journal = download_journal.DownloadJournal(video_filepath_tmp + download_journal.DownloadJournal.SUFFIX,
+                                                     self.getJournalHeader(ts_urls))
+        else:
+          journal = None
+        if stream_remux:
+          video_filepath_mp4_tmp = "%s.part" % (video_filepath_mp4)
+          remux_process = self.startStreamRemux(video_filepath_mp4_tmp)
+        else:
+          remux_process = None
+        if archive is not None:
+          from canalplus import download_archive
+          digest = download_archive.new_content_hash()
+        else:
+          digest = None
+        # download ts files
+        try:
+          self.download_ts(ts_urls,
+                           video_filepath_tmp,
+                           progress,
+                           workers=workers,
+                           journal=journal,
+                           sizes=sizes,
+                           stream=remux_process.stdin if (remux_process is not None) else None,
+                           digest=digest,
+                           stop=stop)
+        except BaseException:
+          if remux_process is not None:
+            self.endStreamRemux(remux_process, video_filepath_mp4_tmp, False)
+          raise
+        if journal is not None:
+          journal.remove()
 
         if progress is not None:
           progress.updateProgress(100)
           progress.display()
           progress.end()
 
-        # try to remux to mp4
-        remuxed = self.remuxToMp4(video_filepath_tmp, video_filepath_mp4)
-        if not remuxed:
-          shutil.move(video_filepath_tmp, video_filepath_ts)
+        remuxed = False
+        if remux_process is not None:
+          remuxed = self.endStreamRemux(remux_process, video_filepath_mp4_tmp, True)
+          if remuxed:
+            os.replace(video_filepath_mp4_tmp, video_filepath_mp4)
+            os.remove(video_filepath_tmp)
+        if (not remuxed) and (remux_queue is not None):
+          # hand over the TS file to the remux queue, it must outlive the temporary file context
+          video_filepath_pending = "%s.remux" % (video_filepath_tmp)
+          os.replace(video_filepath_tmp, video_filepath_pending)
+          remux_queue.submit(self,
+                             self.finishDownload,
+                             video_filepath_pending,
+                             video_filepath_ts,
+                             video_filepath_mp4,
+                             pending=(video_filepath_pending, video_filepath_ts),
+                             digest=digest,
+                             archive=archive)
+        else:
+          self.finishDownload(video_filepath_tmp,
+                              video_filepath_ts,
+                              video_filepath_mp4,
+                              remuxed=remuxed,
+                              digest=digest,
+                              archive=archive)
+
+    except DownloadStopped:
+      logging.getLogger().info("Download stopped")
+      if resume and (video_filepath_tmp is not None):
+        logging.getLogger().info("Partial download kept in '%s', run again to resume it" % (video_filepath_tmp))
+      return False
 
     except Exception as e:
       logging.getLogger().error("Download failed: %s %s", e.__class__.__qualname__, e)
-      exit(1)
+      if resume and (video_filepath_tmp is not None):
+        logging.getLogger().error("Partial download kept in '%s', run again to resume it" % (video_filepath_tmp))
+      return False
+
+    return True
+
+  def finishDownload(self, tmp_filepath, ts_filepath, mp4_filepath, *, remuxed=False, digest=None, archive=None):
+    """
+    Remux a downloaded TS file to MP4 if not already remuxed, or move it to its final path if remuxing fails, and add
+    the download to the archive if any.
+    """
+    if not remuxed:
+      # try to remux to mp4
+      try:
+        remuxed = self.remuxToMp4(tmp_filepath, mp4_filepath)
+      except Exception as e:
+        logging.getLogger().warning("Remuxing failed: %s %s" % (e.__class__.__qualname__, e))
+        try:
+          os.remove(mp4_filepath)
+        except FileNotFoundError:
+          pass
+    if not remuxed:
+      try:
+        shutil.move(tmp_filepath, ts_filepath)
+      except BaseException:
+        # do not leak the temporary file, which may be outside of a temporary file context (remux queue)
+        try:
+          os.remove(tmp_filepath)
+        except FileNotFoundError:
+          pass
+        raise
+
+    if archive is not None:
+      linked_filepath = archive.add(self.id, mp4_filepath if remuxed else ts_filepath, digest.hexdigest())
+      if linked_filepath is not None:
+        logging.getLogger().info("Identical video already downloaded to '%s', hard linked to it" % (linked_filepath))
+
+  def getOutputFilepaths(self, dir):
+    """ Return a tuple of (TS filepath, MP4 filepath) to download the video to in a given directory. """
+    # sanitize output filename
+    video_filepath_ts = os.path.join(dir,
+                                     "%s.ts" % (self.title.replace("/", "-").strip(string.whitespace + ".")))
+    video_filepath_mp4 = "%s.mp4" % (os.path.splitext(video_filepath_ts)[0])
+    return video_filepath_ts, video_filepath_mp4
+
+  def getDownloadedFilepath(self, dir, *, archive=None, filenames=None):
+    """
+    Return the filepath of a completed download of the video to a directory, or None if it was not downloaded.
+
+    If archive is a download_archive.DownloadArchive object, a video in it is downloaded whatever its file name.
+    Otherwise output file names are looked up in filenames, the set of file names in the directory, which is listed
+    if None.
+    """
+    if archive is not None:
+      entry = archive.get(self.id)
+      if entry is not None:
+        return os.path.join(dir, entry["filename"])
+    if filenames is None:
+      try:
+        filenames = frozenset(os.listdir(dir))
+      except FileNotFoundError:
+        return None
+    for filepath in self.getOutputFilepaths(dir):
+      if os.path.basename(filepath) in filenames:
+        return filepath
+    return None
+
+  def isDirectStream(self):
+    """ Return True if the video stream is a single file, False if it is a HLS playlist. """
+    return not self.stream_url.endswith(".m3u8")
+
+  def getSegmentUrls(self):
+    """
+    Return the sequence of segments (m3u8.Segment objects) to download the video stream.
+
+    With automatic quality, the returned AdaptiveSegmentUrls object switches to lower quality segments if download
+    throughput drops.
+    """
+    if self.isDirectStream():
+      return (m3u8.Segment(self.stream_url),)
+    segments = self.fetchMediaPlaylist(self.stream_url)
+    if (self.quality == QUALITY_AUTO) and (self.variants is not None):
+      variant_index = next(i for i, (_, url, _) in enumerate(self.variants) if url == self.stream_url)
+      self.adaptive_segment_urls = AdaptiveSegmentUrls(self, variant_index, segments)
+      return self.adaptive_segment_urls
+    return segments
+
+  def fetchMediaPlaylist(self, url):
+    """ Fetch a HLS media playlist, and return a m3u8.MediaPlaylist object. """
+    return m3u8.parse_media_playlist(self.fetchText(url), url)
+
+  def fetchSegmentSizes(self, segments, workers=SEGMENT_WORKERS):
+    """ Get the size in bytes of segments with concurrent HEAD requests, return a list of sizes, or None if unknown. """
+    def get_size(segment):
+      segment = m3u8.as_segment(segment)
+      if segment.byterange is not None:
+        return segment.byterange[0]
+      HTTP_REQUESTS.inc()
+      try:
+        response = self.getTransport().head(segment.uri,
+                                            kind=http_transport.SEGMENT,
+                                            headers={"User-Agent": USER_AGENT},
+                                            allow_redirects=True,
+                                            retry_counter=SEGMENT_RETRIES)
+        response.raise_for_status()
+        return int(response.headers["Content-Length"])
+      except requests.exceptions.RequestException:
+        HTTP_ERRORS.inc()
+      except (KeyError, ValueError):
+        pass
+      return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      return list(executor.map(get_size, segments))
 
-  def download_ts(self, urls, filepath, progress):
-    """ Download one or several MPEG-TS videos to a file. """
+  def estimateSize(self, workers=SEGMENT_WORKERS):
+    """ Return a tuple of (segment count, duration in seconds or None, size in bytes or None) of the video. """
+    if self.stream_url is None:
+      self.fetchVideoUrl()
+    segments = self.getSegmentUrls()
+    sizes = self.fetchSegmentSizes(segments, workers)
+    durations = tuple(m3u8.as_segment(segment).duration for segment in segments)
+    return (len(segments),
+            sum(durations) if (None not in durations) else None,
+            sum(sizes) if (None not in sizes) else None)
+
+  @staticmethod
+  def checkDiskSpace(size, dirs):
+    """ Raise OSError if a download of a given size does not fit in the free space of one of the directories. """
+    for dir in dirs:
+      free = shutil.disk_usage(dir).free
+      if free < size:
+        raise OSError(errno.ENOSPC,
+                      "Not enough free space in '%s' (%s needed, %s free)" % (dir,
+                                                                              format_byte_size_str(size),
+                                                                              format_byte_size_str(free)))
+
+  def getJournalHeader(self, urls):
+    """
+    Build a journal header identifying a download of the given segments, ignoring volatile URL query parameters.
+    """
+    urls_hash = hashlib.sha1()
+    for segment in map(m3u8.as_segment, urls):
+      urls_hash.update(urllib.parse.urlsplit(segment.uri).path.encode("utf-8"))
+      if segment.byterange is not None:
+        urls_hash.update(("@%u-%u" % segment.byterange).encode("ascii"))
+    return {"id": self.id, "segments": len(urls), "urls_sha1": urls_hash.hexdigest()}
+
+  def download_ts(self, urls, filepath, progress, *, workers=1, journal=None, stream=None, sizes=None, digest=None,
+                  stop=None):
+    """
+    Download one or several MPEG-TS videos (m3u8.Segment objects or URLs) to a file.
+
+    Progress is weighted by segment sizes if the sizes list is passed, or by segment durations if they are known.
+
+    If a download_journal.DownloadJournal object is passed, checkpoints are recorded in it, and download resumes from
+    the last checkpoint if the journal matches the partial file.
+    If stream is a binary file object, all data of the file is also written to it, in order.
+    If digest is a hashlib hash object, it is updated with all data of the file, in order.
+    If stop is a threading.Event object, DownloadStopped is raised before the next segment once it is set, or before
+    the next chunk when segments are downloaded sequentially.
+    """
     logging.getLogger().info("Downloading TS file%s..." % ("s" if len(urls) > 1 else ""))
-    with open(filepath, "wb") as video_file:
-      for i, ts_url in enumerate(urls):
-        previous_size = video_file.tell()
-        with contextlib.closing(self.getHttpSession().get(ts_url,
-                                                          stream=True,
-                                                          headers={"User-Agent":
-                                                                   USER_AGENT},
-                                                          timeout=HTTP_TIMEOUT)) as response:
-          response.raise_for_status()
-          ts_size = int(response.headers["Content-Length"])
+    with contextlib.ExitStack() as stack:
+      sizes_preallocated = False
+      if (journal is not None) and os.path.isfile(filepath):
+        stack.enter_context(journal)
+        start_segment, segment_offset, partial_size = journal.resumePoint(os.path.getsize(filepath))
+        video_file = stack.enter_context(open(filepath, "r+b"))
+        if (workers > 1) and (len(urls) > 1):
+          # parallel download only resumes complete segments
+          partial_size = 0
+        if start_segment or partial_size:
+          logging.getLogger().info("Resuming download from TS file %u/%u (%s already downloaded)" %
+                                   (start_segment + 1,
+                                    len(urls),
+                                    format_byte_size_str(segment_offset + partial_size)))
+        video_file.truncate(segment_offset + partial_size)
+        video_file.seek(segment_offset + partial_size)
+      else:
+        if journal is not None:
+          stack.enter_context(journal).reset()
+        start_segment, partial_size = 0, 0
+        video_file = stack.enter_context(open(filepath, "wb"))
+        if (sizes is not None) and (None not in sizes):
+          preallocate_file(video_file, sum(sizes))
+          sizes_preallocated = True
+
+      if stream is not None:
+        video_file = TeeFile(video_file, stream)
+      if digest is not None:
+        video_file = TeeFile(video_file, HashStream(digest))
+      if isinstance(video_file, TeeFile):
+        # feed complete segments downloaded by a previous run, partial segment is fed once its download is resumed
+        video_file.replay(0, video_file.tell() - partial_size)
+
+      progress_weights = SegmentProgressWeights(urls, sizes)
+      retries = metrics.Counter("retries", "Segment retries of this download")
+      if (workers > 1) and (len(urls) > 1):
+        self.downloadSegmentsParallel(urls,
+                                      video_file,
+                                      progress,
+                                      workers,
+                                      start=start_segment,
+                                      journal=journal,
+                                      progress_weights=progress_weights,
+                                      retries=retries,
+                                      stop=stop)
+      else:
+        self.downloadSegmentsSequential(urls,
+                                        video_file,
+                                        progress,
+                                        start=start_segment,
+                                        partial_size=partial_size,
+                                        journal=journal,
+                                        progress_weights=progress_weights,
+                                        retries=retries,
+                                        preallocate=not sizes_preallocated,
+                                        stop=stop)
+      # drop preallocated space beyond actual data
+      video_file.truncate(video_file.tell())
+
+  def downloadSegmentsSequential(self, urls, video_file, progress, *, start=0, partial_size=0, journal=None,
+                                 progress_weights=None, retries=None, preallocate=False, stop=None):
+    """
+    Download TS segments one after the other and write them to a file object, resuming the first one after
+    partial_size bytes already written.
+
+    If preallocate is True and there is a single segment (direct stream), disk space is reserved for it from the size
+    of its response.
+    """
+    if progress_weights is None:
+      progress_weights = SegmentProgressWeights(urls)
+    if retries is None:
+      retries = metrics.Counter("retries", "Segment retries of this download")
+    for i in range(start, len(urls)):
+      __class__.checkStop(stop)
+      segment_offset = video_file.tell() - partial_size
+      start_time = time.monotonic()
+      with contextlib.closing(self.openSegment(urls[i], partial_size)) as response:
+        response_time = time.monotonic()
+        if partial_size and (response.status_code != 206):
+          # server ignored range, restart segment from the beginning
+          logging.getLogger().debug("Server does not support range requests")
+          video_file.seek(segment_offset)
+          video_file.truncate()
+          partial_size = 0
+        elif partial_size and isinstance(video_file, TeeFile):
+          video_file.replay(segment_offset, segment_offset + partial_size)
+        ts_size = partial_size + int(response.headers["Content-Length"])
+        if preallocate and (len(urls) == 1):
+          preallocate_file(video_file, segment_offset + ts_size)
+        checkpoint_size = partial_size
+        for chunk in self.iterSegmentData(urls[i], response, partial_size, retries):
+          # large segments (direct stream) can take minutes to download
+          __class__.checkStop(stop)
+          if progress is not None:
+            total_dl_bytes = video_file.tell()
+            ts_dl_bytes = total_dl_bytes - segment_offset
+            progress.updateProgress(progress_weights.getProgress(i, ts_dl_bytes / ts_size))
+            progress.setAdditionnalInfo("TS file %s/%u: %s / %s, total %s%s" %
+                                        (str(i + 1).rjust(len(str(len(urls)))),
+                                         len(urls),
+                                         format_byte_size_str(ts_dl_bytes).rjust(6),
+                                         format_byte_size_str(ts_size).rjust(6),
+                                         format_byte_size_str(total_dl_bytes).rjust(7),
+                                         format_retries_str(retries.value)))
+            progress.display()
+          video_file.write(chunk)
+          if journal is not None:
+            ts_dl_bytes = video_file.tell() - segment_offset
+            if ts_dl_bytes - checkpoint_size >= __class__.JOURNAL_CHECKPOINT_BYTES:
+              # checkpoint inside large segment (direct stream)
+              video_file.flush()
+              journal.record(i, segment_offset, ts_dl_bytes, complete=False)
+              checkpoint_size = ts_dl_bytes
+      self.recordSegmentMetrics(start_time, response_time, video_file.tell() - segment_offset - partial_size)
+      partial_size = 0
+      if journal is not None:
+        video_file.flush()
+        journal.record(i, segment_offset, video_file.tell() - segment_offset)
+
+  def downloadSegmentsParallel(self, urls, video_file, progress, workers, *, start=0, journal=None,
+                               progress_weights=None, retries=None, stop=None):
+    """
+    Download TS segments concurrently and write them to a file object in playlist order.
+
+    At most workers * SEGMENT_WINDOW_PER_WORKER segments are held in memory at any time, whatever the playlist length.
+    If retries is not None, it is a metrics.Counter object incremented at each segment retry.
+    """
+    if retries is None:
+      retries = metrics.Counter("retries", "Segment retries of this download")
+    window = workers * __class__.SEGMENT_WINDOW_PER_WORKER
+    next_segment = start
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      try:
+        while (next_segment < len(urls)) and (len(pending) < window):
+          pending.append(executor.submit(self.fetchSegment, urls[next_segment], retries))
+          next_segment += 1
+        i = start
+        while pending:
+          __class__.checkStop(stop)
+          # wait for the oldest segment, and refill the window as soon as its slot is free
+          ts_data = pending.popleft().result()
+          if next_segment < len(urls):
+            pending.append(executor.submit(self.fetchSegment, urls[next_segment], retries))
+            next_segment += 1
+          segment_offset = video_file.tell()
+          video_file.write(ts_data)
+          if journal is not None:
+            video_file.flush()
+            journal.record(i, segment_offset, len(ts_data))
+          i += 1
+          if progress is not None:
+            if progress_weights is not None:
+              progress.updateProgress(progress_weights.getProgress(i - 1, 1))
+            else:
+              progress.updateProgress(i * 100 / len(urls))
+            progress.setAdditionnalInfo("TS file %s/%u: %s, total %s%s" %
+                                        (str(i).rjust(len(str(len(urls)))),
+                                         len(urls),
+                                         format_byte_size_str(len(ts_data)).rjust(6),
+                                         format_byte_size_str(video_file.tell()).rjust(7),
+                                         format_retries_str(retries.value)))
+            progress.display()
+      except BaseException:
+        for future in pending:
+          future.cancel()
+        raise
+
+  @staticmethod
+  def checkStop(stop):
+    """ Raise DownloadStopped if a stop event (threading.Event object or None) is set. """
+    if (stop is not None) and stop.is_set():
+      raise DownloadStopped()
+
+  def fetchSegment(self, segment, retries=None):
+    """ Download a single TS segment and return its content, see iterSegmentData for retries. """
+    start_time = time.monotonic()
+    with contextlib.closing(self.openSegment(segment)) as response:
+      response_time = time.monotonic()
+      data = b"".join(self.iterSegmentData(segment, response, 0, retries))
+    self.recordSegmentMetrics(start_time, response_time, len(data))
+    return data
+
+  def iterSegmentData(self, segment, response, offset, retries=None):
+    """
+    Yield data chunks of a TS segment response starting at offset bytes in the segment.
+
+    If the connection fails before all bytes announced by Content-Length are received, the remaining bytes are requested
+    again with a range request, at most MAX_SEGMENT_RETRIES times. If retries is not None, it is a metrics.Counter
+    object incremented at each retry.
+    """
+    end = offset + int(response.headers["Content-Length"])
+    segment_retries = 0
+    # bytes to drop at the start of the response, if the server ignored the range request
+    discard = 0
+    try:
+      while True:
+        try:
           for chunk in response.iter_content(2 ** 12):
-            if progress is not None:
-              total_dl_bytes = video_file.tell()
-              ts_dl_bytes = total_dl_bytes - previous_size
-              progress.updateProgress((i * 100 / len(urls)) +
-                                      ts_dl_bytes * (100 / len(urls)) / ts_size)
-              progress.setAdditionnalInfo("TS file %s/%u: %s / %s, total %s" %
-                                          (str(i + 1).rjust(len(str(len(urls)))),
-                                           len(urls),
-                                           format_byte_size_str(ts_dl_bytes).rjust(6),
-                                           format_byte_size_str(ts_size).rjust(6),
-                                           format_byte_size_str(total_dl_bytes).rjust(7)))
-              progress.display()
-            video_file.write(chunk)
+            if discard:
+              dropped = min(discard, len(chunk))
+              chunk = chunk[dropped:]
+              discard -= dropped
+            if chunk:
+              offset += len(chunk)
+              yield chunk
+          if offset < end:
+            raise requests.exceptions.ChunkedEncodingError("Got %u bytes instead of %u" % (offset, end))
+          return
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+          HTTP_ERRORS.inc()
+          response.close()
+          if segment_retries >= __class__.MAX_SEGMENT_RETRIES:
+            raise
+          segment_retries += 1
+          SEGMENT_RETRIES.inc()
+          if retries is not None:
+            retries.inc()
+          logging.getLogger().debug("Segment download failed at byte %u/%u (%s %s), retrying (%u/%u)" %
+                                    (offset, end, e.__class__.__qualname__, e, segment_retries,
+                                     __class__.MAX_SEGMENT_RETRIES))
+          response = self.openSegment(segment, offset)
+          remaining = int(response.headers["Content-Length"])
+          if response.status_code == 206:
+            discard = 0
+          else:
+            # server ignored range, drop what we already have
+            discard = offset
+            remaining -= offset
+          if offset + remaining != end:
+            raise requests.exceptions.HTTPError("Segment size changed during download", response=response)
+    finally:
+      response.close()
+
+  def openSegment(self, segment, skip=0):
+    """
+    Send a request for a TS segment (m3u8.Segment object or URL) without its first skip bytes, and return the streamed
+    successful response.
+    """
+    segment = m3u8.as_segment(segment)
+    headers = {"User-Agent": USER_AGENT}
+    range_header = segment.getRangeHeader(skip)
+    if range_header is not None:
+      headers["Range"] = range_header
+    HTTP_REQUESTS.inc()
+    try:
+      response = self.getTransport().get(segment.uri,
+                                         kind=http_transport.SEGMENT,
+                                         stream=True,
+                                         headers=headers,
+                                         retry_counter=SEGMENT_RETRIES)
+      try:
+        response.raise_for_status()
+        if (segment.byterange is not None) and (response.status_code != 206):
+          raise requests.exceptions.HTTPError("Server does not support byte range requests", response=response)
+      except requests.exceptions.HTTPError:
+        response.close()
+        raise
+    except requests.exceptions.RequestException:
+      HTTP_ERRORS.inc()
+      raise
+    return response
+
+  def recordSegmentMetrics(self, start_time, response_time, size):
+    """ Update segment metrics, from request start time, response headers time, and size of the downloaded data. """
+    end_time = time.monotonic()
+    if self.adaptive_segment_urls is not None:
+      self.adaptive_segment_urls.addSample(start_time, end_time, size)
+    SEGMENT_TTFB.observe(response_time - start_time)
+    SEGMENT_THROUGHPUT.observe(size / max(end_time - response_time, 0.001))
+    SEGMENTS_DOWNLOADED.inc()
+    BYTES_DOWNLOADED.inc(size)
 
   def remuxToMp4(self, ts_filepath, mp4_filepath):
     """ Remux TS file to MP4, return True if success, false instead. """
-    ffmpeg_path = shutil.which("ffmpeg")
-    avconv_path = shutil.which("avconv")
+    from canalplus import remux
+    converter = remux.get_converter()
     remuxed = False
-    if ffmpeg_path is not None or avconv_path is not None:
+    if converter is not None:
       # remux to mp4 (better seeking than mpegts)
-      converter = os.path.basename(next(filter(None, (ffmpeg_path, avconv_path))))
-      logging.getLogger().info("Remuxing to '%s' with %s..." % (mp4_filepath, converter))
-      for attempt in range(2):
-        cmd = [converter]
-        if not logging.getLogger().isEnabledFor(logging.DEBUG):
-          cmd.extend(("-loglevel", "quiet"))
-        cmd.extend(("-i", ts_filepath, "-c", "copy"))
-        if attempt == 1:
-          cmd.extend(("-bsf:a", "aac_adtstoasc"))
-        cmd.append(mp4_filepath)
+      logging.getLogger().info("Remuxing to '%s' with %s..." % (mp4_filepath, converter.name))
+      remux_start_time = time.monotonic()
+      stream_types = remux.probe_ts_stream_types(ts_filepath)
+      if stream_types is None:
+        logging.getLogger().debug("Unable to find stream types of '%s'" % (ts_filepath))
+      for cmd in converter.getRemuxCmds(ts_filepath, mp4_filepath, stream_types):
         try:
           subprocess.check_call(cmd)
         except subprocess.CalledProcessError:
@@ -183,34 +1057,94 @@ class CanalPlusVideo(CanalPlusApiObject):
         remuxed = True
         os.remove(ts_filepath)
         break
+      REMUX_DURATION.observe(time.monotonic() - remux_start_time)
       if not remuxed:
         logging.getLogger().warning("Remuxing failed")
     return remuxed
 
-  def view(self, player):
-    """ View a video in a given media player. """
+  def startStreamRemux(self, mp4_filepath):
+    """
+    Start a converter process remuxing TS data written to its stdin to a MP4 file, and return it.
+
+    Return None if no converter is available.
+    """
+    from canalplus import remux
+    converter = remux.get_converter()
+    if converter is None:
+      return None
+    logging.getLogger().info("Remuxing to '%s' with %s while downloading..." % (mp4_filepath, converter.name))
+    return subprocess.Popen(converter.getStreamRemuxCmd(mp4_filepath), stdin=subprocess.PIPE)
+
+  def endStreamRemux(self, process, mp4_filepath, success):
+    """
+    Wait for a converter process started by startStreamRemux to finish, return True if it succeeded, False instead.
+
+    If success is False, the download was aborted and the process is killed. The MP4 file is removed on failure.
+    """
+    try:
+      process.stdin.close()
+    except BrokenPipeError:
+      pass
+    if not success:
+      process.kill()
+    remuxed = (process.wait() == 0) and success
+    if not remuxed:
+      if success:
+        logging.getLogger().warning("Remuxing while downloading failed")
+      try:
+        os.remove(mp4_filepath)
+      except FileNotFoundError:
+        pass
+    return remuxed
+
+  def view(self, player, *, proxy=False, prefetch=PROXY_PREFETCH, cache_size=PROXY_CACHE_SIZE):
+    """
+    View a video in a given media player.
+
+    If proxy is True and the video is a HLS stream, the player gets it from a local hls_proxy.HlsProxy, prefetching
+    prefetch segments ahead, with a segment cache of at most cache_size bytes.
+    """
     logger = logging.getLogger()
     if self.stream_url is None:
       self.fetchVideoUrl()
-    logger.info("Viewing in player '%s'..." % (player))
-    player_cmd = (player, self.stream_url)
-    if logger.isEnabledFor(logging.DEBUG):
-      subprocess.check_call(player_cmd)
-    else:
-      subprocess.check_call(player_cmd,
-                            stdin=subprocess.DEVNULL,
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL)
-
-  def fetchVideoUrl(self):
-    """ Fetch video URL for the best quality available. """
+    with contextlib.ExitStack() as stack:
+      if proxy and (not self.isDirectStream()):
+        from canalplus import hls_proxy
+        segment_cache = hls_proxy.SegmentCache(max_size=cache_size)
+        url = stack.enter_context(hls_proxy.HlsProxy(self, prefetch=prefetch, cache=segment_cache)).url
+      else:
+        url = self.stream_url
+      logger.info("Viewing in player '%s'..." % (player))
+      player_cmd = (player, url)
+      if logger.isEnabledFor(logging.DEBUG):
+        subprocess.check_call(player_cmd)
+      else:
+        subprocess.check_call(player_cmd,
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+  def fetchVideoUrl(self, *, throughput=None):
+    """
+    Fetch video URL, for the quality selected by the quality policy.
+
+    With automatic quality, throughput is the download throughput in bytes per second to use instead of measuring it.
+    """
+    if throughput is not None:
+      self.throughput = throughput
     # get video infos
     logging.getLogger().info("Getting video metadata...")
     xml_vidinfo = self.fetchXml("getVideos", self.id)
+    if self.title is None:
+      # video created from its id only
+      xml_vid = xml_vidinfo.find("VIDEO")
+      title = CanalPlusVideoList.parseVideoRecord(xml_vid).getFullTitle() if (xml_vid is not None) else None
+      self.title = title if title else str(self.id)
     playlist_url = xml_vidinfo.findtext("VIDEO/MEDIA/VIDEOS/HLS")
     if playlist_url:
       playlist = self.fetchText(playlist_url)
-      self.stream_url = self.getPlaylistBestQuality(playlist)
+      self.variants = self.getPlaylistVariants(playlist, playlist_url)
+      self.stream_url = self.variants[self.selectVariant()][1]
     else:
       self.stream_url = xml_vidinfo.findtext("VIDEO/MEDIA/VIDEOS/HD")
       if not self.stream_url:
@@ -221,17 +1155,48 @@ class CanalPlusVideo(CanalPlusApiObject):
 
   def getPlaylistBestQuality(self, playlist):
     """ Parse an M3U8 playlist content, and return best quality stream. """
-    highest_bitrate = 0
-    best_quality_url = None
-    streams = __class__.parseM3U(playlist)
-    for url, attribs in streams:
-      current_bitrate = int(attribs.partition("BANDWIDTH=")[2].split(",", 1)[0])
-      logging.getLogger().debug("Got bitrate of %u" % (current_bitrate))
-      if current_bitrate > highest_bitrate:
-        highest_bitrate = current_bitrate
-        best_quality_url = url
-    assert(best_quality_url is not None)
-    return best_quality_url
+    return self.getPlaylistVariants(playlist)[0][1]
+
+  def getPlaylistVariants(self, playlist, base_url=""):
+    """
+    Parse an M3U8 master playlist content, and return a list of (bitrate, url, format) tuples, sorted by decreasing
+    bitrate, see m3u8.Variant.getFormat.
+
+    Relative URLs are resolved against base_url.
+    """
+    variants = []
+    for variant in m3u8.parse_master_playlist(playlist, base_url):
+      logging.getLogger().debug("Got bitrate of %u" % (variant.bandwidth))
+      variants.append((variant.bandwidth, variant.uri, variant.getFormat()))
+    assert(variants)
+    variants.sort(key=lambda x: x[0], reverse=True)
+    return variants
+
+  def selectVariant(self):
+    """ Return the index in variants of the variant to use, according to the quality policy. """
+    if self.quality == QUALITY_MAX:
+      return 0
+    if self.quality == QUALITY_AUTO:
+      if self.throughput is None:
+        self.throughput = self.probeThroughput()
+      max_bitrate = self.throughput * 8 * __class__.AUTO_QUALITY_THROUGHPUT_RATIO
+    else:
+      max_bitrate = self.quality
+    for i, (bitrate, _, _) in enumerate(self.variants):
+      if bitrate <= max_bitrate:
+        break
+    logging.getLogger().debug("Selected variant with bitrate %u" % (self.variants[i][0]))
+    return i
+
+  def probeThroughput(self):
+    """ Measure download throughput in bytes per second, by downloading the first segment of a medium variant. """
+    url = self.variants[len(self.variants) // 2][1]
+    probe_segment = self.fetchMediaPlaylist(url)[0]
+    start_time = time.monotonic()
+    size = len(self.fetchSegment(probe_segment))
+    throughput = size / max(time.monotonic() - start_time, 0.001)
+    logging.getLogger().debug("Measured throughput of %s/s" % (format_byte_size_str(throughput)))
+    return throughput
 
   @staticmethod
   def parseM3U(data):
@@ -254,126 +1219,255 @@ class CanalPlusVideo(CanalPlusApiObject):
         attribs = None
 
 
-class CanalPlusProgram(CanalPlusApiObject):
+class VideoRecord:
 
-  """ Canal+ program (iterable of CanalPlusVideo) API object. """
+  """ Compact video list entry. """
 
-  def __init__(self, id, title):
+  __slots__ = ("id", "title", "subtitle")
+
+  def __init__(self, id, title, subtitle):
     self.id = id
     self.title = title
-    self.xml_vidlist = None
+    self.subtitle = subtitle
+
+  def getFullTitle(self):
+    """ Return title with subtitle appended if any. """
+    if self.subtitle:
+      return "%s (%s)" % (self.title, self.subtitle)
+    return self.title
+
+
+class CanalPlusVideoList(CanalPlusApiObject):
+
+  """
+  Base class for API objects which are a list of videos (iterable of CanalPlusVideo).
+
+  The XML video list is parsed once into a list of VideoRecord objects, and not kept in memory.
+  """
+
+  # tag of video elements in the XML video list
+  VIDEO_TAG = None
+
+  # message logged when fetching video list
+  FETCH_MESSAGE = "Getting video list..."
+
+  def __init__(self):
+    self.videos = None
 
   def __iter__(self):
-    """ Get an iterator over program videos. """
-    if self.xml_vidlist is None:
-      self.fetchVidlist()
+    """
+    Get an iterator over videos.
+
+    If the video list was not fetched yet, videos are yielded as soon as they are received.
+    """
     return self.__next__()
 
   def __next__(self):
     """ Get a video. """
-    for xml_vid in self.xml_vidlist.iterfind("MEA"):
-      id = int(xml_vid.findtext("ID"))
-      title = xml_vid.findtext("INFOS/TITRAGE/TITRE")
-      subtitle = xml_vid.findtext("INFOS/TITRAGE/SOUS_TITRE")
-      if subtitle:
-        title = "%s (%s)" % (title, subtitle)
-      yield CanalPlusVideo(id, title)
+    for video in self.videos if (self.videos is not None) else self.streamVidlist():
+      yield CanalPlusVideo(video.id, video.getFullTitle())
 
   def __getitem__(self, index):
-    """ Get a video from the program at a given index. """
-    if self.xml_vidlist is None:
+    """ Get a video at a given index. """
+    if self.videos is None:
       self.fetchVidlist()
-    xml_vid = self.xml_vidlist.findall("MEA")[index]
-    id = int(xml_vid.findtext("ID"))
-    title = xml_vid.findtext("INFOS/TITRAGE/TITRE")
-    subtitle = xml_vid.findtext("INFOS/TITRAGE/SOUS_TITRE")
-    if subtitle:
-      title = "%s (%s)" % (title, subtitle)
-    return CanalPlusVideo(id, title)
+    video = self.videos[index]
+    return CanalPlusVideo(video.id, video.getFullTitle())
 
   def __bool__(self):
-    """ Return True if there is at least one video in the program, False otherwise. """
-    if self.xml_vidlist is None:
-      self.fetchVidlist()
-    return self.xml_vidlist.find("MEA") is not None
+    """ Return True if there is at least one video, False otherwise. """
+    return len(self) > 0
 
   def __len__(self):
-    """ Return the number of videos in the program. """
-    if self.xml_vidlist is None:
+    """ Return the number of videos. """
+    if self.videos is None:
       self.fetchVidlist()
-    return len(self.xml_vidlist.findall("MEA"))
+    return len(self.videos)
+
+  def getVidlistRequest(self):
+    """ Return a tuple of (action, parameter) to fetch the video list. """
+    raise NotImplementedError()
+
+  def getKey(self):
+    """ Return a string identifying the video list, ie. 'getMEAs/104'. """
+    return "%s/%s" % self.getVidlistRequest()
 
   def fetchVidlist(self):
-    """ Fetch program video list. """
+    """ Fetch video list. """
+    for _ in self.streamVidlist():
+      pass
+
+  def poll(self):
+    """
+    Fetch video list again, and return an iterator over its videos.
+
+    A cached video list is always revalidated with a conditional request.
+    """
+    for _ in self.streamVidlist(ttl=0):
+      pass
+    return iter(self)
+
+  def streamVidlist(self, *, ttl=None):
+    """
+    Fetch video list, yield VideoRecord objects as soon as they are parsed, and set videos when done.
+
+    See CanalPlusApiObject.streamXml for ttl.
+    """
     # get videos list
-    logging.getLogger().info("Getting video list...")
-    self.xml_vidlist = self.fetchXml("getMEAs", self.id)
+    logging.getLogger().info(self.FETCH_MESSAGE)
+    action, parameter = self.getVidlistRequest()
+    videos = []
+    for xml_vid in self.streamXml(action, parameter, self.VIDEO_TAG, ttl=ttl):
+      video = __class__.parseVideoRecord(xml_vid)
+      videos.append(video)
+      yield video
+    self.videos = videos
+
+  def parseVidlist(self, xml_vidlist):
+    """ Parse a XML video list, and set videos. """
+    self.videos = list(map(__class__.parseVideoRecord, xml_vidlist.iterfind(self.VIDEO_TAG)))
+
+  @staticmethod
+  def parseVideoRecord(xml_vid):
+    """ Parse a XML video list element, and return a VideoRecord object. """
+    return VideoRecord(int(xml_vid.findtext("ID")),
+                       xml_vid.findtext("INFOS/TITRAGE/TITRE"),
+                       xml_vid.findtext("INFOS/TITRAGE/SOUS_TITRE"))
 
 
-class CanalPlusSearch(CanalPlusApiObject):
+class CanalPlusProgram(CanalPlusVideoList):
+
+  """ Canal+ program (iterable of CanalPlusVideo) API object. """
+
+  VIDEO_TAG = "MEA"
+
+  def __init__(self, id, title):
+    super().__init__()
+    self.id = id
+    self.title = title
+
+  def getVidlistRequest(self):
+    """ See CanalPlusVideoList.getVidlistRequest. """
+    return "getMEAs", self.id
+
+
+class IndexedCanalPlusProgram(CanalPlusProgram):
+
+  """
+  Canal+ program found by name in CanalPlusProgramList.index, whose id may no longer be valid.
+
+  If the first fetch of its video list fails, the index entry is dropped, and the program is looked up again in a
+  revalidated program list.
+  """
+
+  def __init__(self, id, title, name):
+    super().__init__(id, title)
+    self.name = name
+    self.checked = False
+
+  def streamVidlist(self, *, ttl=None):
+    """ See CanalPlusVideoList.streamVidlist. """
+    videos = super().streamVidlist(ttl=ttl)
+    if not self.checked:
+      try:
+        first_video = next(videos, None)
+      except (requests.exceptions.HTTPError, xml.etree.ElementTree.ParseError) as e:
+        logging.getLogger().debug("Unable to get videos of program %u from index (%s %s), refreshing program list" %
+                                  (self.id, e.__class__.__qualname__, e))
+        if CanalPlusProgramList.index is not None:
+          try:
+            CanalPlusProgramList.index.discard(self.id)
+          except OSError as e:
+            logging.getLogger().warning("Unable to update program index: %s" % (e))
+        # the cached program list is stale too
+        program = CanalPlusProgramList(revalidate=True)[self.name]
+        if program is None:
+          raise
+        self.id, self.title = program.id, program.title
+        videos = super().streamVidlist(ttl=ttl)
+      else:
+        if first_video is not None:
+          yield first_video
+      self.checked = True
+    yield from videos
+
+
+class CanalPlusSearch(CanalPlusVideoList):
 
   """ Canal+ search result (iterable of CanalPlusVideo) API object. """
 
+  VIDEO_TAG = "VIDEO"
+  FETCH_MESSAGE = "Getting search results..."
+
   def __init__(self, query):
+    super().__init__()
     self.query = query
-    self.fetchVidlist()
 
-  def __iter__(self):
-    """ Get an iterator over search results. """
-    return self.__next__()
+  def getVidlistRequest(self):
+    """ See CanalPlusVideoList.getVidlistRequest. """
+    return "search", urllib.parse.quote_plus(self.query)
 
-  def __next__(self):
-    """ Get a search result video. """
-    for xml_vid in self.xml_vidlist.iterfind("VIDEO"):
-      id = int(xml_vid.findtext("ID"))
-      title = xml_vid.findtext("INFOS/TITRAGE/TITRE")
-      subtitle = xml_vid.findtext("INFOS/TITRAGE/SOUS_TITRE")
-      if subtitle:
-        title = "%s (%s)" % (title, subtitle)
-      yield CanalPlusVideo(id, title)
 
-  def __getitem__(self, index):
-    """ Get a video search result from a given index. """
-    xml_vid = self.xml_vidlist.findall("VIDEO")[index]
-    id = int(xml_vid.findtext("ID"))
-    title = xml_vid.findtext("INFOS/TITRAGE/TITRE")
-    subtitle = xml_vid.findtext("INFOS/TITRAGE/SOUS_TITRE")
-    if subtitle:
-      title = "%s (%s)" % (title, subtitle)
-    return CanalPlusVideo(id, title)
+class CanalPlusCatalogSearch(CanalPlusVideoList):
 
-  def __bool__(self):
-    """ Return True if there is at least one search result, False otherwise. """
-    return self.xml_vidlist.find("VIDEO") is not None
+  """ Search result from the local catalog (iterable of CanalPlusVideo), without any request. """
 
-  def __len__(self):
-    """ Return the number of search results. """
-    return len(self.xml_vidlist.findall("VIDEO"))
+  def __init__(self, query, catalog):
+    super().__init__()
+    self.query = query
+    self.catalog = catalog
 
-  def fetchVidlist(self):
-    """ Fetch search results list. """
-    # get videos list
-    logging.getLogger().info("Getting search results...")
-    self.xml_vidlist = self.fetchXml("search", urllib.parse.quote_plus(self.query))
+  def getKey(self):
+    """ See CanalPlusVideoList.getKey. """
+    return "catalog/%s" % (self.query)
+
+  def streamVidlist(self, *, ttl=None):
+    """ See CanalPlusVideoList.streamVidlist. """
+    # one record per program of a video, keep the first one
+    seen_ids = set()
+    self.videos = []
+    for record in self.catalog.search(self.query):
+      if record.id not in seen_ids:
+        seen_ids.add(record.id)
+        self.videos.append(record)
+    return iter(self.videos)
 
 
 class CanalPlusProgramList(CanalPlusApiObject):
 
   """ Canal+ program list (iterable of CanalPlusProgram) API object. """
 
-  def __init__(self):
+  # program_index.ProgramIndex object refreshed at each fetch of the program list, or None
+  index = None
+
+  def __init__(self, *, revalidate=False):
+    """ If revalidate is True, a cached program list is revalidated with a conditional request. """
     # get program list
     logging.getLogger().info("Getting program list...")
 
-    xml_programs = self.fetchXml("initPlayer")
-    # parse it
+    xml_programs = self.fetchXml("initPlayer", ttl=0 if revalidate else None)
+    self.parseProgramList(xml_programs)
+    if __class__.index is not None:
+      try:
+        __class__.index.update(self.programs.items())
+      except OSError as e:
+        logging.getLogger().warning("Unable to update program index: %s" % (e))
+
+  def parseProgramList(self, xml_programs):
+    """ Parse XML program list, and build program index. """
     self.programs = {}
     for xml_program_group in xml_programs.iterfind("THEMATIQUES/THEMATIQUE"):
       for xml_program in xml_program_group.iterfind("SELECTIONS/SELECTION"):
         id = int(xml_program.findtext("ID"))
-        if id not in self.programs.keys():
+        if id not in self.programs:
           title = xml_program.findtext("NOM")
           self.programs[id] = title
+    # positional arrays, and case insensitive title -> position index
+    self.program_ids = list(self.programs.keys())
+    self.program_titles = list(self.programs.values())
+    self.title_index = {}
+    for i, title in enumerate(self.program_titles):
+      self.title_index.setdefault(title.casefold(), i)
 
   def __iter__(self):
     """ Get an iterator over programs. """
@@ -381,28 +1475,358 @@ class CanalPlusProgramList(CanalPlusApiObject):
 
   def __next__(self):
     """ Get a program. """
-    for (id, title) in self.programs.items():
+    for (id, title) in zip(self.program_ids, self.program_titles):
       yield CanalPlusProgram(id, title)
 
   def __len__(self):
     """ Get the number of programs. """
-    return len(self.programs)
+    return len(self.program_ids)
 
   def __contains__(self, title):
     """ Return True if a program with the given title is available, False otherwise. """
-    for p in self:
-      if p.title.lower() == title.lower():
-        return True
-    return False
+    return title.casefold() in self.title_index
 
   def __getitem__(self, key):
     """ Get a program from name or index. """
     if isinstance(key, str):
-      for p in self:
-        if p.title.lower() == key.lower():
-          return p
+      try:
+        key = self.title_index[key.casefold()]
+      except KeyError:
+        return None
+    return CanalPlusProgram(self.program_ids[key], self.program_titles[key])
+
+  def resolve(self, titles):
+    """ Get programs from several names, return a list of CanalPlusProgram objects, or None for unknown names. """
+    return [self[title] for title in titles]
+
+
+def find_programs(names):
+  """
+  Get programs from several names or numeric ids, return a list of CanalPlusProgram objects, or None for unknown
+  names.
+
+  Names are first looked up in CanalPlusProgramList.index if set, the program list is only fetched (once) if some are
+  not in it. Programs from the index are not checked here, see IndexedCanalPlusProgram.
+  """
+  index = CanalPlusProgramList.index
+  programs = [None] * len(names)
+  missing = []
+  for i, name in enumerate(names):
+    if name.isdigit():
+      id = int(name)
+      title = index.getTitle(id) if (index is not None) else None
+      programs[i] = CanalPlusProgram(id, title if (title is not None) else name)
+      continue
+    entry = index.get(name) if (index is not None) else None
+    if entry is not None:
+      programs[i] = IndexedCanalPlusProgram(*entry, name)
+    else:
+      missing.append(i)
+  if missing:
+    program_list = CanalPlusProgramList()
+    for i, program in zip(missing, program_list.resolve(names[i] for i in missing)):
+      programs[i] = program
+  return programs
+
+
+def update_catalog(catalog, programs, *, workers=CATALOG_UPDATE_WORKERS):
+  """
+  Index all programs of a CanalPlusProgramList in a catalog.Catalog object, fetching video lists concurrently.
+
+  Programs no longer in the list are removed from the catalog. Return a tuple of (added, removed) video counts.
+  """
+  logger = logging.getLogger()
+  programs = tuple(programs)
+  for program_id in catalog.getProgramIds() - set(program.id for program in programs):
+    catalog.removeProgram(program_id)
+
+  def fetch_vidlist(program):
+    program.poll()
+    return program.videos
+
+  added_count, removed_count = 0, 0
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = [executor.submit(fetch_vidlist, program) for program in programs]
+    for i, (program, future) in enumerate(zip(programs, futures), 1):
+      try:
+        videos = future.result()
+      except requests.exceptions.RequestException as e:
+        logger.warning("Unable to get videos of program '%s': %s %s" % (program.title, e.__class__.__qualname__, e))
+        continue
+      added, removed = catalog.updateProgram(program.id, program.title, videos)
+      logger.debug("Program %u/%u '%s': %u video(s) added, %u removed" % (i,
+                                                                           len(programs),
+                                                                           program.title,
+                                                                           added,
+                                                                           removed))
+      added_count += added
+      removed_count += removed
+  return added_count, removed_count
+
+
+def resolve_video_urls(videos, *, workers=RESOLVE_WORKERS):
+  """
+  Fetch stream URLs of CanalPlusVideo objects concurrently (see CanalPlusVideo.fetchVideoUrl), and return a list of the
+  videos.
+
+  With automatic quality, throughput is measured once for the first video, and reused for the others. Resolution
+  failures are logged, and the stream URL of those videos stays None, so it is fetched again before use.
+  """
+  logger = logging.getLogger()
+  videos = list(videos)
+  unresolved = [video for video in videos if video.stream_url is None]
+  if not unresolved:
+    return videos
+  throughput = None
+  if CanalPlusVideo.quality == QUALITY_AUTO:
+    first_video = unresolved.pop(0)
+    try:
+      first_video.fetchVideoUrl()
+      throughput = first_video.throughput
+    except Exception as e:
+      logger.warning("Unable to get URL of '%s': %s %s" % (first_video.title, e.__class__.__qualname__, e))
+
+  def resolve(video):
+    try:
+      video.fetchVideoUrl(throughput=throughput)
+    except Exception as e:
+      logger.warning("Unable to get URL of '%s': %s %s" % (video.title, e.__class__.__qualname__, e))
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    for _ in executor.map(resolve, unresolved):
+      pass
+  return videos
+
+
+class RemuxQueue:
+
+  """
+  Run the remux stage of downloads on worker threads, so that the next download starts while previous ones are
+  remuxed.
+
+  At most max_pending downloaded files wait for remuxing or are being remuxed at any time. Submitting blocks while the
+  queue is full, so temporary disk usage stays bounded.
+  """
+
+  def __init__(self, *, workers=1, max_pending=1):
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    self.slots = threading.BoundedSemaphore(max_pending)
+    # videos whose remux stage raised an exception
+    self.failed = []
+    self.lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.join()
+
+  def submit(self, video, func, *args, pending=None, **kwargs):
+    """
+    Queue a remux stage function call for a video, waiting for a free slot if needed.
+
+    If pending is a tuple of (pending filepath, fallback filepath), and the function raises while the pending file
+    still exists, the pending file is moved to the fallback filepath, or removed if it can not be moved.
+    """
+    self.slots.acquire()
+    try:
+      future = self.executor.submit(func, *args, **kwargs)
+    except BaseException:
+      self.slots.release()
+      raise
+    future.add_done_callback(functools.partial(self.onDone, video, pending))
+
+  def onDone(self, video, pending, future):
+    self.slots.release()
+    if future.cancelled():
+      return
+    e = future.exception()
+    if e is not None:
+      logging.getLogger().error("Remuxing of '%s' failed: %s %s" % (video.title, e.__class__.__qualname__, e))
+      with self.lock:
+        self.failed.append(video)
+      if pending is not None:
+        __class__.dropPendingFile(*pending)
+
+  @staticmethod
+  def dropPendingFile(pending_filepath, fallback_filepath):
+    """ Move a pending file left by a failed remux stage to a fallback filepath, or remove it if that fails. """
+    if not os.path.isfile(pending_filepath):
+      return
+    try:
+      shutil.move(pending_filepath, fallback_filepath)
+    except OSError as e:
+      logging.getLogger().warning("Unable to move '%s' to '%s': %s" % (pending_filepath, fallback_filepath, e))
+      try:
+        os.remove(pending_filepath)
+      except FileNotFoundError:
+        pass
+    else:
+      logging.getLogger().warning("Video kept unremuxed in '%s'" % (fallback_filepath))
+
+  def join(self):
+    """ Wait for all queued remuxes to finish, and return the list of videos whose remux stage failed. """
+    self.executor.shutdown(wait=True)
+    return self.failed
+
+
+def download_videos(videos, dir, *, jobs=1, remux_workers=REMUX_WORKERS, **download_kwargs):
+  """
+  Download several videos to a directory, with up to jobs downloads running concurrently.
+
+  If remux_workers is not 0, videos are remuxed by a RemuxQueue with this number of workers, while the next downloads
+  run. A failed download does not stop the others. Return a tuple of (succeeded videos list, failed videos list).
+  On KeyboardInterrupt, pending downloads are cancelled, running ones stop before their next segment, and the exception
+  is raised again once they have stopped.
+  """
+  logger = logging.getLogger()
+  videos = tuple(videos)
+  if remux_workers and (not download_kwargs.get("stream_remux", False)):
+    remux_queue = RemuxQueue(workers=remux_workers, max_pending=max(remux_workers, jobs))
+    download_kwargs["remux_queue"] = remux_queue
+  else:
+    remux_queue = None
+  if jobs > 1:
+    # each concurrent download needs its own connections, all from the shared session pool
+    segment_workers = download_kwargs.get("segment_workers", CanalPlusVideo.SEGMENT_WORKERS)
+    CanalPlusApiObject.setHttpPoolSize(max(10, jobs * segment_workers))
+    download_kwargs["show_progress"] = False
+  stop = download_kwargs.setdefault("stop", threading.Event())
+
+  def download_video(i, video):
+    logger.info("Getting video %u/%u: '%s'" % (i, len(videos), video.title))
+    try:
+      return video.download(dir, **download_kwargs)
+    except Exception as e:
+      logger.error("Download of '%s' failed: %s %s", video.title, e.__class__.__qualname__, e)
+      return False
+
+  succeeded, failed = [], []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    futures = [executor.submit(download_video, i, video) for i, video in enumerate(videos, 1)]
+    try:
+      for video, future in zip(videos, futures):
+        (succeeded if future.result() else failed).append(video)
+    except BaseException:
+      for future in futures:
+        future.cancel()
+      stop.set()
+      raise
+  if remux_queue is not None:
+    for video in remux_queue.join():
+      succeeded.remove(video)
+      failed.append(video)
+  return succeeded, failed
+
+
+def read_batch_entries(file):
+  """
+  Read batch entries from a text file object, one per line: program names or ids, '?query' searches, or video ids
+  prefixed by BATCH_VIDEO_PREFIX. Blank lines and lines starting with '#' are ignored. Return a list of entries.
+  """
+  entries = []
+  for line in file:
+    line = line.strip()
+    if line and (not line.startswith("#")):
+      entries.append(line)
+  return entries
+
+
+def resolve_batch(entries, *, last_only=False, catalog=None, workers=BATCH_WORKERS):
+  """
+  Resolve batch entries (see read_batch_entries) to videos, and return a tuple of (list of CanalPlusVideo objects,
+  list of entries which failed).
+
+  Program names are resolved together (see find_programs), then video lists are fetched concurrently, sharing the API
+  response cache and connection pools. If last_only is True, only the most recent video of each program or search is
+  kept. Searches use catalog instead of the online search if it is a catalog.Catalog object. Videos are returned in
+  entry order, without duplicates, and video id entries are only fetched if they are not in a resolved video list.
+  """
+  logger = logging.getLogger()
+  # entry index -> CanalPlusVideoList or CanalPlusVideo object, or None if invalid
+  items = {}
+  program_indices = [i for i, entry in enumerate(entries)
+                     if not (entry.startswith("?") or entry.startswith(BATCH_VIDEO_PREFIX))]
+  for i, program in zip(program_indices, find_programs([entries[i] for i in program_indices])):
+    items[i] = program
+  for i, entry in enumerate(entries):
+    if entry.startswith("?"):
+      if catalog is not None:
+        items[i] = CanalPlusCatalogSearch(entry[1:], catalog)
+      else:
+        items[i] = CanalPlusSearch(entry[1:])
+    elif entry.startswith(BATCH_VIDEO_PREFIX):
+      video_id = entry[len(BATCH_VIDEO_PREFIX):].strip()
+      items[i] = CanalPlusVideo(int(video_id), None) if video_id.isdigit() else None
+
+  def resolve(item):
+    if isinstance(item, CanalPlusVideo):
+      item.fetchVideoUrl()
+      return [item]
+    videos = iter(item)
+    if last_only:
+      video = next(videos, None)
+      # stop receiving video list
+      videos.close()
+      return [video] if (video is not None) else []
+    return list(videos)
+
+  # the catalog connection can not be shared between threads, and catalog searches do not need requests
+  results = {}
+  for i, item in items.items():
+    if isinstance(item, CanalPlusCatalogSearch):
+      results[i] = resolve(item)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    # video lists first, so that video entries already in them are not fetched
+    for videos_only in (False, True):
+      if videos_only:
+        listed_ids = set(video.id for videos in results.values() for video in videos)
+      futures = {}
+      for i, item in items.items():
+        if (item is None) or (i in results) or (isinstance(item, CanalPlusVideo) != videos_only):
+          continue
+        if videos_only and (item.id in listed_ids):
+          results[i] = []
+        else:
+          futures[i] = executor.submit(resolve, item)
+      for i, future in futures.items():
+        try:
+          results[i] = future.result()
+        except Exception as e:
+          logger.warning("Unable to resolve '%s': %s %s" % (entries[i], e.__class__.__qualname__, e))
+
+  videos = []
+  seen_ids = set()
+  failed = []
+  for i, entry in enumerate(entries):
+    if i not in results:
+      if items[i] is None:
+        logger.error("Invalid or unknown batch entry '%s'" % (entry))
+      failed.append(entry)
+      continue
+    for video in results[i]:
+      if video.id not in seen_ids:
+        seen_ids.add(video.id)
+        videos.append(video)
+  return videos, failed
+
+
+def estimate_sizes(videos, *, segment_workers=CanalPlusVideo.SEGMENT_WORKERS):
+  """ Log segment count, duration and size of videos without downloading them, return total size or None if unknown. """
+  logger = logging.getLogger()
+  total_size = 0
+  for video in videos:
+    segment_count, duration, size = video.estimateSize(segment_workers)
+    duration_str = ("%us" % (duration)) if (duration is not None) else "?"
+    size_str = format_byte_size_str(size) if (size is not None) else "?"
+    logger.info("'%s': %u segment(s), duration %s, size %s" % (video.title, segment_count, duration_str, size_str))
+    if (size is None) or (total_size is None):
+      total_size = None
     else:
-      return next(itertools.islice(self, key, key + 1))
+      total_size += size
+  if total_size is not None:
+    logger.info("Total size: %s" % (format_byte_size_str(total_size)))
+  return total_size
 
 
 def terminal_choice(items, autocap=False):
@@ -419,12 +1843,24 @@ def terminal_choice(items, autocap=False):
   return c
 
 
+def quality_arg(s):
+  """ Parse a video quality command line argument. """
+  if s in (QUALITY_MAX, QUALITY_AUTO):
+    return s
+  try:
+    return int(s) * 1000
+  except ValueError:
+    raise argparse.ArgumentTypeError("invalid quality '%s'" % (s))
+
+
 def cl_main():
   # parse args
   arg_parser = argparse.ArgumentParser(description=__doc__,
                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   arg_parser.add_argument("output",
-                          help="Output directory to put downloaded files. Use 'player:vlc' to stream in a player.")
+                          nargs="?",
+                          help="Output directory to put downloaded files. Use 'player:vlc' to stream in a player. \
+                                Not needed with --update-catalog.")
   arg_parser.add_argument("-m",
                           "--mode",
                           choices=("auto", "last", "manual"),
@@ -434,10 +1870,136 @@ def cl_main():
                                 interactively download/view a video")
   arg_parser.add_argument("-p",
                           "--program",
+                          action="append",
                           default=None,
                           dest="program",
-                          help="Program (case insensitive). Use '?program' to do a search instead of looking for an \
-                                exact match.")
+                          help="Program name (case insensitive) or numeric id. Use '?program' to do a search instead \
+                                of looking for an exact match. Can be passed several times in watch mode.")
+  arg_parser.add_argument("-b",
+                          "--batch",
+                          default=None,
+                          dest="batch",
+                          help="Batch job file ('-' for stdin), with one entry per line: program name or id, \
+                                '?query' search, or '%sid' video id. Videos of all entries are downloaded or viewed \
+                                together, each video once. With mode 'last', only the last video of each program or \
+                                search is kept, all videos otherwise." % (BATCH_VIDEO_PREFIX))
+  arg_parser.add_argument("-q",
+                          "--quality",
+                          type=quality_arg,
+                          default=QUALITY_MAX,
+                          dest="quality",
+                          help="Video quality: '%s' for best quality, '%s' to select it from measured throughput and \
+                                lower it if throughput drops (only to a variant with the same codecs and \
+                                resolution), or a maximum bitrate in kbit/s" % (QUALITY_MAX, QUALITY_AUTO))
+  arg_parser.add_argument("-w",
+                          "--segment-workers",
+                          type=int,
+                          default=CanalPlusVideo.SEGMENT_WORKERS,
+                          dest="segment_workers",
+                          help="Number of video segments to download concurrently")
+  arg_parser.add_argument("-j",
+                          "--jobs",
+                          type=int,
+                          default=1,
+                          dest="jobs",
+                          help="Number of videos to download concurrently in automatic mode")
+  arg_parser.add_argument("-r",
+                          "--resume",
+                          action="store_true",
+                          default=False,
+                          dest="resume",
+                          help="Keep partial downloads in staging or output directory on failure, and resume them on \
+                                next run")
+  arg_parser.add_argument("--remux-workers",
+                          type=int,
+                          default=REMUX_WORKERS,
+                          dest="remux_workers",
+                          help="In automatic and watch modes, number of videos remuxed while the next ones download \
+                                (0 to remux before starting the next download)")
+  arg_parser.add_argument("--stream-remux",
+                          action="store_true",
+                          default=False,
+                          dest="stream_remux",
+                          help="Remux to MP4 while downloading instead of after download")
+  arg_parser.add_argument("--compute-size",
+                          action="store_true",
+                          default=False,
+                          dest="compute_size",
+                          help="Get size of all video segments before downloading, to check free disk space and \
+                                display accurate progress")
+  arg_parser.add_argument("--staging-dir",
+                          default=None,
+                          dest="staging_dir",
+                          help="Directory to write videos to while they download (default: output directory). Should \
+                                be on the same filesystem as the output directory, to move complete videos without \
+                                copying them")
+  arg_parser.add_argument("--dry-run",
+                          action="store_true",
+                          default=False,
+                          dest="dry_run",
+                          help="Only display segment count, duration and size of videos, without downloading them")
+  arg_parser.add_argument("--http-retries",
+                          type=int,
+                          default=CanalPlusApiObject.transport.max_retries,
+                          dest="http_retries",
+                          help="Maximum number of retries of a failed HTTP request, with exponential backoff")
+  arg_parser.add_argument("--proxy",
+                          action="store_true",
+                          default=False,
+                          dest="proxy",
+                          help="In player mode, serve the video to the player from a local proxy, which prefetches \
+                                segments and caches them on disk")
+  arg_parser.add_argument("--proxy-prefetch",
+                          type=int,
+                          default=PROXY_PREFETCH,
+                          dest="proxy_prefetch",
+                          help="Number of segments the local proxy prefetches ahead of playback")
+  arg_parser.add_argument("--proxy-cache-size",
+                          type=int,
+                          default=PROXY_CACHE_SIZE // (1024 * 1024),
+                          dest="proxy_cache_size",
+                          help="Maximum size in MB of the local proxy segment cache")
+  arg_parser.add_argument("--no-archive",
+                          action="store_false",
+                          default=True,
+                          dest="archive",
+                          help="Do not keep an index of downloaded videos in output directory, only skip videos \
+                                whose file already exists")
+  arg_parser.add_argument("--no-cache",
+                          action="store_false",
+                          default=True,
+                          dest="cache",
+                          help="Do not cache API responses on disk")
+  arg_parser.add_argument("--metrics-file",
+                          default=None,
+                          dest="metrics_file",
+                          help="Write runtime metrics as JSON to this file on exit")
+  arg_parser.add_argument("--metrics-port",
+                          type=int,
+                          default=None,
+                          dest="metrics_port",
+                          help="Serve runtime metrics in Prometheus text format over HTTP on this port")
+  arg_parser.add_argument("--update-catalog",
+                          action="store_true",
+                          default=False,
+                          dest="update_catalog",
+                          help="Build or refresh the local catalog of all programs and videos, and exit")
+  arg_parser.add_argument("-l",
+                          "--local-search",
+                          action="store_true",
+                          default=False,
+                          dest="local_search",
+                          help="Answer '?program' searches from the local catalog, see --update-catalog")
+  arg_parser.add_argument("--watch",
+                          action="store_true",
+                          default=False,
+                          dest="watch",
+                          help="Run forever, polling programs and downloading their new videos as they are published")
+  arg_parser.add_argument("--watch-interval",
+                          type=int,
+                          default=15 * 60,
+                          dest="watch_interval",
+                          help="Interval in seconds between program polls in watch mode")
   arg_parser.add_argument("-v",
                           "--verbose",
                           action="store_true",
@@ -445,6 +2007,16 @@ def cl_main():
                           dest="verbose",
                           help="Increase program output")
   args = arg_parser.parse_args()
+  if (args.output is None) and (not args.update_catalog):
+    arg_parser.error("the output argument is required")
+  if args.watch and ((args.program is None) or (args.output is None) or args.output.startswith("player:")):
+    arg_parser.error("watch mode needs at least one program, and an output directory")
+  if (not args.watch) and (args.program is not None) and (len(args.program) > 1):
+    arg_parser.error("several programs can only be passed in watch mode")
+  if (args.batch is not None) and ((args.program is not None) or args.watch or args.update_catalog):
+    arg_parser.error("batch mode can not be combined with --program, --watch or --update-catalog")
+  if args.jobs < 1:
+    arg_parser.error("the number of jobs must be at least 1")
 
   # setup logger
   logger = logging.getLogger()
@@ -459,21 +2031,177 @@ def cl_main():
   logging_handler.setFormatter(logging_formatter)
   logger.addHandler(logging_handler)
 
+  CanalPlusVideo.quality = args.quality
+  CanalPlusApiObject.transport.max_retries = args.http_retries
+
+  # setup metrics export
+  if args.metrics_file is not None:
+    atexit.register(metrics.dump_json, args.metrics_file)
+  if args.metrics_port is not None:
+    metrics.start_http_server(args.metrics_port)
+
+  # check staging directory
+  if (args.staging_dir is not None) and (args.output is not None) and (not args.output.startswith("player:")):
+    try:
+      if os.stat(args.staging_dir).st_dev != os.stat(args.output).st_dev:
+        logger.warning("Staging directory '%s' is not on the same filesystem as '%s', videos will be copied once "
+                       "downloaded" % (args.staging_dir, args.output))
+    except OSError as e:
+      arg_parser.error("unable to access staging or output directory: %s" % (e))
+
+  # setup download archive
+  if (args.output is not None) and (not args.output.startswith("player:")) and args.archive:
+    from canalplus import download_archive
+    archive = download_archive.DownloadArchive(args.output)
+  else:
+    archive = None
+
+  # CanalPlusVideo.download arguments common to all modes
+  download_kwargs = dict(segment_workers=args.segment_workers,
+                         resume=args.resume,
+                         stream_remux=args.stream_remux,
+                         compute_size=args.compute_size,
+                         staging_dir=args.staging_dir,
+                         archive=archive)
+
+  # setup API response cache
+  if args.cache:
+    try:
+      CanalPlusApiObject.cache = http_cache.HttpCache()
+    except OSError as e:
+      logger.warning("Unable to setup cache: %s" % (e))
+    CanalPlusProgramList.index = program_index.ProgramIndex(ttl=CanalPlusApiObject.CACHE_TTLS["initPlayer"])
+
+  if args.update_catalog:
+    # catalog update mode
+    from canalplus import catalog
+    with catalog.Catalog() as local_catalog:
+      added, removed = update_catalog(local_catalog, CanalPlusProgramList())
+    logger.info("Catalog updated: %u video(s) added, %u removed" % (added, removed))
+    return
+
+  if args.watch:
+    # watch mode
+    from canalplus import watch
+    program_names = [program_name for program_name in args.program if not program_name.startswith("?")]
+    programs = dict(zip(program_names, find_programs(program_names)))
+    video_lists = []
+    for program_name in args.program:
+      if program_name.startswith("?"):
+        video_lists.append(CanalPlusSearch(program_name[1:]))
+      else:
+        program = programs[program_name]
+        if program is None:
+          logger.error("Unknown program '%s'" % (program_name))
+          exit(1)
+        video_lists.append(program)
+    if CanalPlusApiObject.cache is None:
+      logger.warning("API response cache is disabled, every poll will fetch full video lists")
+
+    if args.remux_workers and (not args.stream_remux):
+      remux_queue = RemuxQueue(workers=args.remux_workers, max_pending=args.remux_workers)
+    else:
+      remux_queue = None
+
+    stop = threading.Event()
+
+    def download_video(vid):
+      return vid.download(args.output, show_progress=False, remux_queue=remux_queue, stop=stop, **download_kwargs)
+
+    logger.info("[Watch mode] Polling %u program(s) every %us" % (len(video_lists), args.watch_interval))
+    watcher = watch.Watcher(video_lists,
+                            download_video,
+                            interval=args.watch_interval,
+                            store=watch.SeenVideoStore(),
+                            stop=stop)
+    interrupted = False
+    try:
+      watcher.run()
+    except KeyboardInterrupt:
+      interrupted = True
+    if remux_queue is not None:
+      for vid in remux_queue.join():
+        logger.error("[Watch mode] Failed: '%s'" % (vid.title))
+    if interrupted:
+      exit(128 + signal.SIGINT)
+    return
+
+  def process_videos(videos, mode_name):
+    """ Estimate size of, view, or download several videos, and exit with an error if some downloads failed. """
+    if args.dry_run or args.output.startswith("player:"):
+      resolve_video_urls(videos)
+    else:
+      # no need to resolve videos which are already downloaded
+      try:
+        filenames = frozenset(os.listdir(args.output))
+      except FileNotFoundError:
+        filenames = frozenset()
+      resolve_video_urls(vid for vid in videos
+                         if vid.getDownloadedFilepath(args.output, archive=archive, filenames=filenames) is None)
+    if args.dry_run:
+      estimate_sizes(videos, segment_workers=args.segment_workers)
+    elif args.output.startswith("player:"):
+      for i, vid in enumerate(videos, 1):
+        logger.info("[%s] Getting video %u/%u : '%s'" % (mode_name, i, len(videos), vid.title))
+        vid.view(args.output.split(":", 1)[1],
+                 proxy=args.proxy,
+                 prefetch=args.proxy_prefetch,
+                 cache_size=args.proxy_cache_size * 1024 * 1024)
+    else:
+      succeeded, failed = download_videos(videos,
+                                          args.output,
+                                          jobs=args.jobs,
+                                          remux_workers=args.remux_workers,
+                                          **download_kwargs)
+      logger.info("[%s] Done: %u succeeded, %u failed" % (mode_name, len(succeeded), len(failed)))
+      for vid in failed:
+        logger.error("[%s] Failed: '%s'" % (mode_name, vid.title))
+      if failed:
+        exit(1)
+
+  if args.batch is not None:
+    # batch mode
+    if args.batch == "-":
+      entries = read_batch_entries(sys.stdin)
+    else:
+      try:
+        with open(args.batch, "rt") as batch_file:
+          entries = read_batch_entries(batch_file)
+      except OSError as e:
+        logger.error("Unable to read batch file: %s" % (e))
+        exit(1)
+    if args.local_search:
+      from canalplus import catalog
+      local_catalog = catalog.Catalog()
+    else:
+      local_catalog = None
+    logger.info("[Batch mode] Resolving %u entries" % (len(entries)))
+    videos, failed_entries = resolve_batch(entries, last_only=(args.mode == "last"), catalog=local_catalog)
+    logger.info("[Batch mode] Got %u unique video(s)" % (len(videos)))
+    process_videos(videos, "Batch mode")
+    if failed_entries:
+      exit(1)
+    return
+
   # choose program
+  if args.program is not None:
+    args.program = args.program[0]
   if args.program is None:
     # interactive program selection mode
     programs = CanalPlusProgramList()
     c = terminal_choice(programs, True)
     program = programs[c - 1]
+  elif args.program.startswith("?") and args.local_search:
+    # local catalog search mode
+    from canalplus import catalog
+    program = CanalPlusCatalogSearch(args.program[1:], catalog.Catalog())
   elif args.program.startswith("?"):
     # program search mode
     program = CanalPlusSearch(args.program[1:])
   else:
-    # exact program match mode
-    programs = CanalPlusProgramList()
-    if args.program in programs:
-      program = programs[args.program]
-    else:
+    # exact program match mode, by title or id
+    program = find_programs((args.program,))[0]
+    if program is None:
       logger.error("Unknown program '%s'" % (args.program))
       exit(1)
 
@@ -484,23 +2212,19 @@ def cl_main():
       logger.info("[Automatic mode] Getting all videos of program '%s'" % (program.title))
     else:
       logger.info("[Automatic mode] Getting all videos for query '%s'" % (program.query))
-    for i, vid in enumerate(program, 1):
-      logger.info("[Automatic mode] Getting video %u/%u : '%s'" % (i, len(program), vid.title))
-      if args.output.startswith("player:"):
-        vid.view(args.output.split(":", 1)[1])
-      else:
-        vid.download(args.output)
+    videos = list(program)
+    process_videos(videos, "Automatic mode")
   elif args.mode == "last":
     # last video mode
-    vid = next(iter(program))
+    videos = iter(program)
+    vid = next(videos)
+    # stop receiving video list
+    videos.close()
     if isinstance(program, CanalPlusProgram):
       logger.info("[Last video mode] Getting last video of program '%s': '%s'" % (program.title, vid.title))
     else:
       logger.info("[Last video mode] Getting first search result for query '%s': '%s'" % (program.query, vid.title))
-    if args.output.startswith("player:"):
-      vid.view(args.output.split(":", 1)[1])
-    else:
-      vid.download(args.output)
+    process_videos((vid,), "Last video mode")
   else:
     # interactive mode
     if not program:
@@ -511,10 +2235,7 @@ def cl_main():
       exit(1)
     c = terminal_choice(program)
     vid = program[c - 1]
-    if args.output.startswith("player:"):
-      vid.view(args.output.split(":", 1)[1])
-    else:
-      vid.download(args.output)
+    process_videos((vid,), "Manual mode")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+""" asyncio API for Canal+ videos, requires Python >= 3.5. """
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import threading
+
+from canalplus import CanalPlusApiObject, CanalPlusProgramList, CanalPlusSearch, CanalPlusVideo
+from canalplus import http_transport
+
+
+class AsyncCanalPlusClient:
+
+  """
+  Run Canal+ API operations from asyncio code.
+
+  Blocking operations of the synchronous API objects run on a thread pool, so results are the same as with the
+  synchronous API, and at most max_concurrency of them run at the same time. Cancelling a coroutine stops it at the
+  next blocking operation boundary (for downloads, at the next segment), operations already running in a thread are
+  left to complete and their result is discarded.
+
+  The client has its own HTTP connection pool, API objects passed to or returned by the client are bound to it.
+  """
+
+  def __init__(self, *, max_concurrency=8):
+    self.max_concurrency = max_concurrency
+    # created in the running loop by run, asyncio primitives are bound to a loop at creation before Python 3.10
+    self.semaphore = None
+    self.semaphore_loop = None
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+    # file operations run in order on a single thread, out of the event loop
+    self.file_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    shared_transport = CanalPlusApiObject.transport
+    self.transport = http_transport.Transport(pool_size=max(10, max_concurrency),
+                                              timeouts=shared_transport.timeouts,
+                                              max_retries=shared_transport.max_retries,
+                                              backoff_factor=shared_transport.backoff_factor,
+                                              max_backoff=shared_transport.max_backoff)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    """ Release thread pools, without waiting for running operations. """
+    self.executor.shutdown(wait=False)
+    self.file_executor.shutdown(wait=False)
+
+  def bind(self, api_object):
+    """ Make an API object use the HTTP connection pool of the client, and return it. """
+    api_object.transport = self.transport
+    return api_object
+
+  async def run(self, func, *args, **kwargs):
+    """ Run a blocking function on the thread pool, and return its result. """
+    loop = asyncio.get_event_loop()
+    if self.semaphore_loop is not loop:
+      self.semaphore = asyncio.Semaphore(self.max_concurrency)
+      self.semaphore_loop = loop
+    async with self.semaphore:
+      return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+  async def getProgramList(self):
+    """ Return a CanalPlusProgramList object. """
+    # bind before construction, which fetches the list
+    program_list = self.bind(CanalPlusProgramList.__new__(CanalPlusProgramList))
+    await self.run(program_list.__init__)
+    return program_list
+
+  async def fetchVidlist(self, video_list):
+    """ Fetch video list of a CanalPlusProgram or CanalPlusSearch object if needed, and return a list of videos. """
+    self.bind(video_list)
+    if video_list.videos is None:
+      await self.run(video_list.fetchVidlist)
+    return list(map(self.bind, video_list))
+
+  async def search(self, query):
+    """ Return a CanalPlusSearch object, with its results fetched. """
+    search = self.bind(CanalPlusSearch(query))
+    await self.run(search.fetchVidlist)
+    return search
+
+  async def fetchVideoUrl(self, video):
+    """ Fetch video URL of a CanalPlusVideo object if needed, and return it. """
+    self.bind(video)
+    if video.stream_url is None:
+      await self.run(video.fetchVideoUrl)
+    return video.stream_url
+
+  async def fetchVideoUrls(self, videos):
+    """ Fetch video URLs of several CanalPlusVideo objects concurrently, and return them. """
+    return await asyncio.gather(*map(self.fetchVideoUrl, videos))
+
+  async def downloadSegments(self, video, urls, filepath, *, window=CanalPlusVideo.SEGMENT_WORKERS * 2):
+    """
+    Download TS segments of a video concurrently to a file, in order.
+
+    At most window segments are downloading or waiting to be written at any time.
+    """
+    self.bind(video)
+    loop = asyncio.get_event_loop()
+    video_file = await loop.run_in_executor(self.file_executor, open, filepath, "wb")
+    urls = iter(urls)
+    pending = collections.deque()
+    try:
+      for url in urls:
+        pending.append(asyncio.ensure_future(self.run(video.fetchSegment, url)))
+        if len(pending) >= window:
+          break
+      while pending:
+        ts_data = await pending.popleft()
+        url = next(urls, None)
+        if url is not None:
+          pending.append(asyncio.ensure_future(self.run(video.fetchSegment, url)))
+        await loop.run_in_executor(self.file_executor, video_file.write, ts_data)
+    except BaseException:
+      for future in pending:
+        future.cancel()
+      # queued after any write still running
+      self.file_executor.submit(video_file.close)
+      raise
+    await loop.run_in_executor(self.file_executor, video_file.close)
+
+  async def download(self, video, dir, **download_kwargs):
+    """
+    Download a video to a given directory with CanalPlusVideo.download, which takes the same keyword arguments, and
+    return its result. Progress is not displayed by default.
+
+    If cancelled, the download stops before its next segment.
+    """
+    self.bind(video)
+    download_kwargs.setdefault("show_progress", False)
+    stop = download_kwargs.setdefault("stop", threading.Event())
+    try:
+      return await self.run(video.download, dir, **download_kwargs)
+    except asyncio.CancelledError:
+      stop.set()
+      raise
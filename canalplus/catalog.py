@@ -0,0 +1,190 @@
+""" Local SQLite full text index of programs and videos, for offline search. """
+
+import contextlib
+import os
+import re
+import sqlite3
+
+from canalplus import http_cache
+
+
+def get_default_catalog_filepath():
+  """ Return the default catalog database file path, in the cache directory. """
+  return os.path.join(http_cache.get_default_cache_dir(), "catalog.sqlite")
+
+
+def get_fts_module():
+  """ Return the name of the best available SQLite full text search module. """
+  with contextlib.closing(sqlite3.connect(":memory:")) as connection:
+    try:
+      connection.execute("CREATE VIRTUAL TABLE t USING fts5(c)")
+    except sqlite3.OperationalError:
+      return "fts4"
+  return "fts5"
+
+
+class CatalogRecord:
+
+  """ Video search result. """
+
+  __slots__ = ("id", "title", "subtitle", "program_id", "program_title")
+
+  def __init__(self, id, title, subtitle, program_id, program_title):
+    self.id = id
+    self.title = title
+    self.subtitle = subtitle
+    self.program_id = program_id
+    self.program_title = program_title
+
+  def getFullTitle(self):
+    """ Return title with subtitle if any. """
+    if self.subtitle:
+      return "%s (%s)" % (self.title, self.subtitle)
+    return self.title
+
+
+class Catalog:
+
+  """
+  Full text index of programs, and of the videos of each program.
+
+  A video can belong to several programs. Video title, subtitle and the titles of its programs are indexed, searches
+  match all query words as prefixes, case and accent insensitively.
+  """
+
+  # incremented when the schema changes, older databases are rebuilt
+  SCHEMA_VERSION = 2
+
+  def __init__(self, filepath=None):
+    self.filepath = filepath if (filepath is not None) else get_default_catalog_filepath()
+    os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+    self.connection = sqlite3.connect(self.filepath)
+    self.createTables()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    self.connection.close()
+
+  def createTables(self):
+    with self.connection:
+      version = self.connection.execute("PRAGMA user_version;").fetchone()[0]
+      if version < __class__.SCHEMA_VERSION:
+        # the catalog only holds data fetched from the API, rebuild it from scratch
+        for table in ("video_programs", "videos_fts", "videos", "programs"):
+          self.connection.execute("DROP TABLE IF EXISTS %s;" % (table))
+        self.connection.execute("PRAGMA user_version = %u;" % (__class__.SCHEMA_VERSION))
+      self.connection.execute("CREATE TABLE IF NOT EXISTS programs (id INTEGER PRIMARY KEY, title TEXT NOT NULL);")
+      self.connection.execute("CREATE TABLE IF NOT EXISTS videos (id INTEGER PRIMARY KEY, title TEXT, subtitle TEXT);")
+      self.connection.execute("CREATE TABLE IF NOT EXISTS video_programs (video_id INTEGER NOT NULL, "
+                              "                                          program_id INTEGER NOT NULL, "
+                              "                                          PRIMARY KEY (video_id, program_id));")
+      self.connection.execute("CREATE INDEX IF NOT EXISTS video_programs_program_id "
+                              "ON video_programs(program_id);")
+      self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS videos_fts USING %s(title, "
+                              "                                                         subtitle, "
+                              "                                                         program, "
+                              "                                                         tokenize=unicode61);" %
+                              (get_fts_module()))
+
+  def getProgramIds(self):
+    """ Return the set of indexed program ids. """
+    return set(row[0] for row in self.connection.execute("SELECT id FROM programs;"))
+
+  def updateProgram(self, program_id, program_title, videos):
+    """
+    Update the index of a program, from an iterable of VideoRecord objects.
+
+    Only added, changed and removed videos are written. Return a tuple of (added, removed) video counts for this
+    program, a video also listed by another program counts for both.
+    """
+    videos = dict((video.id, (video.title, video.subtitle)) for video in videos)
+    with self.connection:
+      cursor = self.connection.execute("SELECT title FROM programs WHERE id = ?;", (program_id,))
+      row = cursor.fetchone()
+      program_changed = (row is not None) and (row[0] != program_title)
+      self.connection.execute("INSERT OR REPLACE INTO programs (id, title) VALUES (?, ?);",
+                              (program_id, program_title))
+      indexed = dict((row[0], (row[1], row[2]))
+                     for row in self.connection.execute("SELECT videos.id, videos.title, videos.subtitle "
+                                                        "FROM video_programs "
+                                                        "JOIN videos ON videos.id = video_programs.video_id "
+                                                        "WHERE video_programs.program_id = ?;",
+                                                        (program_id,)))
+      removed = indexed.keys() - videos.keys()
+      for video_id in removed:
+        self.unlinkVideo(video_id, program_id)
+      added = 0
+      for video_id, (title, subtitle) in videos.items():
+        previous = indexed.get(video_id)
+        if previous == (title, subtitle) and not program_changed:
+          continue
+        if previous is None:
+          added += 1
+          self.connection.execute("INSERT OR IGNORE INTO video_programs (video_id, program_id) VALUES (?, ?);",
+                                  (video_id, program_id))
+        self.connection.execute("INSERT OR REPLACE INTO videos (id, title, subtitle) VALUES (?, ?, ?);",
+                                (video_id, title, subtitle))
+        self.indexVideo(video_id)
+    return added, len(removed)
+
+  def removeProgram(self, program_id):
+    """ Remove a program from the index, and its videos not listed by other programs. """
+    with self.connection:
+      for video_id, in self.connection.execute("SELECT video_id FROM video_programs WHERE program_id = ?;",
+                                               (program_id,)).fetchall():
+        self.unlinkVideo(video_id, program_id)
+      self.connection.execute("DELETE FROM programs WHERE id = ?;", (program_id,))
+
+  def unlinkVideo(self, video_id, program_id):
+    """ Remove a video from a program, and from the index if it is not listed by another program. """
+    self.connection.execute("DELETE FROM video_programs WHERE video_id = ? AND program_id = ?;",
+                            (video_id, program_id))
+    if self.connection.execute("SELECT 1 FROM video_programs WHERE video_id = ? LIMIT 1;",
+                               (video_id,)).fetchone() is None:
+      self.connection.execute("DELETE FROM videos WHERE id = ?;", (video_id,))
+      self.connection.execute("DELETE FROM videos_fts WHERE rowid = ?;", (video_id,))
+    else:
+      self.indexVideo(video_id)
+
+  def indexVideo(self, video_id):
+    """ Write the full text index row of a video, with the titles of all its programs. """
+    title, subtitle = self.connection.execute("SELECT title, subtitle FROM videos WHERE id = ?;",
+                                              (video_id,)).fetchone()
+    program_titles = [row[0] for row in self.connection.execute("SELECT programs.title "
+                                                                "FROM video_programs "
+                                                                "JOIN programs ON programs.id = "
+                                                                "                 video_programs.program_id "
+                                                                "WHERE video_programs.video_id = ? "
+                                                                "ORDER BY programs.id;",
+                                                                (video_id,))]
+    self.connection.execute("DELETE FROM videos_fts WHERE rowid = ?;", (video_id,))
+    self.connection.execute("INSERT INTO videos_fts (rowid, title, subtitle, program) VALUES (?, ?, ?, ?);",
+                            (video_id, title, subtitle, " ".join(program_titles)))
+
+  def search(self, query, limit=None):
+    """
+    Search videos matching all words of a query, and return a list of CatalogRecord objects, most recent first.
+
+    A video listed by several programs gets one record per program.
+    """
+    # lower case words, so that they are not parsed as query operators
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+      return []
+    sql = ("SELECT videos.id, videos.title, videos.subtitle, programs.id, programs.title "
+           "FROM videos_fts "
+           "JOIN videos ON videos.id = videos_fts.rowid "
+           "JOIN video_programs ON video_programs.video_id = videos.id "
+           "JOIN programs ON programs.id = video_programs.program_id "
+           "WHERE videos_fts MATCH ? "
+           "ORDER BY videos.id DESC, programs.id")
+    params = [" ".join("%s*" % (word) for word in words)]
+    if limit is not None:
+      sql += " LIMIT ?"
+      params.append(limit)
+    return [CatalogRecord(*row) for row in self.connection.execute(sql + ";", params)]
@@ -0,0 +1,103 @@
+""" Archive index of the videos downloaded to an output directory, keyed by video id, with their content hash. """
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+def new_content_hash():
+  """ Return a new hash object to compute the content hash of a video, from its downloaded TS data. """
+  return hashlib.sha256()
+
+
+class DownloadArchive:
+
+  """
+  Append only index of completed downloads, stored in the output directory.
+
+  Each line is a JSON object of the form {"id": video id, "filename": output filename, "sha256": TS content hash}.
+  Later lines override earlier ones for the same video id.
+  """
+
+  FILENAME = ".canalplus-archive.jsonl"
+
+  def __init__(self, dirpath):
+    self.dirpath = dirpath
+    self.filepath = os.path.join(dirpath, __class__.FILENAME)
+    # video id -> entry dict
+    self.entries = {}
+    # content hash -> entry dict
+    self.hashes = {}
+    self.lock = threading.Lock()
+    self.load()
+
+  def load(self):
+    """ Load archive file, if any. """
+    try:
+      with open(self.filepath, "rt", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    except FileNotFoundError:
+      return
+    for line in lines:
+      try:
+        entry = json.loads(line)
+        self.index(entry)
+      except (ValueError, KeyError, TypeError):
+        # last line may be truncated if we were killed while writing it
+        logging.getLogger().debug("Ignoring invalid line in archive '%s'" % (self.filepath))
+
+  def index(self, entry):
+    self.entries[entry["id"]] = entry
+    if entry["sha256"] is not None:
+      self.hashes[entry["sha256"]] = entry
+
+  def __contains__(self, video_id):
+    with self.lock:
+      return video_id in self.entries
+
+  def get(self, video_id):
+    """ Return the entry dict of a downloaded video, or None if it is not in the archive. """
+    with self.lock:
+      return self.entries.get(video_id)
+
+  def add(self, video_id, filepath, content_hash):
+    """
+    Record a completed download.
+
+    If another video with identical content was downloaded before to the same container format and its file still
+    exists, the new file is replaced by a hard link to it. Return the filepath of the file the new one is linked to, or
+    None.
+    """
+    filename = os.path.basename(filepath)
+    linked_filepath = None
+    with self.lock:
+      previous = self.hashes.get(content_hash)
+      # the hash is computed on TS data, a remuxed file only has the same content as another remuxed file
+      if ((previous is not None) and (previous["filename"] != filename) and
+              (os.path.splitext(previous["filename"])[1] == os.path.splitext(filename)[1])):
+        previous_filepath = os.path.join(self.dirpath, previous["filename"])
+        if os.path.isfile(previous_filepath) and self.link(previous_filepath, filepath):
+          linked_filepath = previous_filepath
+      entry = {"id": video_id, "filename": filename, "sha256": content_hash}
+      self.index(entry)
+      with open(self.filepath, "at", encoding="utf-8") as f:
+        f.write("%s\n" % (json.dumps(entry, sort_keys=True)))
+    return linked_filepath
+
+  @staticmethod
+  def link(src_filepath, dst_filepath):
+    """ Atomically replace a file by a hard link to another file, return True if success, False instead. """
+    tmp_filepath = "%s.link" % (dst_filepath)
+    try:
+      os.link(src_filepath, tmp_filepath)
+      os.replace(tmp_filepath, dst_filepath)
+    except OSError as e:
+      logging.getLogger().debug("Unable to link '%s' to '%s': %s" % (dst_filepath, src_filepath, e))
+      try:
+        os.remove(tmp_filepath)
+      except FileNotFoundError:
+        pass
+      return False
+    return True
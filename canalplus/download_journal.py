@@ -0,0 +1,96 @@
+""" Sidecar journal recording download progress of a partial file, to be able to resume it later. """
+
+import json
+import logging
+import os
+
+
+class DownloadJournal:
+
+  """
+  Append only journal of completed (or partially completed) segments of a partial download file.
+
+  Each line is a JSON object. The first one is a header identifying the download, the following ones are checkpoints of
+  the form {"segment": index, "offset": offset of segment in file, "size": bytes of segment written, "complete": bool}.
+  """
+
+  SUFFIX = ".journal"
+
+  def __init__(self, filepath, header):
+    self.filepath = filepath
+    self.header = header
+    self.checkpoint = None
+    self.file = None
+
+  def __enter__(self):
+    self.load()
+    if self.checkpoint is None:
+      self.reset()
+    else:
+      self.file = open(self.filepath, "at")
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.file.close()
+    self.file = None
+
+  def load(self):
+    """ Load last checkpoint from an existing journal file, if it matches the current download. """
+    try:
+      with open(self.filepath, "rt") as f:
+        lines = f.read().splitlines()
+    except FileNotFoundError:
+      return
+    try:
+      if (not lines) or (json.loads(lines[0]) != self.header):
+        logging.getLogger().debug("Journal '%s' is for another download, ignoring it" % (self.filepath))
+        return
+      for line in reversed(lines[1:]):
+        try:
+          self.checkpoint = json.loads(line)
+        except ValueError:
+          # last line may be truncated if we were killed while writing it
+          continue
+        break
+      else:
+        self.checkpoint = {"segment": 0, "offset": 0, "size": 0, "complete": False}
+    except ValueError:
+      logging.getLogger().debug("Journal '%s' is corrupted, ignoring it" % (self.filepath))
+      self.checkpoint = None
+
+  def resumePoint(self, data_size):
+    """
+    Return a tuple (segment index, offset of segment in file, bytes of segment already written) to resume download
+    from, given the current size of the partial file.
+    """
+    c = self.checkpoint
+    if (c is None) or (c["offset"] + c["size"] > data_size):
+      self.reset()
+      return 0, 0, 0
+    if c["complete"]:
+      return c["segment"] + 1, c["offset"] + c["size"], 0
+    return c["segment"], c["offset"], c["size"]
+
+  def reset(self):
+    """ Discard all checkpoints. """
+    if self.file is not None:
+      self.file.close()
+    self.file = open(self.filepath, "wt")
+    self.checkpoint = None
+    self.write(self.header)
+
+  def record(self, segment, offset, size, complete=True):
+    """ Record a checkpoint, data must have been flushed to the partial file before. """
+    self.checkpoint = {"segment": segment, "offset": offset, "size": size, "complete": complete}
+    self.write(self.checkpoint)
+
+  def write(self, obj):
+    self.file.write("%s\n" % (json.dumps(obj, sort_keys=True)))
+    self.file.flush()
+
+  def remove(self):
+    """ Remove journal file. """
+    try:
+      os.remove(self.filepath)
+    except FileNotFoundError:
+      pass
@@ -0,0 +1,207 @@
+""" Local HTTP proxy serving a HLS video to media players, with segment prefetching and a disk cache. """
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+
+from canalplus import http_cache
+from canalplus import m3u8
+from canalplus import mkstemp_ctx
+
+
+def get_default_segment_cache_dir():
+  """ Return the default segment cache directory path. """
+  return os.path.join(http_cache.get_default_cache_dir(), "segments")
+
+
+class SegmentCache:
+
+  """
+  Size bounded on-disk cache of video segments, shareable between concurrent processes.
+
+  Entries are written atomically, and evicted least recently used first (file modification time is the last access
+  time). A lock file serializes eviction between processes.
+  """
+
+  LOCK_FILENAME = "lock"
+  SUFFIX = ".ts"
+
+  def __init__(self, dirpath=None, *, max_size):
+    self.dirpath = dirpath if (dirpath is not None) else get_default_segment_cache_dir()
+    self.max_size = max_size
+    os.makedirs(self.dirpath, exist_ok=True)
+
+  def getEntryFilepath(self, segment):
+    key = segment.uri if (segment.byterange is None) else ("%s@%u-%u" % ((segment.uri,) + segment.byterange))
+    return os.path.join(self.dirpath, "%s%s" % (hashlib.sha1(key.encode("utf-8")).hexdigest(), __class__.SUFFIX))
+
+  def get(self, segment):
+    """ Return the filepath of a cached segment, or None if it is not cached. """
+    filepath = self.getEntryFilepath(segment)
+    try:
+      os.utime(filepath)
+    except FileNotFoundError:
+      return None
+    return filepath
+
+  def store(self, segment, data):
+    """ Store segment data, evict old entries if needed, and return the entry filepath. """
+    filepath = self.getEntryFilepath(segment)
+    with mkstemp_ctx.atomic_write(filepath) as f:
+      f.write(data)
+    self.evict()
+    return filepath
+
+  def evict(self):
+    """ Remove least recently used entries until cache size is below its maximum size. """
+    with http_cache.lock_file(os.path.join(self.dirpath, __class__.LOCK_FILENAME), True):
+      # never evict the most recent entry, it is about to be served
+      http_cache.evict_lru_files(self.dirpath, __class__.SUFFIX, self.max_size, keep=1)
+
+
+class HlsProxy:
+
+  """
+  Serve a HLS video on localhost, with a rewritten media playlist pointing to the proxy.
+
+  When a player requests a segment, the following ones are prefetched in the background, and all segments go through a
+  SegmentCache, so replays, seeks and concurrent players are served locally. A segment is only fetched once at a time.
+  """
+
+  PLAYLIST_PATH = "/playlist.m3u8"
+  SEGMENT_PATH_REGEX = re.compile(r"^/segments/(\d+)\.ts$")
+
+  def __init__(self, video, *, prefetch, cache, address="127.0.0.1", port=0):
+    self.video = video
+    self.playlist = video.fetchMediaPlaylist(video.stream_url)
+    self.prefetch = prefetch
+    self.cache = cache
+    # segment index -> concurrent.futures.Future object of the segment filepath, for segments being fetched
+    self.fetching = {}
+    self.lock = threading.Lock()
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, prefetch))
+    # imported here so that importing this module does not load http.server
+    from canalplus import http_server
+    self.server = http_server.create_http_server((address, port), self.getRequestHandlerClass())
+    self.thread = None
+
+  @property
+  def url(self):
+    """ URL of the proxy playlist. """
+    address, port = self.server.server_address[:2]
+    return "http://%s:%u%s" % (address, port, __class__.PLAYLIST_PATH)
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def start(self):
+    """ Start serving from a background thread. """
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    logging.getLogger().debug("HLS proxy listening on '%s'" % (self.url))
+
+  def stop(self):
+    """ Stop serving, and cancel pending prefetches. """
+    self.server.shutdown()
+    self.server.server_close()
+    with self.lock:
+      futures = tuple(self.fetching.values())
+    for future in futures:
+      future.cancel()
+    self.executor.shutdown(wait=False)
+
+  def getPlaylistText(self):
+    """ Return the media playlist text, with segment URIs pointing to the proxy. """
+    return m3u8.format_media_playlist(self.playlist, ("/segments/%u.ts" % (i) for i in range(len(self.playlist))))
+
+  def getSegmentFilepath(self, index):
+    """ Return the filepath of a cached segment, fetching it if needed. """
+    segment = self.playlist[index]
+    filepath = self.cache.get(segment)
+    if filepath is not None:
+      return filepath
+    return self.submitFetch(index).result()
+
+  def submitFetch(self, index):
+    """ Fetch a segment in the background if it is not already being fetched, and return the Future object. """
+    with self.lock:
+      future = self.fetching.get(index)
+      if future is None:
+        future = self.executor.submit(self.fetchSegment, index)
+        self.fetching[index] = future
+    return future
+
+  def fetchSegment(self, index):
+    segment = self.playlist[index]
+    try:
+      filepath = self.cache.get(segment)
+      if filepath is None:
+        logging.getLogger().debug("Fetching segment %u/%u" % (index + 1, len(self.playlist)))
+        filepath = self.cache.store(segment, self.video.fetchSegment(segment))
+      return filepath
+    finally:
+      with self.lock:
+        del self.fetching[index]
+
+  def prefetchFrom(self, index):
+    """ Prefetch segments following a segment index. """
+    for i in range(index + 1, min(index + 1 + self.prefetch, len(self.playlist))):
+      if self.cache.get(self.playlist[i]) is None:
+        self.submitFetch(i)
+
+  def getRequestHandlerClass(self):
+    import http.server
+    proxy = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        if self.path == proxy.PLAYLIST_PATH:
+          data = proxy.getPlaylistText().encode("utf-8")
+          self.send_response(200)
+          self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+          self.send_header("Content-Length", str(len(data)))
+          self.end_headers()
+          self.wfile.write(data)
+          return
+        match = proxy.SEGMENT_PATH_REGEX.match(self.path)
+        if (match is None) or (int(match.group(1)) >= len(proxy.playlist)):
+          self.send_error(404)
+          return
+        index = int(match.group(1))
+        try:
+          filepath = proxy.getSegmentFilepath(index)
+        except Exception as e:
+          logging.getLogger().warning("Unable to get segment %u: %s %s" % (index, e.__class__.__qualname__, e))
+          self.send_error(502)
+          return
+        proxy.prefetchFrom(index)
+        try:
+          f = open(filepath, "rb")
+        except FileNotFoundError:
+          # evicted in the meantime by another process
+          self.send_error(503)
+          return
+        with f:
+          self.send_response(200)
+          self.send_header("Content-Type", "video/mp2t")
+          self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+          self.end_headers()
+          try:
+            shutil.copyfileobj(f, self.wfile)
+          except (BrokenPipeError, ConnectionResetError):
+            # player seeked away
+            pass
+
+      def log_message(self, *args):
+        pass
+
+    return Handler
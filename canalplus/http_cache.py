@@ -0,0 +1,151 @@
+""" Persistent on-disk cache for HTTP text responses, shareable between concurrent processes. """
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import time
+
+try:
+  import fcntl
+except ImportError:
+  # Windows, no inter process locking
+  fcntl = None
+
+from canalplus import mkstemp_ctx
+
+
+def get_default_cache_dir():
+  """ Return the default cache directory path, following the XDG base directory specification. """
+  cache_root = os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+  return os.path.join(cache_root, "canalplus")
+
+
+@contextlib.contextmanager
+def lock_file(filepath, exclusive):
+  """ Context manager to hold an inter process lock on a file, which is created if needed. """
+  with open(filepath, "ab") as f:
+    if fcntl is not None:
+      fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    try:
+      yield
+    finally:
+      if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def evict_lru_files(dirpath, suffix, max_size, *, keep=0):
+  """
+  Remove least recently used files of a directory whose name ends with suffix, until their total size is below
+  max_size. File modification time is the last access time, and the keep most recent files are never removed.
+  """
+  entries = []
+  total_size = 0
+  for filename in os.listdir(dirpath):
+    if not filename.endswith(suffix):
+      continue
+    filepath = os.path.join(dirpath, filename)
+    try:
+      st = os.stat(filepath)
+    except FileNotFoundError:
+      continue
+    entries.append((st.st_mtime, st.st_size, filepath))
+    total_size += st.st_size
+  if total_size <= max_size:
+    return
+  entries.sort()
+  for _, size, filepath in entries[:len(entries) - keep]:
+    logging.getLogger().debug("Evicting '%s' from cache" % (filepath))
+    try:
+      os.remove(filepath)
+    except FileNotFoundError:
+      pass
+    total_size -= size
+    if total_size <= max_size:
+      break
+
+
+class HttpCache:
+
+  """
+  Cache of HTTP text responses, with conditional request validators, and LRU eviction when its size exceeds a limit.
+
+  Each entry is stored in its own JSON file, named after the hash of the URL, and written atomically. The file
+  modification time is the last access time used for LRU eviction. A lock file serializes writes and eviction between
+  processes.
+  """
+
+  LOCK_FILENAME = "lock"
+  ENTRY_SUFFIX = ".json"
+
+  def __init__(self, dirpath=None, max_size=32 * 1024 * 1024):
+    self.dirpath = dirpath if (dirpath is not None) else get_default_cache_dir()
+    self.max_size = max_size
+    os.makedirs(self.dirpath, exist_ok=True)
+
+  def lock(self, exclusive):
+    """ Context manager to hold the inter process cache lock. """
+    return lock_file(os.path.join(self.dirpath, __class__.LOCK_FILENAME), exclusive)
+
+  def getEntryFilepath(self, url):
+    return os.path.join(self.dirpath, "%s%s" % (hashlib.sha1(url.encode("utf-8")).hexdigest(), __class__.ENTRY_SUFFIX))
+
+  def get(self, url):
+    """
+    Get a cache entry dict for an URL, or None if not cached.
+
+    The entry has keys "url", "timestamp", "etag", "last_modified", and "text".
+    """
+    filepath = self.getEntryFilepath(url)
+    with self.lock(False):
+      try:
+        with open(filepath, "rt", encoding="utf-8") as f:
+          entry = json.load(f)
+        os.utime(filepath)
+      except (OSError, ValueError):
+        return None
+    if entry.get("url") != url:
+      # hash collision
+      return None
+    return entry
+
+  def store(self, url, text, headers):
+    """ Store an HTTP response text with the validators from its headers, and evict old entries if needed. """
+    entry = {"url": url,
+             "timestamp": time.time(),
+             "etag": headers.get("ETag"),
+             "last_modified": headers.get("Last-Modified"),
+             "text": text}
+    self.write(url, entry)
+    self.evict()
+
+  def refresh(self, url, entry):
+    """ Mark an entry as fresh again, after successful revalidation. """
+    entry["timestamp"] = time.time()
+    self.write(url, entry)
+
+  def write(self, url, entry):
+    filepath = self.getEntryFilepath(url)
+    with self.lock(True), mkstemp_ctx.atomic_write(filepath, "wt", encoding="utf-8") as f:
+      json.dump(entry, f)
+
+  def evict(self):
+    """ Remove least recently used entries until cache size is below its maximum size. """
+    with self.lock(True):
+      evict_lru_files(self.dirpath, __class__.ENTRY_SUFFIX, self.max_size)
+
+  @staticmethod
+  def isFresh(entry, ttl):
+    """ Return True if a cache entry is younger than ttl seconds, False instead. """
+    return (time.time() - entry["timestamp"]) < ttl
+
+  @staticmethod
+  def getValidationHeaders(entry):
+    """ Return a dict of conditional request headers to revalidate an entry. """
+    headers = {}
+    if entry["etag"]:
+      headers["If-None-Match"] = entry["etag"]
+    if entry["last_modified"]:
+      headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
@@ -0,0 +1,16 @@
+""" Threaded HTTP server on localhost, for the HLS proxy and the metrics endpoint. """
+
+import http.server
+import socketserver
+
+
+class ThreadedHttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+  """ HTTP server handling each request in a thread, which does not block exit. """
+
+  daemon_threads = True
+
+
+def create_http_server(address, handler_class):
+  """ Return a ThreadedHttpServer object bound to an address, serving requests with a given handler class. """
+  return ThreadedHttpServer(address, handler_class)
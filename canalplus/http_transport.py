@@ -0,0 +1,132 @@
+""" Thread safe HTTP transport, with per host connection pools, per traffic kind timeouts, and retries. """
+
+import logging
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+
+# traffic kinds, each with its own timeouts
+API = "api"
+SEGMENT = "segment"
+
+# default (connect, read) timeouts in seconds, per traffic kind
+DEFAULT_TIMEOUTS = {API: (3.05, 9.1),
+                    SEGMENT: (3.05, 30.1)}
+
+# response status codes worth retrying
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+# methods which can be retried without side effect
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+
+class Transport:
+
+  """
+  HTTP transport shareable between threads.
+
+  Each thread gets its own requests.Session object, all sessions share the same connection pools (one per host, of
+  configurable size), so connections are kept alive across threads. Requests with idempotent methods are retried with
+  exponential backoff on connection errors, timeouts, and transient error statuses.
+  """
+
+  def __init__(self, *, pool_size=10, timeouts=None, max_retries=3, backoff_factor=0.5, max_backoff=30):
+    self.timeouts = dict(DEFAULT_TIMEOUTS)
+    if timeouts is not None:
+      self.timeouts.update(timeouts)
+    self.max_retries = max_retries
+    self.backoff_factor = backoff_factor
+    self.max_backoff = max_backoff
+    self.default_adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    # host -> requests.adapters.HTTPAdapter object
+    self.host_adapters = {}
+    # incremented when adapters change, so that thread sessions are rebuilt
+    self.generation = 0
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  def setPoolSize(self, size, host=None):
+    """
+    Set the maximum number of connections kept alive per host, for all hosts, or only for a given host (ie.
+    'example.com' or 'example.com:8080').
+    """
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=size)
+    with self.lock:
+      if host is None:
+        self.default_adapter = adapter
+      else:
+        self.host_adapters[host.lower()] = adapter
+      self.generation += 1
+
+  def getSession(self):
+    """ Return the requests.Session object of the current thread. """
+    local = self.local
+    if getattr(local, "generation", None) != self.generation:
+      session = requests.Session()
+      with self.lock:
+        for scheme in ("http", "https"):
+          session.mount("%s://" % (scheme), self.default_adapter)
+          for host, adapter in self.host_adapters.items():
+            session.mount("%s://%s/" % (scheme, host), adapter)
+        local.generation = self.generation
+      # the previous session is not closed, because it would close adapters shared with other threads
+      local.session = session
+    return local.session
+
+  def getRetryDelay(self, attempt, response=None):
+    """ Return delay in seconds before retry attempt (starting from 0), honoring a Retry-After header if any. """
+    delay = self.backoff_factor * (2 ** attempt)
+    if response is not None:
+      try:
+        delay = max(delay, float(response.headers["Retry-After"]))
+      except (KeyError, ValueError):
+        pass
+    return min(delay, self.max_backoff)
+
+  def request(self, method, url, *, kind=API, retry_counter=None, **kwargs):
+    """
+    Send a request, and return the requests.Response object, like requests.Session.request.
+
+    The default timeouts of the traffic kind are used if no timeout is passed. If retry_counter is not None, it is a
+    metrics.Counter object incremented for each retry. The response of the last attempt is returned even if it has an
+    error status.
+    """
+    kwargs.setdefault("timeout", self.timeouts[kind])
+    max_retries = self.max_retries if (method.upper() in IDEMPOTENT_METHODS) else 0
+    attempt = 0
+    while True:
+      try:
+        response = self.getSession().request(method, url, **kwargs)
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        if attempt >= max_retries:
+          raise
+        error = "%s %s" % (e.__class__.__qualname__, e)
+        delay = self.getRetryDelay(attempt)
+      else:
+        if (response.status_code not in RETRY_STATUSES) or (attempt >= max_retries):
+          return response
+        error = "HTTP status %u" % (response.status_code)
+        delay = self.getRetryDelay(attempt, response)
+        response.close()
+      attempt += 1
+      if retry_counter is not None:
+        retry_counter.inc()
+      host = urllib.parse.urlsplit(url).netloc
+      logging.getLogger().debug("Request to '%s' failed (%s), retry %u/%u in %.1fs" % (host,
+                                                                                       error,
+                                                                                       attempt,
+                                                                                       max_retries,
+                                                                                       delay))
+      time.sleep(delay)
+
+  def get(self, url, **kwargs):
+    """ Send a GET request, see request. """
+    return self.request("GET", url, **kwargs)
+
+  def head(self, url, **kwargs):
+    """ Send a HEAD request, see request. """
+    return self.request("HEAD", url, **kwargs)
@@ -0,0 +1,181 @@
+""" HLS (M3U8) master and media playlist parsing. """
+
+import urllib.parse
+
+
+class Segment:
+
+  """ Media playlist segment. """
+
+  __slots__ = ("uri", "duration", "byterange", "sequence")
+
+  def __init__(self, uri, duration=None, byterange=None, sequence=0):
+    self.uri = uri
+    self.duration = duration
+    # tuple of (length, offset) in bytes, or None if segment is the whole resource
+    self.byterange = byterange
+    self.sequence = sequence
+
+  def getRangeHeader(self, skip=0):
+    """ Return the value of the Range HTTP header to request the segment without its first skip bytes, or None. """
+    if self.byterange is not None:
+      length, offset = self.byterange
+      return "bytes=%u-%u" % (offset + skip, offset + length - 1)
+    if skip:
+      return "bytes=%u-" % (skip)
+    return None
+
+  def __repr__(self):
+    return "%s(%r, %r, %r, %r)" % (__class__.__name__, self.uri, self.duration, self.byterange, self.sequence)
+
+
+def as_segment(item):
+  """ Return a Segment object for a Segment object or an URL string. """
+  return item if isinstance(item, Segment) else Segment(item)
+
+
+class MediaPlaylist:
+
+  """ Media playlist, a sequence of Segment objects. """
+
+  def __init__(self, segments, target_duration=None, media_sequence=0, ended=False):
+    self.segments = segments
+    self.target_duration = target_duration
+    self.media_sequence = media_sequence
+    self.ended = ended
+
+  def __len__(self):
+    return len(self.segments)
+
+  def __getitem__(self, index):
+    return self.segments[index]
+
+  def getDuration(self):
+    """ Return total duration in seconds, or None if unknown. """
+    if any(segment.duration is None for segment in self.segments):
+      return None
+    return sum(segment.duration for segment in self.segments)
+
+
+class Variant:
+
+  """ Master playlist variant stream. """
+
+  __slots__ = ("uri", "bandwidth", "attributes")
+
+  def __init__(self, uri, bandwidth, attributes):
+    self.uri = uri
+    self.bandwidth = bandwidth
+    self.attributes = attributes
+
+  def getFormat(self):
+    """ Return a tuple of (codecs, resolution) attribute values identifying the stream format, None if unknown. """
+    return self.attributes.get("CODECS"), self.attributes.get("RESOLUTION")
+
+
+def parse_attributes(s):
+  """ Parse an attribute list (ie. 'BANDWIDTH=1280000,CODECS="avc1.4d401f,mp4a.40.2"') into a dict. """
+  attributes = {}
+  i = 0
+  while i < len(s):
+    key_end = s.find("=", i)
+    if key_end == -1:
+      break
+    key = s[i:key_end].strip()
+    i = key_end + 1
+    if s.startswith("\"", i):
+      value_end = s.find("\"", i + 1)
+      if value_end == -1:
+        value_end = len(s)
+      value = s[i + 1:value_end]
+      i = s.find(",", value_end)
+    else:
+      value_end = s.find(",", i)
+      if value_end == -1:
+        value_end = len(s)
+      value = s[i:value_end].strip()
+      i = value_end
+    attributes[key] = value
+    if i == -1:
+      break
+    i += 1
+  return attributes
+
+
+def iter_lines(text):
+  """ Yield stripped non empty lines of a playlist, raise ValueError if it is not a M3U8 playlist. """
+  lines = text.splitlines()
+  if (not lines) or (lines[0].strip() != "#EXTM3U"):
+    raise ValueError("Not a M3U8 playlist")
+  for line in lines[1:]:
+    line = line.strip()
+    if line:
+      yield line
+
+
+def parse_master_playlist(text, base_url=""):
+  """ Parse a master playlist, and return a list of Variant objects, with URIs resolved against base_url. """
+  variants = []
+  attributes = None
+  for line in iter_lines(text):
+    if line.startswith("#EXT-X-STREAM-INF:"):
+      attributes = parse_attributes(line[len("#EXT-X-STREAM-INF:"):])
+    elif line.startswith("#"):
+      continue
+    elif attributes is not None:
+      variants.append(Variant(urllib.parse.urljoin(base_url, line), int(attributes.get("BANDWIDTH", 0)), attributes))
+      attributes = None
+  return variants
+
+
+def parse_media_playlist(text, base_url=""):
+  """ Parse a media playlist, and return a MediaPlaylist object, with URIs resolved against base_url. """
+  segments = []
+  target_duration = None
+  media_sequence = 0
+  ended = False
+  duration = None
+  byterange = None
+  # end offset of the previous byte range, per URI
+  next_offsets = {}
+  for line in iter_lines(text):
+    if line.startswith("#EXTINF:"):
+      duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+    elif line.startswith("#EXT-X-BYTERANGE:"):
+      length, _, offset = line[len("#EXT-X-BYTERANGE:"):].partition("@")
+      byterange = (int(length), int(offset) if offset else None)
+    elif line.startswith("#EXT-X-TARGETDURATION:"):
+      target_duration = int(line[len("#EXT-X-TARGETDURATION:"):])
+    elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+      media_sequence = int(line[len("#EXT-X-MEDIA-SEQUENCE:"):])
+    elif line == "#EXT-X-ENDLIST":
+      ended = True
+    elif line.startswith("#"):
+      continue
+    else:
+      uri = urllib.parse.urljoin(base_url, line)
+      if byterange is not None:
+        length, offset = byterange
+        if offset is None:
+          offset = next_offsets.get(uri, 0)
+        byterange = (length, offset)
+        next_offsets[uri] = offset + length
+      segments.append(Segment(uri, duration, byterange, media_sequence + len(segments)))
+      duration = None
+      byterange = None
+  return MediaPlaylist(segments, target_duration, media_sequence, ended)
+
+
+def format_media_playlist(playlist, uris):
+  """ Return the text of a media playlist, from a MediaPlaylist object, with segment URIs replaced by uris. """
+  lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+  if playlist.target_duration is not None:
+    lines.append("#EXT-X-TARGETDURATION:%u" % (playlist.target_duration))
+  lines.append("#EXT-X-MEDIA-SEQUENCE:%u" % (playlist.media_sequence))
+  for segment, uri in zip(playlist, uris):
+    if segment.duration is not None:
+      lines.append("#EXTINF:%.3f," % (segment.duration))
+    lines.append(uri)
+  if playlist.ended:
+    lines.append("#EXT-X-ENDLIST")
+  return "\n".join(lines) + "\n"
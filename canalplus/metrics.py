@@ -0,0 +1,172 @@
+""" Runtime metrics (counters and histograms), exportable as JSON or in Prometheus text format. """
+
+import contextlib
+import json
+import threading
+import time
+
+
+# default histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = tuple(2 ** i for i in range(14, 28, 2))
+
+
+class Counter:
+
+  """ Monotonic counter. """
+
+  TYPE = "counter"
+
+  def __init__(self, name, help):
+    self.name = name
+    self.help = help
+    self.value = 0
+    self.lock = threading.Lock()
+
+  def inc(self, amount=1):
+    """ Increment counter. """
+    with self.lock:
+      self.value += amount
+
+  def toJson(self):
+    return self.value
+
+  def toPrometheusSamples(self):
+    """ Return a list of (sample name, value) tuples. """
+    return [(self.name, self.value)]
+
+
+class Histogram:
+
+  """ Histogram of observed values, with cumulative buckets. """
+
+  TYPE = "histogram"
+
+  def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.help = help
+    self.buckets = tuple(buckets)
+    self.bucket_counts = [0] * len(self.buckets)
+    self.count = 0
+    self.sum = 0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    """ Add an observed value. """
+    with self.lock:
+      self.count += 1
+      self.sum += value
+      for i, bucket in enumerate(self.buckets):
+        if value <= bucket:
+          self.bucket_counts[i] += 1
+          break
+
+  @contextlib.contextmanager
+  def time(self):
+    """ Context manager observing the duration of its block in seconds. """
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.observe(time.monotonic() - start)
+
+  def getCumulativeCounts(self):
+    counts = []
+    total = 0
+    for bucket_count in self.bucket_counts:
+      total += bucket_count
+      counts.append(total)
+    return counts
+
+  def toJson(self):
+    with self.lock:
+      return {"count": self.count,
+              "sum": self.sum,
+              "buckets": dict(("%g" % (bucket), count) for bucket, count in zip(self.buckets,
+                                                                                 self.getCumulativeCounts()))}
+
+  def toPrometheusSamples(self):
+    """ Return a list of (sample name, value) tuples. """
+    with self.lock:
+      samples = [("%s_bucket{le=\"%g\"}" % (self.name, bucket), count)
+                 for bucket, count in zip(self.buckets, self.getCumulativeCounts())]
+      samples.append(("%s_bucket{le=\"+Inf\"}" % (self.name), self.count))
+      samples.append(("%s_sum" % (self.name), self.sum))
+      samples.append(("%s_count" % (self.name), self.count))
+    return samples
+
+
+class Registry:
+
+  """ Set of named metrics. """
+
+  def __init__(self):
+    self.metrics = {}
+    self.lock = threading.Lock()
+
+  def register(self, metric):
+    """ Register a metric and return it, or return the already registered metric with the same name. """
+    with self.lock:
+      return self.metrics.setdefault(metric.name, metric)
+
+  def toJson(self):
+    """ Return a dict of metric name -> value. """
+    with self.lock:
+      metrics = sorted(self.metrics.values(), key=lambda x: x.name)
+    return dict((metric.name, metric.toJson()) for metric in metrics)
+
+  def toPrometheus(self):
+    """ Return metrics in Prometheus text exposition format. """
+    with self.lock:
+      metrics = sorted(self.metrics.values(), key=lambda x: x.name)
+    lines = []
+    for metric in metrics:
+      lines.append("# HELP %s %s" % (metric.name, metric.help))
+      lines.append("# TYPE %s %s" % (metric.name, metric.TYPE))
+      for sample_name, value in metric.toPrometheusSamples():
+        lines.append("%s %s" % (sample_name, value))
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help):
+  """ Get or create a counter in the default registry. """
+  return REGISTRY.register(Counter(name, help))
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+  """ Get or create a histogram in the default registry. """
+  return REGISTRY.register(Histogram(name, help, buckets))
+
+
+def dump_json(filepath, registry=REGISTRY):
+  """ Write metrics of a registry to a JSON file. """
+  with open(filepath, "wt") as f:
+    json.dump(registry.toJson(), f, indent=2, sort_keys=True)
+
+
+def start_http_server(port, address="", registry=REGISTRY):
+  """ Serve metrics of a registry in Prometheus text format over HTTP from a background thread, return the server. """
+  # imported here so that importing this module does not load http.server
+  import http.server
+  from canalplus import http_server
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      data = registry.toPrometheus().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def log_message(self, *args):
+      pass
+
+  server = http_server.create_http_server((address, port), Handler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server
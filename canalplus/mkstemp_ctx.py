@@ -19,3 +19,19 @@ def mkstemp(*args, **kwargs):
       os.remove(filename)
     except FileNotFoundError:
       pass
+
+
+@contextlib.contextmanager
+def atomic_write(filepath, mode="wb", **kwargs):
+  """
+  Context manager yielding a file object opened with mode and kwargs like open, to a temporary file in the directory of
+  filepath, which replaces filepath atomically on exit, or is removed if an exception is raised.
+  """
+  fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)), suffix=".tmp")
+  try:
+    with open(fd, mode, **kwargs) as f:
+      yield f
+    os.replace(tmp_filepath, filepath)
+  except BaseException:
+    os.remove(tmp_filepath)
+    raise
@@ -0,0 +1,92 @@
+""" Persistent index of program titles and ids, to resolve a program without fetching the full program list. """
+
+import json
+import logging
+import os
+import time
+
+from canalplus import http_cache
+from canalplus import mkstemp_ctx
+
+
+# default time in seconds after which the index is not used anymore, and the program list is fetched again
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def get_default_program_index_filepath():
+  """ Return the default program index file path, in the cache directory. """
+  return os.path.join(http_cache.get_default_cache_dir(), "programs.json")
+
+
+class ProgramIndex:
+
+  """
+  Map of casefolded program title -> (program id, program title), stored in a JSON file written atomically, of the
+  form {"timestamp": time of last update, "programs": map}.
+
+  The index is refreshed each time the program list is fetched, and is ignored once older than ttl seconds, so that
+  renamed or reassigned programs are eventually picked up.
+  """
+
+  def __init__(self, filepath=None, *, ttl=DEFAULT_TTL):
+    self.filepath = filepath if (filepath is not None) else get_default_program_index_filepath()
+    self.ttl = ttl
+    self.programs = {}
+    self.timestamp = None
+    self.load()
+
+  def load(self):
+    """ Load index file, if any. """
+    try:
+      with open(self.filepath, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+      self.programs = dict((key, tuple(value)) for key, value in data["programs"].items())
+      self.timestamp = float(data["timestamp"])
+    except FileNotFoundError:
+      pass
+    except (ValueError, TypeError, AttributeError, KeyError):
+      logging.getLogger().debug("Program index '%s' is corrupted, ignoring it" % (self.filepath))
+      self.programs = {}
+      self.timestamp = None
+
+  def isFresh(self):
+    """ Return True if the index was updated less than ttl seconds ago, False otherwise. """
+    return (self.timestamp is not None) and (0 <= time.time() - self.timestamp < self.ttl)
+
+  def get(self, title):
+    """
+    Return a tuple of (program id, program title) from a program title, or None if it is not in the index or the index
+    is stale.
+    """
+    if not self.isFresh():
+      return None
+    return self.programs.get(title.casefold())
+
+  def getTitle(self, id):
+    """ Return the title of a program from its id, or None if it is not in the index or the index is stale. """
+    if not self.isFresh():
+      return None
+    for program_id, title in self.programs.values():
+      if program_id == id:
+        return title
+    return None
+
+  def update(self, programs):
+    """ Replace index with an iterable of (program id, program title) tuples, and write it. """
+    new_programs = {}
+    for id, title in programs:
+      new_programs.setdefault(title.casefold(), (id, title))
+    self.programs = new_programs
+    self.timestamp = time.time()
+    self.save()
+
+  def discard(self, id):
+    """ Remove a program from the index, ie. because its id is no longer valid, and write it. """
+    self.programs = dict((key, value) for key, value in self.programs.items() if value[0] != id)
+    self.save()
+
+  def save(self):
+    """ Write index file atomically. """
+    os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+    with mkstemp_ctx.atomic_write(self.filepath, "wt", encoding="utf-8") as f:
+      json.dump({"timestamp": self.timestamp, "programs": self.programs}, f, sort_keys=True)
@@ -0,0 +1,162 @@
+""" Remux backend: converter detection with cached capabilities, and cheap in-process probing of TS streams. """
+
+import logging
+import shutil
+import subprocess
+import threading
+
+
+# converters in order of preference
+CONVERTER_NAMES = ("ffmpeg", "avconv")
+
+# size of the TS file head read to find stream types, PAT and PMT are repeated at least at every segment start
+PROBE_SIZE = 1024 * 1024
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+# MPEG-TS PMT stream types
+STREAM_TYPE_AAC_ADTS = 0x0f
+STREAM_TYPE_AAC_LATM = 0x11
+AUDIO_STREAM_TYPES = frozenset((0x03, 0x04, STREAM_TYPE_AAC_ADTS, STREAM_TYPE_AAC_LATM, 0x81, 0x87))
+
+
+class Converter:
+
+  """ FFmpeg or Libav converter, with its capabilities. """
+
+  def __init__(self, name, path):
+    self.name = name
+    self.path = path
+    self.bitstream_filters = self.listBitstreamFilters()
+
+  def listBitstreamFilters(self):
+    """ Return the frozenset of bitstream filter names supported by the converter, or None if unknown. """
+    try:
+      output = subprocess.check_output((self.path, "-hide_banner", "-bsfs"),
+                                       stdin=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+      return None
+    # first line is a header, ie. 'Bitstream filters:'
+    return frozenset(line.strip() for line in output.splitlines()[1:] if line.strip())
+
+  def supportsBitstreamFilter(self, name):
+    """ Return True if the converter supports a bitstream filter, assuming it does if unknown. """
+    return (self.bitstream_filters is None) or (name in self.bitstream_filters)
+
+  def getBaseCmd(self):
+    # overwrite output, ie. a partial file left by an interrupted run
+    cmd = [self.path, "-y"]
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+      cmd.extend(("-loglevel", "quiet"))
+    return cmd
+
+  def getRemuxCmds(self, ts_filepath, mp4_filepath, stream_types):
+    """
+    Return the list of commands to try in order to remux a TS file to MP4, from the stream types of the file (as
+    returned by probe_ts_stream_types).
+
+    When stream types are known, there is a single command, with the right flags.
+    """
+    cmd = self.getBaseCmd()
+    cmd.extend(("-i", ts_filepath, "-c", "copy"))
+    bsf_cmd = cmd + ["-bsf:a", "aac_adtstoasc", mp4_filepath]
+    cmd.append(mp4_filepath)
+    if stream_types is None:
+      # unknown audio format, try without and with ADTS to ASC conversion
+      return [cmd, bsf_cmd]
+    if (STREAM_TYPE_AAC_ADTS in stream_types) and self.supportsBitstreamFilter("aac_adtstoasc"):
+      return [bsf_cmd]
+    return [cmd]
+
+  def getStreamRemuxCmd(self, mp4_filepath):
+    """ Return the command to remux TS data read from stdin to a MP4 file. """
+    cmd = self.getBaseCmd()
+    cmd.extend(("-f", "mpegts", "-i", "pipe:0", "-c", "copy"))
+    # the stream can not be probed before it starts, and HLS audio is ADTS AAC
+    if self.supportsBitstreamFilter("aac_adtstoasc"):
+      cmd.extend(("-bsf:a", "aac_adtstoasc"))
+    cmd.extend(("-f", "mp4", mp4_filepath))
+    return cmd
+
+
+_converter = None
+_converter_probed = False
+_converter_lock = threading.Lock()
+
+
+def get_converter():
+  """ Return the available Converter object, or None if none is available. Detection is done once per process. """
+  global _converter, _converter_probed
+  with _converter_lock:
+    if not _converter_probed:
+      for name in CONVERTER_NAMES:
+        path = shutil.which(name)
+        if path is not None:
+          _converter = Converter(name, path)
+          logging.getLogger().debug("Using converter '%s'" % (path))
+          break
+      _converter_probed = True
+    return _converter
+
+
+def parse_ts_stream_types(data):
+  """
+  Return the tuple of stream types of the first program of MPEG-TS data, from its PAT and PMT, or None if not found.
+
+  Only sections fitting in a single TS packet are parsed, which is always the case in practice for PAT and PMT of
+  single program streams.
+  """
+  start = data.find(bytes((TS_SYNC_BYTE,)))
+  if start < 0:
+    return None
+  pmt_pids = None
+  for offset in range(start, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+    packet = data[offset:offset + TS_PACKET_SIZE]
+    if packet[0] != TS_SYNC_BYTE:
+      # lost sync
+      return None
+    payload_unit_start = packet[1] & 0x40
+    pid = ((packet[1] & 0x1f) << 8) | packet[2]
+    adaptation_field_control = (packet[3] >> 4) & 0x3
+    if (not payload_unit_start) or (not (adaptation_field_control & 0x1)):
+      continue
+    if (pid != 0) and ((pmt_pids is None) or (pid not in pmt_pids)):
+      continue
+    pos = 4
+    if adaptation_field_control & 0x2:
+      pos += 1 + packet[4]
+    if pos >= TS_PACKET_SIZE:
+      continue
+    # skip pointer field
+    section = packet[pos + 1 + packet[pos]:]
+    if len(section) < 12:
+      continue
+    section_end = min(3 + (((section[1] & 0xf) << 8) | section[2]) - 4, len(section))
+    if pid == 0:
+      if section[0] != 0x00:
+        continue
+      pmt_pids = set()
+      for i in range(8, section_end - 3, 4):
+        program_number = (section[i] << 8) | section[i + 1]
+        if program_number != 0:
+          pmt_pids.add(((section[i + 2] & 0x1f) << 8) | section[i + 3])
+    else:
+      if section[0] != 0x02:
+        continue
+      stream_types = []
+      i = 12 + (((section[10] & 0xf) << 8) | section[11])
+      while i + 5 <= section_end:
+        stream_types.append(section[i])
+        i += 5 + (((section[i + 3] & 0xf) << 8) | section[i + 4])
+      return tuple(stream_types)
+  return None
+
+
+def probe_ts_stream_types(filepath):
+  """ Return the tuple of stream types of a TS file, or None if they could not be found, see parse_ts_stream_types. """
+  with open(filepath, "rb") as f:
+    data = f.read(PROBE_SIZE)
+  return parse_ts_stream_types(data)
@@ -0,0 +1,172 @@
+""" Watch mode: poll video lists periodically, and download new videos as soon as they are published. """
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from canalplus import mkstemp_ctx
+
+
+def get_default_data_dir():
+  """ Return the default data directory path, following the XDG base directory specification. """
+  data_root = os.getenv("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share"))
+  return os.path.join(data_root, "canalplus")
+
+
+class SeenVideoStore:
+
+  """
+  Persistent set of already seen video ids, per video list.
+
+  Video lists are identified by a string key, ie. 'getMEAs/104'. The store is a single JSON file, written atomically.
+  """
+
+  FILENAME = "seen.json"
+
+  def __init__(self, filepath=None):
+    if filepath is None:
+      filepath = os.path.join(get_default_data_dir(), __class__.FILENAME)
+    self.filepath = filepath
+    self.seen = {}
+    self.lock = threading.Lock()
+    self.load()
+
+  def load(self):
+    """ Load store file, if any. """
+    try:
+      with open(self.filepath, "rt") as f:
+        self.seen = dict((key, set(ids)) for key, ids in json.load(f).items())
+    except FileNotFoundError:
+      pass
+    except ValueError:
+      logging.getLogger().warning("Seen videos file '%s' is corrupted, ignoring it" % (self.filepath))
+
+  def save(self):
+    """ Write store file atomically. """
+    os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+    with self.lock:
+      data = dict((key, sorted(ids)) for key, ids in self.seen.items())
+    with mkstemp_ctx.atomic_write(self.filepath, "wt") as f:
+      json.dump(data, f, sort_keys=True)
+
+  def isKnown(self, key):
+    """ Return True if a video list was already seen, False otherwise. """
+    with self.lock:
+      return key in self.seen
+
+  def isSeen(self, key, video_id):
+    """ Return True if a video of a video list was already seen, False otherwise. """
+    with self.lock:
+      return video_id in self.seen.get(key, ())
+
+  def add(self, key, video_ids):
+    """ Mark videos of a video list as seen, and save store. """
+    with self.lock:
+      self.seen.setdefault(key, set()).update(video_ids)
+    self.save()
+
+
+def get_video_list_key(video_list):
+  """ Return the SeenVideoStore key of a CanalPlusVideoList object. """
+  return video_list.getKey()
+
+
+class Watcher:
+
+  """
+  Poll video lists at a fixed interval, and download new videos from a background thread.
+
+  Video lists are polled with CanalPlusVideoList.poll, so if an API response cache is set, an unchanged list costs a
+  conditional request with an empty response. Videos are marked as seen once downloaded successfully, so failed
+  downloads are retried at next poll. When a video list is watched for the first time, only its most recent video is
+  downloaded, the others are marked as seen.
+
+  If stop is a threading.Event object, it is set when polling is interrupted, and download_func should pass it to
+  CanalPlusVideo.download so that the running download stops before its next segment.
+  """
+
+  def __init__(self, video_lists, download_func, *, interval, store, stop=None):
+    self.video_lists = tuple(video_lists)
+    self.download_func = download_func
+    self.interval = interval
+    self.store = store
+    self.stop = stop
+    self.queue = queue.Queue()
+    # ids of videos queued or being downloaded
+    self.pending = set()
+    self.pending_lock = threading.Lock()
+
+  def run(self, *, iterations=None):
+    """
+    Poll video lists forever (or iterations times), and wait for queued downloads to finish before returning.
+
+    If interrupted, queued downloads are dropped, and the exception is raised again once the running one has returned.
+    """
+    download_thread = threading.Thread(target=self.downloadLoop)
+    download_thread.start()
+    try:
+      i = 0
+      while True:
+        for video_list in self.video_lists:
+          self.pollVideoList(video_list)
+        i += 1
+        if (iterations is not None) and (i >= iterations):
+          break
+        time.sleep(self.interval)
+    except BaseException:
+      while True:
+        try:
+          self.queue.get_nowait()
+        except queue.Empty:
+          break
+      self.queue.put(None)
+      if self.stop is not None:
+        self.stop.set()
+      download_thread.join()
+      raise
+    self.queue.put(None)
+    download_thread.join()
+
+  def pollVideoList(self, video_list):
+    """ Fetch a video list, and queue its new videos for download. """
+    try:
+      videos = list(video_list.poll())
+    except Exception as e:
+      logging.getLogger().warning("Polling '%s' failed: %s %s" % (get_video_list_key(video_list),
+                                                                  e.__class__.__qualname__,
+                                                                  e))
+      return
+    # the id of a program from the program index can change at its first fetch
+    key = get_video_list_key(video_list)
+    if not self.store.isKnown(key):
+      # first time we see this list, only get the most recent video
+      self.store.add(key, (video.id for video in videos[1:]))
+      videos = videos[:1]
+    for video in reversed(videos):
+      if self.store.isSeen(key, video.id):
+        continue
+      with self.pending_lock:
+        if video.id in self.pending:
+          continue
+        self.pending.add(video.id)
+      logging.getLogger().info("New video in '%s': '%s'" % (key, video.title))
+      self.queue.put((key, video))
+
+  def downloadLoop(self):
+    """ Download queued videos until None is queued. """
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      key, video = item
+      try:
+        if self.download_func(video):
+          self.store.add(key, (video.id,))
+      except Exception as e:
+        logging.getLogger().error("Download of '%s' failed: %s %s" % (video.title, e.__class__.__qualname__, e))
+      finally:
+        with self.pending_lock:
+          self.pending.discard(video.id)
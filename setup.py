@@ -32,7 +32,7 @@ except ImportError:
 setup(name="canalplus",
       version=version,
       author="desbma",
-      packages=find_packages(),
+      packages=find_packages(exclude=("benchmarks",)),
       entry_points={"console_scripts": ["canalplus = canalplus:cl_main"]},
       test_suite="tests",
       install_requires=requirements,
@@ -1,16 +1,1215 @@
 #!/usr/bin/env python3
 
+import contextlib
 import functools
+import hashlib
+import http.server
+import io
 import logging
 import os
 import random
 import shutil
+import sys
 import tempfile
+import threading
+import time
 import unittest
+import xml.etree.ElementTree
 
 import requests
 
 import canalplus
+import canalplus.catalog
+import canalplus.download_archive
+import canalplus.hls_proxy
+import canalplus.http_server
+import canalplus.watch
+from canalplus import remux
+
+
+@contextlib.contextmanager
+def serve_files(files, requested_paths=None, truncated=None):
+  """
+  Serve a dict of path -> bytes over HTTP on localhost, and yield the base URL.
+
+  Requested paths are appended to the requested_paths list if provided. The truncated dict of path -> count can be
+  used to close the connection in the middle of the next count responses of a path.
+  """
+  if requested_paths is None:
+    requested_paths = []
+  if truncated is None:
+    truncated = {}
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      try:
+        data = files[self.path]
+      except KeyError:
+        self.send_error(404)
+        return
+      requested_paths.append(self.path)
+      etag = "\"%s\"" % (hashlib.sha1(data).hexdigest())
+      if self.headers.get("If-None-Match") == etag:
+        self.send_response(304)
+        self.end_headers()
+        return
+      range_header = self.headers.get("Range")
+      if range_header is not None:
+        start, end = range_header.split("=", 1)[1].split("-", 1)
+        start = int(start)
+        end = int(end) if end else (len(data) - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %u-%u/%u" % (start, end, len(data)))
+        data = data[start:end + 1]
+      else:
+        self.send_response(200)
+      self.send_header("ETag", etag)
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      if self.command == "HEAD":
+        return
+      if truncated.get(self.path, 0) > 0:
+        truncated[self.path] -= 1
+        data = data[:len(data) // 2]
+        self.close_connection = True
+      self.wfile.write(data)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+      pass
+
+  server = canalplus.http_server.create_http_server(("127.0.0.1", 0), Handler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  try:
+    yield "http://127.0.0.1:%u" % (server.server_address[1])
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+FAKE_CONVERTER_SCRIPT = """#!%s
+import os
+import sys
+if "-bsfs" in sys.argv:
+  print("Bitstream filters:\\naac_adtstoasc")
+  sys.exit(0)
+dir_path = os.path.dirname(os.path.abspath(__file__))
+input_filepath = sys.argv[sys.argv.index("-i") + 1]
+with open(os.path.join(dir_path, "inputs"), "at") as f:
+  f.write("%%s\\n" %% (input_filepath))
+if input_filepath == "pipe:0":
+  data = sys.stdin.buffer.read()
+else:
+  with open(input_filepath, "rb") as f:
+    data = f.read()
+output_filepath = sys.argv[-1]
+if os.path.exists(os.path.join(dir_path, "fail")):
+  sys.exit(1)
+if os.path.exists(output_filepath) and ("-y" not in sys.argv):
+  sys.exit(1)
+with open(output_filepath, "wb") as f:
+  f.write(data)
+"""
+
+
+@contextlib.contextmanager
+def fake_converter():
+  """
+  Put a fake ffmpeg first in PATH, which copies its input to its output and refuses to overwrite it without -y, and
+  yield its directory path. The converter fails while a 'fail' file exists in it, and appends its inputs to an
+  'inputs' file in it, one per line.
+  """
+  with tempfile.TemporaryDirectory() as dir_path:
+    converter_filepath = os.path.join(dir_path, "ffmpeg")
+    with open(converter_filepath, "wt") as f:
+      f.write(FAKE_CONVERTER_SCRIPT % (sys.executable))
+    os.chmod(converter_filepath, 0o755)
+    prev_path = os.environ.get("PATH", "")
+    prev_converter = remux._converter, remux._converter_probed
+    os.environ["PATH"] = os.pathsep.join((dir_path, prev_path))
+    remux._converter, remux._converter_probed = None, False
+    try:
+      yield dir_path
+    finally:
+      os.environ["PATH"] = prev_path
+      remux._converter, remux._converter_probed = prev_converter
+
+
+def make_ts_section_packet(pid, table_id, body):
+  """ Return a MPEG-TS packet carrying a PSI section (with dummy CRC) starting in its payload. """
+  section_length = 5 + len(body) + 4
+  section = bytes((table_id, 0xb0 | (section_length >> 8), section_length & 0xff, 0, 1, 0xc1, 0, 0)) + body
+  section += b"\x00" * 4
+  payload = b"\x00" + section
+  header = bytes((0x47, 0x40 | (pid >> 8), pid & 0xff, 0x10))
+  return header + payload + b"\xff" * (188 - len(header) - len(payload))
+
+
+class TestCanalPlusOffline(unittest.TestCase):
+
+  # class attributes changed by tests, restored after each test
+  GLOBALS = ((canalplus.CanalPlusApiObject, "BASE_URL"),
+             (canalplus.CanalPlusApiObject, "cache"),
+             (canalplus.CanalPlusProgramList, "index"),
+             (canalplus.CanalPlusVideo, "quality"))
+
+  def setUp(self):
+    self.saved_globals = [(cls, name, vars(cls)[name]) for cls, name in __class__.GLOBALS]
+
+  def tearDown(self):
+    for cls, name, value in self.saved_globals:
+      setattr(cls, name, value)
+
+  def test_downloadSegmentsParallel(self):
+    """ Download segments concurrently, and check output is identical to the sequential download. """
+    files = {"/%u.ts" % (i): os.urandom(random.randint(1, 2 ** 16)) for i in range(50)}
+    video = canalplus.CanalPlusVideo(0, "test")
+    with serve_files(files) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      urls = tuple("%s/%u.ts" % (base_url, i) for i in range(len(files)))
+      expected = b"".join(files["/%u.ts" % (i)] for i in range(len(files)))
+      for workers in (1, 3, 8):
+        filepath = os.path.join(temp_dir_path, "%u.ts" % (workers))
+        stream = io.BytesIO()
+        video.download_ts(urls, filepath, None, workers=workers, stream=stream)
+        with open(filepath, "rb") as f:
+          self.assertEqual(f.read(), expected)
+        self.assertEqual(stream.getvalue(), expected)
+      with self.assertRaises(requests.exceptions.HTTPError):
+        video.download_ts(urls + ("%s/missing.ts" % (base_url),), filepath, None, workers=4)
+
+  def test_resumeDownload(self):
+    """ Interrupt a download, and check it resumes from the journal checkpoints. """
+    files = {"/%u.ts" % (i): os.urandom(random.randint(1, 2 ** 16)) for i in range(20)}
+    expected = b"".join(files["/%u.ts" % (i)] for i in range(len(files)))
+    video = canalplus.CanalPlusVideo(0, "test")
+    for workers in (1, 4):
+      missing_data = files.pop("/12.ts")
+      requested_paths = []
+      with serve_files(files, requested_paths) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+        urls = tuple("%s/%u.ts" % (base_url, i) for i in range(len(files) + 1))
+        filepath = os.path.join(temp_dir_path, "test.ts.part")
+        journal_filepath = filepath + canalplus.download_journal.DownloadJournal.SUFFIX
+        header = video.getJournalHeader(urls)
+        journal = canalplus.download_journal.DownloadJournal(journal_filepath, header)
+        with self.assertRaises(requests.exceptions.HTTPError):
+          video.download_ts(urls, filepath, None, workers=workers, journal=journal)
+        files["/12.ts"] = missing_data
+        del requested_paths[:]
+        journal = canalplus.download_journal.DownloadJournal(journal_filepath, header)
+        video.download_ts(urls, filepath, None, workers=workers, journal=journal)
+        self.assertEqual(sorted(requested_paths), sorted("/%u.ts" % (i) for i in range(12, len(files))))
+        with open(filepath, "rb") as f:
+          self.assertEqual(f.read(), expected)
+
+    # failure before anything is downloaded
+    with serve_files({}) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      canalplus.CanalPlusApiObject.BASE_URL = base_url
+      canalplus.CanalPlusApiObject.cache = None
+      self.assertFalse(video.download(temp_dir_path, resume=True, show_progress=False))
+      self.assertEqual(os.listdir(temp_dir_path), [])
+
+  def test_resumeDirectStream(self):
+    """ Resume a partially downloaded direct stream with a range request. """
+    data = os.urandom(2 ** 20)
+    video = canalplus.CanalPlusVideo(0, "test")
+    requested_paths = []
+    with serve_files({"/video.mp4": data}, requested_paths) as base_url, \
+            tempfile.TemporaryDirectory() as temp_dir_path:
+      urls = ("%s/video.mp4" % (base_url),)
+      filepath = os.path.join(temp_dir_path, "test.ts.part")
+      journal_filepath = filepath + canalplus.download_journal.DownloadJournal.SUFFIX
+      header = video.getJournalHeader(urls)
+      # simulate an interrupted download, with garbage after last checkpoint
+      with open(filepath, "wb") as f:
+        f.write(data[:300000] + os.urandom(1000))
+      with canalplus.download_journal.DownloadJournal(journal_filepath, header) as journal:
+        journal.record(0, 0, 300000, complete=False)
+      journal = canalplus.download_journal.DownloadJournal(journal_filepath, header)
+      stream = io.BytesIO()
+      video.download_ts(urls, filepath, None, journal=journal, stream=stream)
+      with open(filepath, "rb") as f:
+        self.assertEqual(f.read(), data)
+      self.assertEqual(stream.getvalue(), data)
+
+  def test_downloadVideos(self):
+    """ Download several videos concurrently, with one failing. """
+    files = {"/%u.mp4" % (i): os.urandom(random.randint(1, 2 ** 16)) for i in range(6)}
+    with serve_files(files) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      videos = []
+      for i in range(7):
+        video = canalplus.CanalPlusVideo(i, "video %u" % (i))
+        video.stream_url = "%s/%u.mp4" % (base_url, i)
+        videos.append(video)
+      succeeded, failed = canalplus.download_videos(videos, temp_dir_path, jobs=3)
+      self.assertEqual(succeeded, videos[:-1])
+      self.assertEqual(failed, videos[-1:])
+      self.assertEqual(len(os.listdir(temp_dir_path)), 6)
+
+  def test_downloadVideosInterrupted(self):
+    """ Interrupt concurrent downloads, and check running ones stop before their next segment. """
+    files = {"/%u.ts" % (i): os.urandom(1024) for i in range(10)}
+    stop = threading.Event()
+    stop.set()
+    video = canalplus.CanalPlusVideo(0, "test")
+    requested_paths = []
+    with serve_files(files, requested_paths) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      urls = tuple("%s/%u.ts" % (base_url, i) for i in range(len(files)))
+      for workers in (1, 4):
+        with self.assertRaises(canalplus.DownloadStopped):
+          video.download_ts(urls, os.path.join(temp_dir_path, "test.ts"), None, workers=workers, stop=stop)
+    self.assertLessEqual(len(requested_paths), 4 * canalplus.CanalPlusVideo.SEGMENT_WINDOW_PER_WORKER)
+
+    # a direct stream stops in the middle of its single segment
+    data = os.urandom(2 ** 20)
+    stop.clear()
+    written = []
+
+    class StopStream:
+
+      def write(self, chunk):
+        written.append(len(chunk))
+        stop.set()
+
+    with serve_files({"/video.mp4": data}) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      filepath = os.path.join(temp_dir_path, "test.ts")
+      with self.assertRaises(canalplus.DownloadStopped):
+        video.download_ts(("%s/video.mp4" % (base_url),), filepath, None, stream=StopStream(), stop=stop)
+    self.assertLess(sum(written), len(data))
+
+    started = threading.Event()
+    stopped = []
+
+    class StoppableVideo:
+
+      def __init__(self, title, interrupt=False):
+        self.title = title
+        self.interrupt = interrupt
+
+      def download(self, dir, *, stop, **kwargs):
+        if self.interrupt:
+          started.wait(10)
+          raise KeyboardInterrupt()
+        started.set()
+        # a running download only returns once stopped
+        stopped.append(stop.wait(10))
+        return False
+
+    start = time.monotonic()
+    with self.assertRaises(KeyboardInterrupt):
+      canalplus.download_videos((StoppableVideo("interrupted", interrupt=True), StoppableVideo("running")),
+                                None,
+                                jobs=2,
+                                remux_workers=0)
+    self.assertEqual(stopped, [True])
+    self.assertLess(time.monotonic() - start, 10)
+
+  def test_stagedDownload(self):
+    """ Download to a staging directory with preallocation, and check the file is moved to the output directory. """
+    files = {"/%u.ts" % (i): os.urandom(random.randint(1, 2 ** 16)) for i in range(5)}
+    expected = b"".join(files["/%u.ts" % (i)] for i in range(len(files)))
+    video = canalplus.CanalPlusVideo(0, "test")
+    with serve_files(files) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      urls = tuple("%s/%u.ts" % (base_url, i) for i in range(len(files)))
+      # preallocated space beyond actual data (overestimated sizes) is dropped
+      for workers in (1, 3):
+        filepath = os.path.join(temp_dir_path, "%u.ts" % (workers))
+        video.download_ts(urls, filepath, None, workers=workers, sizes=[len(expected)] * len(urls))
+        with open(filepath, "rb") as f:
+          self.assertEqual(f.read(), expected)
+
+      with open(os.path.join(temp_dir_path, "prealloc"), "wb") as f:
+        preallocated = canalplus.preallocate_file(f, 12345)
+        if preallocated:
+          self.assertEqual(os.fstat(f.fileno()).st_size, 12345)
+
+      # a direct stream is preallocated once its size is known from the response
+      data = os.urandom(2 ** 18)
+      filepath = os.path.join(temp_dir_path, "direct.ts")
+      file_sizes = []
+
+      class FileSizeStream:
+
+        def write(self, chunk):
+          file_sizes.append(os.path.getsize(filepath))
+
+      with serve_files({"/video.mp4": data}) as direct_base_url:
+        video.download_ts(("%s/video.mp4" % (direct_base_url),), filepath, None, stream=FileSizeStream())
+      self.assertEqual(file_sizes[0], len(data) if preallocated else 0)
+      with open(filepath, "rb") as f:
+        self.assertEqual(f.read(), data)
+
+      output_dir_path = os.path.join(temp_dir_path, "output")
+      staging_dir_path = os.path.join(temp_dir_path, "staging")
+      os.mkdir(output_dir_path)
+      os.mkdir(staging_dir_path)
+      # random data can not be remuxed, the TS file is kept
+      video.stream_url = "%s/0.ts" % (base_url)
+      self.assertTrue(video.download(output_dir_path,
+                                     show_progress=False,
+                                     compute_size=True,
+                                     staging_dir=staging_dir_path))
+      self.assertEqual(os.listdir(output_dir_path), ["test.ts"])
+      self.assertEqual(os.listdir(staging_dir_path), [])
+      with open(os.path.join(output_dir_path, "test.ts"), "rb") as f:
+        self.assertEqual(f.read(), files["/0.ts"])
+
+      # resumable partial downloads are kept in the staging directory too
+      os.remove(os.path.join(output_dir_path, "test.ts"))
+      video.stream_url = "%s/missing.ts" % (base_url)
+      self.assertFalse(video.download(output_dir_path, show_progress=False, resume=True, staging_dir=staging_dir_path))
+      self.assertEqual(os.listdir(output_dir_path), [])
+      self.assertIn("test.ts.part", os.listdir(staging_dir_path))
+      video.stream_url = "%s/1.ts" % (base_url)
+      self.assertTrue(video.download(output_dir_path, show_progress=False, resume=True, staging_dir=staging_dir_path))
+      self.assertEqual(os.listdir(output_dir_path), ["test.ts"])
+      self.assertEqual(os.listdir(staging_dir_path), [])
+      with open(os.path.join(output_dir_path, "test.ts"), "rb") as f:
+        self.assertEqual(f.read(), files["/1.ts"])
+
+  def test_httpCache(self):
+    """ Fetch text with a cache, and check fresh entries are reused, stale ones revalidated, and old ones evicted. """
+    files = {"/%u.xml" % (i): ("<doc>%u</doc>" % (i)).encode("utf-8") for i in range(20)}
+    requested_paths = []
+    api_object = canalplus.CanalPlusApiObject()
+    with serve_files(files, requested_paths) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      cache = canalplus.http_cache.HttpCache(temp_dir_path, max_size=2 ** 20)
+      canalplus.CanalPlusApiObject.cache = cache
+      url = "%s/0.xml" % (base_url)
+      for ttl in (3600, 3600, 0):
+        self.assertEqual(api_object.fetchText(url, ttl=ttl), "<doc>0</doc>")
+      self.assertEqual(requested_paths, ["/0.xml", "/0.xml"])
+      self.assertIsNotNone(cache.get(url))
+      self.assertIsNone(cache.get("%s/1.xml" % (base_url)))
+      # no caching without ttl
+      api_object.fetchText("%s/1.xml" % (base_url))
+      self.assertIsNone(cache.get("%s/1.xml" % (base_url)))
+      # eviction
+      cache.max_size = 5 * os.path.getsize(cache.getEntryFilepath(url))
+      for i in range(1, len(files)):
+        api_object.fetchText("%s/%u.xml" % (base_url, i), ttl=3600)
+      self.assertLessEqual(len(tuple(filter(lambda x: x.endswith(cache.ENTRY_SUFFIX), os.listdir(temp_dir_path)))),
+                           5)
+      self.assertIsNone(cache.get(url))
+      self.assertIsNotNone(cache.get("%s/%u.xml" % (base_url, len(files) - 1)))
+
+  def test_videoList(self):
+    """ Parse a video list, and check length, indexing and iteration. """
+    xml_text = ("<MEAS>"
+                "<MEA><ID>1</ID><INFOS><TITRAGE><TITRE>A</TITRE><SOUS_TITRE>sub</SOUS_TITRE></TITRAGE></INFOS></MEA>"
+                "<MEA><ID>2</ID><INFOS><TITRAGE><TITRE>B</TITRE><SOUS_TITRE></SOUS_TITRE></TITRAGE></INFOS></MEA>"
+                "</MEAS>")
+    program = canalplus.CanalPlusProgram(0, "test")
+    program.parseVidlist(xml.etree.ElementTree.fromstring(xml_text))
+    self.assertTrue(program)
+    self.assertEqual(len(program), 2)
+    self.assertEqual([(v.id, v.title) for v in program], [(1, "A (sub)"), (2, "B")])
+    self.assertEqual(program[-1].id, 2)
+    self.assertEqual(program[0].title, "A (sub)")
+    program.parseVidlist(xml.etree.ElementTree.fromstring("<MEAS/>"))
+    self.assertFalse(program)
+
+  def test_programList(self):
+    """ Parse a program list, and check lookups by name and index. """
+    xml_text = ("<INIT_PLAYER><THEMATIQUES>"
+                "<THEMATIQUE><SELECTIONS>"
+                "<SELECTION><ID>10</ID><NOM>Groland</NOM></SELECTION>"
+                "<SELECTION><ID>20</ID><NOM>LES GUIGNOLS</NOM></SELECTION>"
+                "</SELECTIONS></THEMATIQUE>"
+                "<THEMATIQUE><SELECTIONS>"
+                "<SELECTION><ID>20</ID><NOM>LES GUIGNOLS</NOM></SELECTION>"
+                "<SELECTION><ID>30</ID><NOM>Straße</NOM></SELECTION>"
+                "</SELECTIONS></THEMATIQUE>"
+                "</THEMATIQUES></INIT_PLAYER>")
+    programs = canalplus.CanalPlusProgramList.__new__(canalplus.CanalPlusProgramList)
+    programs.parseProgramList(xml.etree.ElementTree.fromstring(xml_text))
+    self.assertEqual(len(programs), 3)
+    self.assertIn("les guignols", programs)
+    self.assertIn("STRASSE", programs)
+    self.assertNotIn("guignols", programs)
+    self.assertEqual(programs["groland"].id, 10)
+    self.assertIsNone(programs["unknown"])
+    self.assertEqual(programs[1].title, "LES GUIGNOLS")
+    self.assertEqual(programs[-1].id, 30)
+    self.assertEqual([p.id for p in programs], [10, 20, 30])
+    resolved = programs.resolve(("Groland", "unknown", "straße"))
+    self.assertEqual([p.id if (p is not None) else None for p in resolved], [10, None, 30])
+
+  def test_findPrograms(self):
+    """ Resolve programs by name or id, fetching the program list only when they are not in the program index. """
+    xml_text = ("<INIT_PLAYER><THEMATIQUES><THEMATIQUE><SELECTIONS>"
+                "<SELECTION><ID>10</ID><NOM>Groland</NOM></SELECTION>"
+                "<SELECTION><ID>20</ID><NOM>LES GUIGNOLS</NOM></SELECTION>"
+                "</SELECTIONS></THEMATIQUE></THEMATIQUES></INIT_PLAYER>")
+    files = {"/initPlayer/cplus/": xml_text.encode("utf-8"),
+             "/getMEAs/cplus/10": b"<MEAS></MEAS>",
+             "/getMEAs/cplus/20": b"<MEAS></MEAS>"}
+    requested_paths = []
+    with serve_files(files, requested_paths) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      index_filepath = os.path.join(temp_dir_path, "programs.json")
+      canalplus.CanalPlusApiObject.BASE_URL = base_url
+      canalplus.CanalPlusProgramList.index = canalplus.program_index.ProgramIndex(index_filepath)
+      # numeric id, without index entry
+      program, = canalplus.find_programs(("20",))
+      self.assertEqual((program.id, program.title), (20, "20"))
+      self.assertEqual(requested_paths, [])
+      # cold index
+      programs = canalplus.find_programs(("groland", "unknown"))
+      self.assertEqual(programs[0].id, 10)
+      self.assertIsNone(programs[1])
+      self.assertEqual(requested_paths.count("/initPlayer/cplus/"), 1)
+      # warm index, reloaded from disk
+      canalplus.CanalPlusProgramList.index = canalplus.program_index.ProgramIndex(index_filepath)
+      del requested_paths[:]
+      programs = canalplus.find_programs(("les guignols", "GROLAND", "10"))
+      self.assertEqual([(p.id, p.title) for p in programs], [(20, "LES GUIGNOLS"), (10, "Groland"), (10, "Groland")])
+      # program ids from the index are only checked when their video list is fetched
+      self.assertEqual(requested_paths, [])
+      # stale index
+      canalplus.CanalPlusProgramList.index = canalplus.program_index.ProgramIndex(index_filepath, ttl=0)
+      self.assertEqual(canalplus.find_programs(("groland",))[0].id, 10)
+      self.assertEqual(requested_paths.count("/initPlayer/cplus/"), 1)
+      # program id reassigned, index entry is dropped and program list is fetched again
+      canalplus.CanalPlusProgramList.index = canalplus.program_index.ProgramIndex(index_filepath)
+      files["/initPlayer/cplus/"] = xml_text.replace("<ID>10</ID>", "<ID>30</ID>").encode("utf-8")
+      files["/getMEAs/cplus/30"] = files.pop("/getMEAs/cplus/10")
+      program, = canalplus.find_programs(("groland",))
+      self.assertEqual(list(program), [])
+      self.assertEqual(program.id, 30)
+      self.assertEqual(requested_paths.count("/initPlayer/cplus/"), 2)
+      self.assertEqual(canalplus.CanalPlusProgramList.index.get("groland"), (30, "Groland"))
+
+  def test_batch(self):
+    """ Resolve batch entries to a deduplicated list of videos. """
+    def make_vidlist(root_tag, video_tag, ids):
+      videos = "".join("<%s><ID>%u</ID><INFOS><TITRAGE><TITRE>Title %u</TITRE></TITRAGE></INFOS></%s>" %
+                       (video_tag, i, i, video_tag) for i in ids)
+      return ("<%s>%s</%s>" % (root_tag, videos, root_tag)).encode("utf-8")
+    files = {"/initPlayer/cplus/": ("<INIT_PLAYER><THEMATIQUES><THEMATIQUE><SELECTIONS>"
+                                    "<SELECTION><ID>10</ID><NOM>Groland</NOM></SELECTION>"
+                                    "</SELECTIONS></THEMATIQUE></THEMATIQUES></INIT_PLAYER>").encode("utf-8"),
+             "/getMEAs/cplus/10": make_vidlist("MEAS", "MEA", (3, 2, 1)),
+             "/getMEAs/cplus/20": make_vidlist("MEAS", "MEA", (4, 3)),
+             "/search/cplus/zapping+du+jour": make_vidlist("VIDEOS", "VIDEO", (5, 2)),
+             "/getVideos/cplus/7": ("<VIDEOS><VIDEO><ID>7</ID><INFOS><TITRAGE><TITRE>Raw</TITRE>"
+                                    "<SOUS_TITRE>Sub</SOUS_TITRE></TITRAGE></INFOS>"
+                                    "<MEDIA><VIDEOS><HD>http://example.com/7.mp4</HD></VIDEOS></MEDIA>"
+                                    "</VIDEO></VIDEOS>").encode("utf-8")}
+    entries = canalplus.read_batch_entries(io.StringIO("# programs\n"
+                                                       "groland\n"
+                                                       "  20  \n"
+                                                       "\n"
+                                                       "?zapping du jour\n"
+                                                       "video:7\n"
+                                                       "video:3\n"
+                                                       "unknown\n"
+                                                       "video:x\n"
+                                                       "video:8\n"))
+    self.assertEqual(entries, ["groland", "20", "?zapping du jour", "video:7", "video:3", "unknown", "video:x",
+                               "video:8"])
+    requested_paths = []
+    with serve_files(files, requested_paths) as base_url:
+      canalplus.CanalPlusApiObject.BASE_URL = base_url
+      videos, failed = canalplus.resolve_batch(entries)
+      self.assertEqual([v.id for v in videos], [3, 2, 1, 4, 5, 7])
+      self.assertEqual(videos[-1].title, "Raw (Sub)")
+      self.assertEqual(videos[-1].stream_url, "http://example.com/7.mp4")
+      self.assertEqual(failed, ["unknown", "video:x", "video:8"])
+      self.assertEqual(requested_paths.count("/initPlayer/cplus/"), 1)
+      videos, failed = canalplus.resolve_batch(entries[:4], last_only=True)
+      self.assertEqual([v.id for v in videos], [3, 4, 5, 7])
+      self.assertEqual(failed, [])
+
+  def test_streamVideoList(self):
+    """ Stream a video list, with and without cache. """
+    xml_text = "<MEAS>%s</MEAS>" % ("".join("<MEA><ID>%u</ID><INFOS><TITRAGE><TITRE>Title %u</TITRE>"
+                                            "<SOUS_TITRE/></TITRAGE></INFOS><MEA><ID>0</ID></MEA></MEA>" % (i, i)
+                                            for i in range(1, 1001)))
+    requested_paths = []
+    with serve_files({"/getMEAs/cplus/5": xml_text.encode("utf-8")}, requested_paths) as base_url, \
+            tempfile.TemporaryDirectory() as temp_dir_path:
+      for cache in (None, canalplus.http_cache.HttpCache(temp_dir_path)):
+        canalplus.CanalPlusApiObject.cache = cache
+        # stop after first video
+        program = canalplus.CanalPlusProgram(5, "test")
+        program.BASE_URL = base_url
+        videos = iter(program)
+        self.assertEqual(next(videos).id, 1)
+        videos.close()
+        self.assertIsNone(program.videos)
+        # full list
+        self.assertEqual([v.id for v in program], list(range(1, 1001)))
+        self.assertEqual(len(program), 1000)
+        self.assertEqual(program[-1].title, "Title 1000")
+        program = canalplus.CanalPlusProgram(5, "test")
+        program.BASE_URL = base_url
+        self.assertEqual(len(program), 1000)
+      # 3 requests without cache, 2 with cache (the interrupted one is not cached)
+      self.assertEqual(len(requested_paths), 5)
+
+  @unittest.skipIf(sys.version_info < (3, 5), "asyncio API requires Python >= 3.5")
+  def test_asyncClient(self):
+    """ Download a video and get a video list with the asyncio API, and compare with the synchronous API. """
+    import asyncio
+    import canalplus.aio
+    files = {"/%u.ts" % (i): os.urandom(random.randint(1, 2 ** 16)) for i in range(30)}
+    files["/getMEAs/cplus/5"] = ("<MEAS>%s</MEAS>" %
+                                 ("".join("<MEA><ID>%u</ID><INFOS><TITRAGE><TITRE>Title %u</TITRE></TITRAGE></INFOS>"
+                                          "</MEA>" % (i, i) for i in range(100)))).encode("utf-8")
+    loop = asyncio.new_event_loop()
+    with serve_files(files) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      files["/video.m3u8"] = ("#EXTM3U\n%s" % ("".join("#EXTINF:10,\n%s/%u.ts\n" % (base_url, i)
+                                                        for i in range(30)))).encode("utf-8")
+      client = canalplus.aio.AsyncCanalPlusClient(max_concurrency=4)
+      try:
+        program = canalplus.CanalPlusProgram(5, "test")
+        program.BASE_URL = base_url
+        videos = loop.run_until_complete(client.fetchVidlist(program))
+        self.assertEqual([(v.id, v.title) for v in videos], [(v.id, v.title) for v in program])
+        self.assertEqual(len(videos), 100)
+        # the client has its own connection pool
+        self.assertIs(videos[0].getTransport(), client.transport)
+        self.assertIsNot(client.transport, canalplus.CanalPlusApiObject.transport)
+        for download_func in (lambda v, d: loop.run_until_complete(client.download(v, d)),
+                              canalplus.CanalPlusVideo.download):
+          output_dir_path = tempfile.mkdtemp(dir=temp_dir_path)
+          video = canalplus.CanalPlusVideo(0, "video")
+          video.stream_url = "%s/video.m3u8" % (base_url)
+          self.assertTrue(download_func(video, output_dir_path))
+          with open(os.path.join(output_dir_path, "video.ts"), "rb") as f:
+            self.assertEqual(f.read(), b"".join(files["/%u.ts" % (i)] for i in range(30)))
+        # the client can be used from another event loop
+        loop.close()
+        loop = asyncio.new_event_loop()
+        video = canalplus.CanalPlusVideo(0, "video")
+        urls = ["%s/%u.ts" % (base_url, i) for i in range(30)]
+        filepath = os.path.join(temp_dir_path, "segments.ts")
+        loop.run_until_complete(client.downloadSegments(video, urls, filepath, window=3))
+        with open(filepath, "rb") as f:
+          self.assertEqual(f.read(), b"".join(files["/%u.ts" % (i)] for i in range(30)))
+        # cancellation
+        task = loop.create_task(client.downloadSegments(video, urls, os.path.join(temp_dir_path, "cancelled.ts")))
+        loop.call_soon(task.cancel)
+        with self.assertRaises(asyncio.CancelledError):
+          loop.run_until_complete(task)
+      finally:
+        client.close()
+        loop.close()
+
+  def test_metrics(self):
+    """ Update metrics, and check JSON and Prometheus exports. """
+    registry = canalplus.metrics.Registry()
+    counter = registry.register(canalplus.metrics.Counter("test_total", "Test counter"))
+    self.assertIs(registry.register(canalplus.metrics.Counter("test_total", "Test counter")), counter)
+    histogram = registry.register(canalplus.metrics.Histogram("test_seconds", "Test histogram", (0.1, 1)))
+    counter.inc()
+    counter.inc(2)
+    for value in (0.05, 0.5, 0.7, 5):
+      histogram.observe(value)
+    self.assertEqual(registry.toJson(),
+                     {"test_total": 3,
+                      "test_seconds": {"count": 4, "sum": 6.25, "buckets": {"0.1": 1, "1": 3}}})
+    self.assertEqual(registry.toPrometheus(),
+                     "# HELP test_seconds Test histogram\n"
+                     "# TYPE test_seconds histogram\n"
+                     "test_seconds_bucket{le=\"0.1\"} 1\n"
+                     "test_seconds_bucket{le=\"1\"} 3\n"
+                     "test_seconds_bucket{le=\"+Inf\"} 4\n"
+                     "test_seconds_sum 6.25\n"
+                     "test_seconds_count 4\n"
+                     "# HELP test_total Test counter\n"
+                     "# TYPE test_total counter\n"
+                     "test_total 3\n")
+
+  def test_variantSelection(self):
+    """ Select variants according to quality policy, and switch to a lower variant when throughput drops. """
+    files = {}
+    with serve_files(files) as base_url:
+      master_playlist = "#EXTM3U\n"
+      for bitrate in (500000, 2000000, 1000000):
+        master_playlist += "#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%u\n%s/%u.m3u8\n" % (bitrate, base_url, bitrate)
+        files["/%u.m3u8" % (bitrate)] = ("#EXTM3U\n%s" % ("".join("#EXTINF:10,\n%s/%u_%u.ts\n" % (base_url, bitrate, i)
+                                                                 for i in range(5)))).encode("utf-8")
+        for i in range(5):
+          files["/%u_%u.ts" % (bitrate, i)] = b"\0" * 1000
+      video = canalplus.CanalPlusVideo(0, "test")
+      self.assertEqual(video.getPlaylistBestQuality(master_playlist), "%s/2000000.m3u8" % (base_url))
+      video.variants = video.getPlaylistVariants(master_playlist)
+      self.assertEqual([v[0] for v in video.variants], [2000000, 1000000, 500000])
+      for quality, expected_bitrate in ((canalplus.QUALITY_MAX, 2000000),
+                                        (1500000, 1000000),
+                                        (1000000, 1000000),
+                                        (100, 500000)):
+        video.quality = quality
+        self.assertEqual(video.variants[video.selectVariant()][0], expected_bitrate)
+      video.quality = canalplus.QUALITY_AUTO
+      video.stream_url = video.variants[0][1]
+      urls = video.getSegmentUrls()
+      self.assertIsInstance(urls, canalplus.AdaptiveSegmentUrls)
+      self.assertEqual(urls[4].uri, "%s/2000000_4.ts" % (base_url))
+      # fast enough
+      for i in range(3):
+        urls.addSample(i, i + 1, 1000000)
+      self.assertEqual(urls[4].uri, "%s/2000000_4.ts" % (base_url))
+      # throughput drop
+      for i in range(3):
+        urls.addSample(i, i + 1, 100000)
+      self.assertEqual(urls[4].uri, "%s/1000000_4.ts" % (base_url))
+      self.assertEqual(video.stream_url, "%s/1000000.m3u8" % (base_url))
+      # only switch to a variant with the same format
+      video.variants = [(bitrate, url, ("avc1", "960x540" if (bitrate == 1000000) else "1280x720"))
+                        for bitrate, url, _ in video.variants]
+      video.stream_url = video.variants[0][1]
+      urls = video.getSegmentUrls()
+      for i in range(3):
+        urls.addSample(i, i + 1, 100000)
+      self.assertEqual(urls[4].uri, "%s/500000_4.ts" % (base_url))
+      # no lower variant left
+      for i in range(3):
+        urls.addSample(i, i + 1, 1000)
+      self.assertEqual(urls[4].uri, "%s/500000_4.ts" % (base_url))
+
+  def test_m3u8(self):
+    """ Parse master and media playlists, and plan a download. """
+    master_playlist = ("#EXTM3U\n"
+                       "#EXT-X-STREAM-INF:BANDWIDTH=1280000,CODECS=\"avc1.4d401f,mp4a.40.2\",RESOLUTION=640x360\n"
+                       "low/index.m3u8\n"
+                       "#EXT-X-STREAM-INF:BANDWIDTH=2560000\n"
+                       "http://other.example.com/high/index.m3u8\n")
+    variants = canalplus.m3u8.parse_master_playlist(master_playlist, "http://example.com/hls/master.m3u8")
+    self.assertEqual([(v.bandwidth, v.uri) for v in variants],
+                     [(1280000, "http://example.com/hls/low/index.m3u8"),
+                      (2560000, "http://other.example.com/high/index.m3u8")])
+    self.assertEqual(variants[0].attributes["CODECS"], "avc1.4d401f,mp4a.40.2")
+    self.assertEqual(variants[0].attributes["RESOLUTION"], "640x360")
+    self.assertEqual(variants[0].getFormat(), ("avc1.4d401f,mp4a.40.2", "640x360"))
+    with self.assertRaises(ValueError):
+      canalplus.m3u8.parse_media_playlist("<html></html>")
+
+    files = {"/all.ts": bytes(range(250)) * 4}
+    with serve_files(files) as base_url:
+      media_playlist = ("#EXTM3U\n"
+                        "#EXT-X-TARGETDURATION:10\n"
+                        "#EXT-X-MEDIA-SEQUENCE:7\n"
+                        "#EXTINF:10.0,\n"
+                        "#EXT-X-BYTERANGE:600@0\n"
+                        "all.ts\n"
+                        "#EXTINF:5.5,\n"
+                        "#EXT-X-BYTERANGE:400\n"
+                        "all.ts\n"
+                        "#EXT-X-ENDLIST\n")
+      playlist = canalplus.m3u8.parse_media_playlist(media_playlist, "%s/index.m3u8" % (base_url))
+      self.assertEqual(len(playlist), 2)
+      self.assertEqual((playlist.target_duration, playlist.media_sequence, playlist.ended), (10, 7, True))
+      self.assertEqual(playlist.getDuration(), 15.5)
+      self.assertEqual([(s.uri, s.byterange, s.sequence) for s in playlist],
+                       [("%s/all.ts" % (base_url), (600, 0), 7), ("%s/all.ts" % (base_url), (400, 600), 8)])
+      self.assertEqual(playlist[1].getRangeHeader(100), "bytes=700-999")
+
+      video = canalplus.CanalPlusVideo(0, "test")
+      self.assertEqual(video.fetchSegmentSizes(playlist), [600, 400])
+      self.assertEqual(video.fetchSegmentSizes(("%s/all.ts" % (base_url), "%s/missing.ts" % (base_url))), [1000, None])
+      weights = canalplus.SegmentProgressWeights(playlist, (600, 400))
+      self.assertEqual(weights.getProgress(0, 0.5), 30)
+      self.assertEqual(weights.getProgress(1, 1), 100)
+      with tempfile.TemporaryDirectory() as temp_dir_path:
+        filepath = os.path.join(temp_dir_path, "test.ts")
+        video.download_ts(playlist, filepath, None)
+        with open(filepath, "rb") as f:
+          self.assertEqual(f.read(), files["/all.ts"])
+
+  def test_watch(self):
+    """ Poll a program several times, and check only new videos are downloaded. """
+    def make_vidlist(ids):
+      return ("<MEAS>%s</MEAS>" % ("".join("<MEA><ID>%u</ID><INFOS><TITRAGE><TITRE>Title %u</TITRE></TITRAGE></INFOS>"
+                                           "</MEA>" % (i, i) for i in ids))).encode("utf-8")
+    files = {"/getMEAs/cplus/5": make_vidlist((3, 2, 1))}
+    downloaded = []
+
+    def download(video):
+      downloaded.append(video.id)
+      # fail once
+      return (video.id != 5) or (downloaded.count(5) > 1)
+
+    with serve_files(files) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      canalplus.CanalPlusApiObject.cache = canalplus.http_cache.HttpCache(temp_dir_path)
+      program = canalplus.CanalPlusProgram(5, "test")
+      program.BASE_URL = base_url
+      store_filepath = os.path.join(temp_dir_path, "seen", "seen.json")
+      watcher = canalplus.watch.Watcher((program,),
+                                        download,
+                                        interval=0,
+                                        store=canalplus.watch.SeenVideoStore(store_filepath))
+      # first poll, only most recent video
+      watcher.run(iterations=1)
+      self.assertEqual(downloaded, [3])
+      # unchanged list
+      watcher.run(iterations=2)
+      self.assertEqual(downloaded, [3])
+      # new videos
+      files["/getMEAs/cplus/5"] = make_vidlist((5, 4, 3, 2, 1))
+      watcher.run(iterations=1)
+      self.assertEqual(downloaded, [3, 4, 5])
+      # failed download is retried, with a new store loaded from disk
+      watcher = canalplus.watch.Watcher((program,),
+                                        download,
+                                        interval=0,
+                                        store=canalplus.watch.SeenVideoStore(store_filepath))
+      watcher.run(iterations=2)
+      self.assertEqual(downloaded, [3, 4, 5, 5])
+      self.assertEqual(canalplus.watch.get_video_list_key(program), "getMEAs/5")
+      catalog_search = canalplus.CanalPlusCatalogSearch("test", None)
+      self.assertEqual(canalplus.watch.get_video_list_key(catalog_search), "catalog/test")
+
+      # interrupted while downloading, the running download is stopped before returning
+      stop = threading.Event()
+      started = threading.Event()
+      stopped = []
+
+      class InterruptedProgram(canalplus.CanalPlusProgram):
+
+        def poll(self):
+          if started.is_set():
+            raise KeyboardInterrupt()
+          return iter((canalplus.CanalPlusVideo(7, "Title 7"), canalplus.CanalPlusVideo(6, "Title 6")))
+
+      def stoppable_download(video):
+        started.set()
+        stopped.append(stop.wait(10))
+        return False
+
+      watcher = canalplus.watch.Watcher((InterruptedProgram(6, "test"),),
+                                        stoppable_download,
+                                        interval=0.1,
+                                        store=canalplus.watch.SeenVideoStore(store_filepath),
+                                        stop=stop)
+      with self.assertRaises(KeyboardInterrupt):
+        watcher.run()
+      self.assertEqual(stopped, [True])
+
+  def test_catalog(self):
+    """ Index programs in a local catalog, update it incrementally, and search it. """
+    def make_vidlist(videos):
+      return ("<MEAS>%s</MEAS>" % ("".join("<MEA><ID>%u</ID><INFOS><TITRAGE><TITRE>%s</TITRE>"
+                                           "<SOUS_TITRE>%s</SOUS_TITRE></TITRAGE></INFOS></MEA>" % video
+                                           for video in videos))).encode("utf-8")
+    files = {"/getMEAs/cplus/10": make_vidlist(((3, "Le Zapping", "Mardi"), (2, "Le Zapping", "Lundi"))),
+             "/getMEAs/cplus/20": make_vidlist(((12, "Les Guignols", "Émission spéciale"),))}
+    with serve_files(files) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      programs = [canalplus.CanalPlusProgram(10, "Zapping"), canalplus.CanalPlusProgram(20, "Guignols de l'info")]
+      for program in programs:
+        program.BASE_URL = base_url
+      with canalplus.catalog.Catalog(os.path.join(temp_dir_path, "catalog.sqlite")) as catalog:
+        self.assertEqual(canalplus.update_catalog(catalog, programs), (3, 0))
+        self.assertEqual(catalog.getProgramIds(), {10, 20})
+        self.assertEqual([v.id for v in catalog.search("zapp")], [3, 2])
+        self.assertEqual([v.id for v in catalog.search("ZAPPING lundi")], [2])
+        self.assertEqual([v.id for v in catalog.search("speciale")], [12])
+        self.assertEqual([v.program_title for v in catalog.search("info")], ["Guignols de l'info"])
+        self.assertEqual(catalog.search("and or not"), [])
+        self.assertEqual(catalog.search("?!"), [])
+        # incremental update
+        files["/getMEAs/cplus/10"] = make_vidlist(((4, "Le Zapping", "Mercredi"), (3, "Le Zapping", "Mardi")))
+        self.assertEqual(canalplus.update_catalog(catalog, programs), (1, 1))
+        self.assertEqual([v.id for v in catalog.search("zapping")], [4, 3])
+        # removed program
+        self.assertEqual(canalplus.update_catalog(catalog, programs[:1]), (0, 0))
+        self.assertEqual(catalog.search("guignols"), [])
+        search = canalplus.CanalPlusCatalogSearch("mercredi", catalog)
+        self.assertEqual([(v.id, v.title) for v in search], [(4, "Le Zapping (Mercredi)")])
+        self.assertEqual(len(search), 1)
+
+    # same video listed by two programs
+    files = {"/getMEAs/cplus/10": make_vidlist(((5, "Best of", "Janvier"), (3, "Le Zapping", "Mardi"))),
+             "/getMEAs/cplus/20": make_vidlist(((5, "Best of", "Janvier"),))}
+    with serve_files(files) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      programs = [canalplus.CanalPlusProgram(10, "Zapping"), canalplus.CanalPlusProgram(20, "Guignols de l'info")]
+      for program in programs:
+        program.BASE_URL = base_url
+      with canalplus.catalog.Catalog(os.path.join(temp_dir_path, "catalog.sqlite")) as catalog:
+        self.assertEqual(canalplus.update_catalog(catalog, programs), (3, 0))
+        # unchanged lists, nothing rewritten
+        self.assertEqual(canalplus.update_catalog(catalog, programs), (0, 0))
+        self.assertEqual([(v.id, v.program_id) for v in catalog.search("best")], [(5, 10), (5, 20)])
+        self.assertEqual([v.program_title for v in catalog.search("guignols")], ["Zapping", "Guignols de l'info"])
+        self.assertEqual([v.id for v in canalplus.CanalPlusCatalogSearch("janvier", catalog)], [5])
+        # video removed from one program only
+        files["/getMEAs/cplus/20"] = make_vidlist(())
+        self.assertEqual(canalplus.update_catalog(catalog, programs), (0, 1))
+        self.assertEqual([(v.id, v.program_id) for v in catalog.search("best")], [(5, 10)])
+        self.assertEqual(catalog.search("guignols"), [])
+        # and then from the other
+        self.assertEqual(canalplus.update_catalog(catalog, programs[1:]), (0, 0))
+        self.assertEqual(catalog.search("best"), [])
+
+  def test_resolveVideoUrls(self):
+    """ Resolve stream URLs of several videos concurrently, with a single throughput probe in automatic quality. """
+    files = {}
+    requested_paths = []
+    with serve_files(files, requested_paths) as base_url:
+      for video_id in range(1, 11):
+        files["/getVideos/cplus/%u" % (video_id)] = ("<VIDEOS><VIDEO><MEDIA><VIDEOS><HLS>%s/%u/master.m3u8</HLS>"
+                                                     "</VIDEOS></MEDIA></VIDEO></VIDEOS>" % (base_url,
+                                                                                             video_id)).encode("utf-8")
+        files["/%u/master.m3u8" % (video_id)] = ("#EXTM3U\n"
+                                                 "#EXT-X-STREAM-INF:BANDWIDTH=2000000\nhigh.m3u8\n"
+                                                 "#EXT-X-STREAM-INF:BANDWIDTH=1000\nlow.m3u8\n").encode("utf-8")
+        for variant in ("high", "low"):
+          files["/%u/%s.m3u8" % (video_id, variant)] = ("#EXTM3U\n#EXTINF:10,\n%s.ts\n" % (variant)).encode("utf-8")
+          files["/%u/%s.ts" % (video_id, variant)] = b"\0" * 1000
+      # video 11 does not exist
+      videos = [canalplus.CanalPlusVideo(video_id, "Video %u" % (video_id)) for video_id in range(1, 12)]
+      for video in videos:
+        video.BASE_URL = base_url
+      resolved = canalplus.resolve_video_urls(videos, workers=4)
+      self.assertEqual(resolved, videos)
+      self.assertEqual([v.stream_url for v in videos],
+                       ["%s/%u/high.m3u8" % (base_url, video_id) for video_id in range(1, 11)] + [None])
+      self.assertEqual(sum(path.endswith(".ts") for path in requested_paths), 0)
+      # automatic quality
+      for video in videos:
+        video.stream_url = None
+      canalplus.CanalPlusVideo.quality = canalplus.QUALITY_AUTO
+      canalplus.resolve_video_urls(videos, workers=4)
+      self.assertEqual(len(set(v.throughput for v in videos[:10])), 1)
+      self.assertEqual(sum(path.endswith(".ts") for path in requested_paths), 1)
+
+  def test_httpTransport(self):
+    """ Retry failed requests with backoff, and share connection pools between thread sessions. """
+    failures = {"/flaky": 2, "/broken": 10}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        if failures.get(self.path, 0) > 0:
+          failures[self.path] -= 1
+          self.send_error(503)
+          return
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+      def do_POST(self):
+        self.send_error(503)
+
+      def log_message(self, *args):
+        pass
+
+    server = canalplus.http_server.create_http_server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+      base_url = "http://127.0.0.1:%u" % (server.server_address[1])
+      transport = canalplus.http_transport.Transport(max_retries=3, backoff_factor=0)
+      retries = canalplus.metrics.Counter("retries", "")
+      response = transport.get("%s/flaky" % (base_url), retry_counter=retries)
+      self.assertEqual((response.status_code, response.text, retries.value), (200, "ok", 2))
+      # retry budget exceeded, last response is returned
+      response = transport.get("%s/broken" % (base_url), retry_counter=retries)
+      self.assertEqual((response.status_code, retries.value, failures["/broken"]), (503, 5, 6))
+      # no retry for non idempotent requests
+      response = transport.request("POST", "%s/flaky" % (base_url), retry_counter=retries)
+      self.assertEqual((response.status_code, retries.value), (503, 5))
+      self.assertEqual(canalplus.http_transport.Transport(max_backoff=30).getRetryDelay(10), 30)
+      # one session per thread, sharing the same pools
+      transport.setPoolSize(4, "127.0.0.1:%u" % (server.server_address[1]))
+      sessions = []
+      threads = [threading.Thread(target=lambda: sessions.append(transport.getSession())) for _ in range(2)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      self.assertIsNot(sessions[0], sessions[1])
+      self.assertIs(sessions[0].get_adapter("%s/" % (base_url)), sessions[1].get_adapter("%s/" % (base_url)))
+      self.assertIsNot(sessions[0].get_adapter("%s/" % (base_url)), sessions[0].get_adapter("http://example.com/"))
+      self.assertIs(transport.getSession(), transport.getSession())
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def test_segmentRetry(self):
+    """ Recover from connections closed in the middle of segments with range requests, within the retry budget. """
+    files = {"/%u.ts" % (i): os.urandom(random.randint(2 ** 10, 2 ** 17)) for i in range(10)}
+    expected = b"".join(files["/%u.ts" % (i)] for i in range(len(files)))
+    video = canalplus.CanalPlusVideo(0, "test")
+    with tempfile.TemporaryDirectory() as temp_dir_path:
+      filepath = os.path.join(temp_dir_path, "test.ts")
+      for workers in (1, 4):
+        truncated = {"/3.ts": 2, "/7.ts": 1}
+        requested_paths = []
+        with serve_files(files, requested_paths, truncated) as base_url:
+          urls = tuple("%s/%u.ts" % (base_url, i) for i in range(len(files)))
+          stream = io.BytesIO()
+          video.download_ts(urls, filepath, None, workers=workers, stream=stream)
+          with open(filepath, "rb") as f:
+            self.assertEqual(f.read(), expected)
+          self.assertEqual(stream.getvalue(), expected)
+          self.assertEqual(requested_paths.count("/3.ts"), 3)
+          self.assertEqual(requested_paths.count("/7.ts"), 2)
+          # retry budget exceeded
+          truncated["/5.ts"] = canalplus.CanalPlusVideo.MAX_SEGMENT_RETRIES + 1
+          with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            video.download_ts(urls, filepath, None, workers=workers)
+    self.assertEqual(canalplus.format_retries_str(0), "")
+    self.assertEqual(canalplus.format_retries_str(2), ", 2 retries")
+
+  def test_downloadArchive(self):
+    """ Skip videos already in the archive, hard link identical videos, and hash resumed downloads. """
+    data = os.urandom(2 ** 16)
+    files = {"/1.mp4": data, "/2.mp4": data}
+    requested_paths = []
+    with serve_files(files, requested_paths) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      archive = canalplus.download_archive.DownloadArchive(temp_dir_path)
+      filepaths = []
+      for video_id, title in ((1, "A"), (2, "B"), (1, "A renamed")):
+        video = canalplus.CanalPlusVideo(video_id, title)
+        video.stream_url = "%s/%u.mp4" % (base_url, video_id)
+        self.assertTrue(video.download(temp_dir_path, show_progress=False, archive=archive))
+        filepaths.append(os.path.join(temp_dir_path, archive.get(video_id)["filename"]))
+      self.assertEqual(requested_paths, ["/1.mp4", "/2.mp4"])
+      self.assertEqual(filepaths[0], filepaths[2])
+      self.assertEqual(os.stat(filepaths[0]).st_ino, os.stat(filepaths[1]).st_ino)
+      with open(filepaths[1], "rb") as f:
+        self.assertEqual(f.read(), data)
+      archive = canalplus.download_archive.DownloadArchive(temp_dir_path)
+      self.assertIn(2, archive)
+      self.assertNotIn(3, archive)
+      self.assertEqual(archive.get(1)["sha256"], hashlib.sha256(data).hexdigest())
+      # a remuxed file with the same TS content is not linked
+      mp4_filepath = os.path.join(temp_dir_path, "C.mp4")
+      with open(mp4_filepath, "wb") as f:
+        f.write(b"remuxed")
+      self.assertIsNone(archive.add(3, mp4_filepath, hashlib.sha256(data).hexdigest()))
+      self.assertNotEqual(os.stat(mp4_filepath).st_ino, os.stat(filepaths[0]).st_ino)
+      video = canalplus.CanalPlusVideo(3, "C")
+      self.assertEqual(video.getDownloadedFilepath(temp_dir_path, archive=archive), mp4_filepath)
+      video = canalplus.CanalPlusVideo(4, "C")
+      self.assertEqual(video.getDownloadedFilepath(temp_dir_path), mp4_filepath)
+      self.assertIsNone(video.getDownloadedFilepath(temp_dir_path, filenames=frozenset()))
+
+    # temporary files are not left behind when finishing a download fails
+    video = canalplus.CanalPlusVideo(0, "test")
+    with tempfile.TemporaryDirectory() as temp_dir_path:
+      archive = canalplus.download_archive.DownloadArchive(temp_dir_path)
+      tmp_filepath = os.path.join(temp_dir_path, "test.ts.part.remux")
+      ts_filepath, mp4_filepath = video.getOutputFilepaths(temp_dir_path)
+      with open(tmp_filepath, "wb") as f:
+        f.write(data)
+
+      def remux_error(*args):
+        raise OSError("remux error")
+
+      video.remuxToMp4 = remux_error
+      video.finishDownload(tmp_filepath, ts_filepath, mp4_filepath, digest=hashlib.sha256(data), archive=archive)
+      self.assertEqual(sorted(os.listdir(temp_dir_path)), sorted((archive.FILENAME, "test.ts")))
+      os.remove(ts_filepath)
+      with open(tmp_filepath, "wb") as f:
+        f.write(data)
+      with self.assertRaises(OSError):
+        video.finishDownload(tmp_filepath,
+                             os.path.join(temp_dir_path, "missing", "test.ts"),
+                             mp4_filepath,
+                             digest=hashlib.sha256(data),
+                             archive=archive)
+      self.assertEqual(os.listdir(temp_dir_path), [archive.FILENAME])
+
+    # hash of a resumed download, with a stream
+    files = {"/%u.ts" % (i): os.urandom(random.randint(1, 2 ** 16)) for i in range(10)}
+    expected = b"".join(files["/%u.ts" % (i)] for i in range(len(files)))
+    video = canalplus.CanalPlusVideo(0, "test")
+    missing_data = files.pop("/6.ts")
+    with serve_files(files) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      urls = tuple("%s/%u.ts" % (base_url, i) for i in range(len(files) + 1))
+      filepath = os.path.join(temp_dir_path, "test.ts.part")
+      journal_filepath = filepath + canalplus.download_journal.DownloadJournal.SUFFIX
+      header = video.getJournalHeader(urls)
+      journal = canalplus.download_journal.DownloadJournal(journal_filepath, header)
+      with self.assertRaises(requests.exceptions.HTTPError):
+        video.download_ts(urls, filepath, None, journal=journal, digest=hashlib.sha256())
+      files["/6.ts"] = missing_data
+      journal = canalplus.download_journal.DownloadJournal(journal_filepath, header)
+      stream = io.BytesIO()
+      digest = hashlib.sha256()
+      video.download_ts(urls, filepath, None, journal=journal, stream=stream, digest=digest)
+      self.assertEqual(stream.getvalue(), expected)
+      self.assertEqual(digest.hexdigest(), hashlib.sha256(expected).hexdigest())
+
+  def test_hlsProxy(self):
+    """ Serve a video through the local HLS proxy, and check segments are prefetched and cached. """
+    files = {"/%u.ts" % (i): os.urandom(random.randint(1, 2 ** 16)) for i in range(8)}
+    files["/index.m3u8"] = ("#EXTM3U\n#EXT-X-TARGETDURATION:10\n#EXT-X-MEDIA-SEQUENCE:3\n%s#EXT-X-ENDLIST\n" %
+                            ("".join("#EXTINF:9.5,\n%u.ts\n" % (i) for i in range(8)))).encode("utf-8")
+    requested_paths = []
+    with serve_files(files, requested_paths) as base_url, tempfile.TemporaryDirectory() as temp_dir_path:
+      video = canalplus.CanalPlusVideo(0, "test")
+      video.stream_url = "%s/index.m3u8" % (base_url)
+      # cache fits 5 segments at most
+      cache = canalplus.hls_proxy.SegmentCache(temp_dir_path, max_size=5 * 2 ** 16)
+      with canalplus.hls_proxy.HlsProxy(video, prefetch=2, cache=cache) as proxy:
+        playlist = canalplus.m3u8.parse_media_playlist(requests.get(proxy.url).text, proxy.url)
+        self.assertEqual(len(playlist), 8)
+        self.assertEqual((playlist.media_sequence, playlist.target_duration, playlist.ended), (3, 10, True))
+        self.assertEqual(playlist.getDuration(), 8 * 9.5)
+        self.assertTrue(playlist[0].uri.startswith(proxy.url.rsplit("/", 1)[0]))
+        for i in (0, 1, 0):
+          self.assertEqual(requests.get(playlist[i].uri).content, files["/%u.ts" % (i)])
+        # wait for prefetches
+        while proxy.fetching:
+          time.sleep(0.05)
+        self.assertEqual(sorted(p for p in requested_paths if p.endswith(".ts")), ["/0.ts", "/1.ts", "/2.ts", "/3.ts"])
+        self.assertEqual(requests.get(playlist[2].uri).content, files["/2.ts"])
+        self.assertEqual(requests.get(proxy.url.replace("playlist.m3u8", "segments/8.ts")).status_code, 404)
+      self.assertLessEqual(sum(os.path.getsize(os.path.join(temp_dir_path, f)) for f in os.listdir(temp_dir_path)),
+                           5 * 2 ** 16)
+      # pending prefetches are cancelled on stop
+      release = threading.Event()
+      video.fetchSegment = lambda segment: release.wait(10) and b""
+      cache = canalplus.hls_proxy.SegmentCache(os.path.join(temp_dir_path, "stopped"), max_size=2 ** 16)
+      proxy = canalplus.hls_proxy.HlsProxy(video, prefetch=1, cache=cache)
+      proxy.start()
+      running, pending = proxy.submitFetch(0), proxy.submitFetch(1)
+      while not running.running():
+        time.sleep(0.05)
+      proxy.stop()
+      release.set()
+      self.assertTrue(pending.cancelled())
+      self.assertEqual(running.result(), cache.get(proxy.playlist[0]))
+
+  def test_remuxQueue(self):
+    """ Run remux stages in the background, with a bounded number of pending files. """
+    lock = threading.Lock()
+    pending = [0]
+    max_pending = [0]
+    done = []
+
+    def remux(i, pending_filepath, mp4_filepath):
+      time.sleep(0.05)
+      with lock:
+        pending[0] -= 1
+        done.append(i)
+      if i in (3, 5):
+        raise OSError("remux failed")
+      os.replace(pending_filepath, mp4_filepath)
+
+    videos = [canalplus.CanalPlusVideo(i, "video %u" % (i)) for i in range(6)]
+    with tempfile.TemporaryDirectory() as temp_dir_path:
+      with canalplus.RemuxQueue(workers=1, max_pending=2) as remux_queue:
+        for i, video in enumerate(videos):
+          with lock:
+            pending[0] += 1
+            max_pending[0] = max(max_pending[0], pending[0])
+          pending_filepath = os.path.join(temp_dir_path, "%u.ts.remux" % (i))
+          with open(pending_filepath, "wb") as f:
+            f.write(b"video %u" % (i))
+          # the pending file of the last video can not be moved to its fallback path
+          ts_filepath = os.path.join(temp_dir_path, "missing" if (i == 5) else "", "%u.ts" % (i))
+          remux_queue.submit(video,
+                             remux,
+                             i,
+                             pending_filepath,
+                             os.path.join(temp_dir_path, "%u.mp4" % (i)),
+                             pending=(pending_filepath, ts_filepath))
+          # submitting does not wait for the remux
+          self.assertNotIn(i, done)
+      self.assertEqual(sorted(os.listdir(temp_dir_path)), ["0.mp4", "1.mp4", "2.mp4", "3.ts", "4.mp4"])
+      with open(os.path.join(temp_dir_path, "3.ts"), "rb") as f:
+        self.assertEqual(f.read(), b"video 3")
+    self.assertEqual(done, list(range(6)))
+    self.assertLessEqual(max_pending[0], 3)
+    self.assertEqual(remux_queue.failed, [videos[3], videos[5]])
+
+  def test_remux(self):
+    """ Probe stream types of TS data, and choose remux flags. """
+    # PAT: program 1 -> PMT PID 0x100
+    pat = make_ts_section_packet(0, 0x00, bytes((0, 1, 0xe1, 0x00)))
+    # PMT: H.264 video on PID 0x101, ADTS AAC audio on PID 0x102 with a 3 bytes descriptor
+    pmt = make_ts_section_packet(0x100,
+                                 0x02,
+                                 bytes((0xe1, 0x01, 0xf0, 0x00,
+                                        0x1b, 0xe1, 0x01, 0xf0, 0x00,
+                                        0x0f, 0xe1, 0x02, 0xf0, 0x03, 0x0a, 0x01, 0x00)))
+    es = bytes((0x47, 0x01, 0x01, 0x10)) + b"\x00" * 184
+    self.assertEqual(remux.parse_ts_stream_types(es + pat + es + pmt + es), (0x1b, 0x0f))
+    # PMT before PAT is ignored
+    self.assertEqual(remux.parse_ts_stream_types(pmt + pat + pmt), (0x1b, 0x0f))
+    self.assertIsNone(remux.parse_ts_stream_types(pat + es))
+    self.assertIsNone(remux.parse_ts_stream_types(b""))
+    self.assertIsNone(remux.parse_ts_stream_types(pat + b"\x00" * 188 + pmt))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      ts_filepath = os.path.join(tmp_dir, "v.ts")
+      with open(ts_filepath, "wb") as f:
+        f.write(pat + pmt + es * 10)
+      self.assertEqual(remux.probe_ts_stream_types(ts_filepath), (0x1b, 0x0f))
+
+    converter = remux.Converter.__new__(remux.Converter)
+    converter.name = converter.path = "ffmpeg"
+    converter.bitstream_filters = frozenset(("aac_adtstoasc", "h264_mp4toannexb"))
+    cmds = converter.getRemuxCmds("v.ts", "v.mp4", (0x1b, 0x0f))
+    self.assertEqual(len(cmds), 1)
+    self.assertIn("aac_adtstoasc", cmds[0])
+    self.assertEqual(cmds[0][-1], "v.mp4")
+    cmds = converter.getRemuxCmds("v.ts", "v.mp4", (0x1b, 0x03))
+    self.assertEqual(len(cmds), 1)
+    self.assertNotIn("aac_adtstoasc", cmds[0])
+    cmds = converter.getRemuxCmds("v.ts", "v.mp4", None)
+    self.assertEqual(len(cmds), 2)
+    self.assertNotIn("aac_adtstoasc", cmds[0])
+    self.assertIn("aac_adtstoasc", cmds[1])
+    converter.bitstream_filters = frozenset()
+    cmds = converter.getRemuxCmds("v.ts", "v.mp4", (0x1b, 0x0f))
+    self.assertNotIn("aac_adtstoasc", cmds[0])
+    self.assertNotIn("aac_adtstoasc", converter.getStreamRemuxCmd("v.mp4"))
+
+    # detection is cached
+    self.assertIs(remux.get_converter(), remux.get_converter())
+
+  def test_remuxDownload(self):
+    """ Remux downloads with a fake converter, while downloading or after, and check the TS fallback on failure. """
+    files = {"/%u.ts" % (i): os.urandom(random.randint(1, 2 ** 16)) for i in range(3)}
+    expected = b"".join(files["/%u.ts" % (i)] for i in range(len(files)))
+    files["/video.m3u8"] = ("#EXTM3U\n%s" % ("".join("#EXTINF:10,\n%u.ts\n" % (i)
+                                                        for i in range(len(files))))).encode("utf-8")
+    with fake_converter() as converter_dir_path, serve_files(files) as base_url:
+      inputs_filepath = os.path.join(converter_dir_path, "inputs")
+      self.assertEqual(remux.get_converter().name, "ffmpeg")
+      video = canalplus.CanalPlusVideo(0, "video")
+      video.stream_url = "%s/video.m3u8" % (base_url)
+      for fail in (False, True):
+        if fail:
+          open(os.path.join(converter_dir_path, "fail"), "wb").close()
+        for stream_remux in (False, True):
+          with tempfile.TemporaryDirectory() as temp_dir_path:
+            # leftover of an interrupted run
+            with open(os.path.join(temp_dir_path, "video.mp4.part"), "wb") as f:
+              f.write(b"garbage")
+            with contextlib.suppress(FileNotFoundError):
+              os.remove(inputs_filepath)
+            self.assertTrue(video.download(temp_dir_path, stream_remux=stream_remux, show_progress=False))
+            with open(inputs_filepath, "rt") as f:
+              inputs = f.read().splitlines()
+            if stream_remux:
+              # the file is only remuxed again if remuxing while downloading failed
+              self.assertEqual(inputs[0], "pipe:0")
+              self.assertEqual(len(inputs) > 1, fail)
+            else:
+              self.assertNotIn("pipe:0", inputs)
+            filename = "video.ts" if fail else "video.mp4"
+            expected_filenames = [filename]
+            if not stream_remux:
+              expected_filenames.append("video.mp4.part")
+            self.assertEqual(sorted(os.listdir(temp_dir_path)), sorted(expected_filenames))
+            with open(os.path.join(temp_dir_path, filename), "rb") as f:
+              self.assertEqual(f.read(), expected)
+
+          with tempfile.TemporaryDirectory() as temp_dir_path:
+            mp4_filepath = os.path.join(temp_dir_path, "video.mp4.part")
+            for success in (True, False):
+              process = video.startStreamRemux(mp4_filepath)
+              process.stdin.write(expected)
+              self.assertEqual(video.endStreamRemux(process, mp4_filepath, success), success and (not fail))
+              self.assertEqual(os.path.isfile(mp4_filepath), success and (not fail))
 
 
 class TestCanalPlus(unittest.TestCase):